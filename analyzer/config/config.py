@@ -32,6 +32,8 @@ _C.AUTOENCODER.MAX_VAR = 0.001
 _C.AUTOENCODER.MAX_GRADIENT = 1.0
 _C.AUTOENCODER.FEATURES = ['shape', 'texture']
 _C.AUTOENCODER.LARGE_OBJECT_SAMPLES = 4
+# 'object' extracts every object on its own, 'sweep' decodes every slice once for all objects that touch it.
+_C.AUTOENCODER.EXTRACT_MODE = 'object'
 _C.AUTOENCODER.MONITOR_PATH = 'models/vae/'
 _C.AUTOENCODER.MODEL = '' # models/vae/human/run_2021-08-29/vae_ptc_model_10.pt
 # -----------------------------------------------------------------------------
@@ -46,14 +48,18 @@ _C.PTC.WEIGHT_DECAY = 0.0001
 _C.PTC.LATENT_SPACE = 512
 _C.PTC.FILTER_LIST = [64, 64, 64, 128, 512]
 _C.PTC.LINEAR_LAYERS = [1024, 1024]
-_C.PTC.SAMPLE_MODE = None
+_C.PTC.SAMPLE_MODE = None # None || 'partial' || 'whitenoise' || 'montecarlo' || 'bluenoise' || 'farthest'
 _C.PTC.RECON_NUM_POINTS = 5000
 _C.PTC.SAMPLE_SIZE = 4096
-_C.PTC.BLUE_NOISE_SAMPLE_POINTS = 10
+_C.PTC.BLUE_NOISE_SAMPLE_POINTS = 10 # random candidates per blue noise step. 0 is farthest point sampling.
+_C.PTC.SAMPLE_BATCH_POINTS = 65536 # padded points of a batch of clouds that is sampled at once (small batches stay in cache).
 _C.PTC.LOG_INTERVAL = 10
 _C.PTC.DEVICE = 'cpu'
 _C.PTC.INPUT_DATA = ''
 _C.PTC.INPUT_DATA_SAMPLED = '' # wn_pts.h5, mc_pts.h5, bn_pts.h5
+_C.PTC.STORE_FORMAT = 'ragged' # 'ragged': one points array with ids and offsets || 'groups': one dataset ptcs/<id> per object
+_C.PTC.STORE_CHUNKS = 16384 # points per chunk of the ragged point cloud store.
+_C.PTC.STORE_CODEC = 'lz4' # 'lz4' || 'blosc' (need hdf5plugin) || 'lzf' || 'gzip' || 'none'
 _C.PTC.FEATURE_NAME = 'ptcf'
 _C.PTC.OUTPUT_FOLDER = 'features/'
 _C.PTC.MONITOR_PATH = 'models/ptc/'
@@ -93,7 +99,18 @@ _C.DATASET.CHUNK_SIZE = [100, 4096, 4096]
 _C.DATASET.FILE_FORMAT = 'png'
 _C.DATASET.ROOTF = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'features/')
 _C.DATASET.ROOTD = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'datasets/')
+# deprecated: replaced by the region index.
 _C.DATASET.DATAINFO = 'features/data_info.json'
+# folder of the persistent per-object region index (columnar .npy files, memory-mapped).
+_C.DATASET.REGION_INDEX = 'features/region_index/'
+# Chunked h5 volume that holds the em, label and gt stacks. Written by MODE.PROCESS 'ingest' and used instead of the images once it exists.
+_C.DATASET.VOLUME_STORE = 'datasets/volume_store.h5'
+_C.DATASET.STORE_CHUNKS = [16, 256, 256]
+_C.DATASET.STORE_CODEC = 'lz4' # 'lz4' || 'blosc' (need hdf5plugin) || 'lzf' || 'gzip' || 'none'
+# Block-wise 3d connected component labeling (MODE.PROCESS 'cclabel') of CC_SOURCE into CC_TARGET of the volume store.
+_C.DATASET.CC_SOURCE = 'label'
+_C.DATASET.CC_TARGET = 'cc'
+_C.DATASET.CC_BLOCK = [64, 1024, 1024]
 _C.DATASET.CHUNKS_PATH = ''
 _C.DATASET.EXCLUDE_BORDER_OBJECTS = False
 # -----------------------------------------------------------------------------
@@ -118,9 +135,35 @@ _C.CLUSTER.FEAT_LIST = ['sizef', 'distf', 'shapef', 'texturef', 'circf', 'ptc_sh
 #Please make sure these weights make the dimension of the features. Means 4 features 4 weight factors.
 _C.CLUSTER.WEIGHTSF = [1, 1, 1 ,1, 1, 1]
 _C.CLUSTER.N_CLUSTER = 5
+# Rows of the distance matrix that are computed at once for 'aggloCl' and 'specCl'.
+_C.CLUSTER.BLOCK_ROWS = 2048
+# Neighbours per object in the sparse affinity of 'specCl'.
+_C.CLUSTER.KNN = 30
+# Sparse kNN graph on the feature matrix for 'aggloCl', 'specCl' and 'dbscan': 'exact' || 'approx'.
+# '' keeps the (N x N) distance store for 'aggloCl' and 'specCl' and the feature matrix for 'dbscan'.
+_C.CLUSTER.KNN_MODE = ''
+# Rows per batch and passes over all batches of 'minibatch_kmeans'.
+_C.CLUSTER.BATCH_SIZE = 4096
+_C.CLUSTER.STREAM_EPOCHS = 3
+# Reuse distance matrices and kNN graphs from ROOTF/cache/. They are keyed by a hash of the feature contents,
+# their order, the weights and the scaler, so changed inputs are never served from the cache.
+_C.CLUSTER.CACHE = True
+# Grid of MODE.PROCESS 'clsweep': every weight vector is combined with every number of clusters.
+_C.CLUSTER.SWEEP_WEIGHTSF = []
+_C.CLUSTER.SWEEP_N_CLUSTER = []
+# Algorithms of MODE.PROCESS 'clcompare'. Each runs with every number of clusters in SWEEP_N_CLUSTER (or N_CLUSTER).
+_C.CLUSTER.COMPARE_ALGS = ['kmeans', 'specCl', 'aggloCl', 'dbscan']
+# Common id order of the feature files: 'inner' (ids in every file) || 'outer' (ids in any file) || 'first' (ids of
+# the first file). Features of ids that are missing in a file are set to ID_FILL.
+_C.CLUSTER.ID_JOIN = 'inner'
+_C.CLUSTER.ID_FILL = 0.0
+# Float features are down-cast to this dtype when they are read from the feature files.
+_C.CLUSTER.FEATURE_DTYPE = 'float32'
 _C.CLUSTER.OUTPUTPATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'outputs/')
 _C.CLUSTER.NEUROGLANCER = False
 _C.CLUSTER.GENERATE_MASKS = False
+# Masks are written as uint16 images ('png') or as one chunked volume 'cluster' in OUTPUTPATH/masks/masks.h5 ('store').
+_C.CLUSTER.MASK_OUTPUT = 'png'
 _C.CLUSTER.VISUALIZATION = False
 _C.CLUSTER.BINARY = False
 _C.CLUSTER.TRUE_LABEL = 23299
@@ -0,0 +1,148 @@
+import os, sys
+import itertools
+import multiprocessing
+
+import h5py
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
+from tqdm import tqdm
+
+from analyzer.data.volume_store import get_codec, get_volume_store_path, volume_store_exists
+
+
+def label_volume_store(cfg):
+    '''
+    Block-wise 3d connected component labeling of one volume of the volume store. The volume
+    never has to fit into memory:
+        1. every block is labeled on its own in parallel and written with a global offset to a
+           temporary h5 file.
+        2. the faces between neighbouring blocks are compared in parallel. Touching components
+           (same source value) are collected as equivalence pairs and merged by a union-find pass.
+        3. every block is relabeled with the resulting lookup table and written to the target volume.
+    Voxels with different values are never connected, so a label volume is split into its
+    connected parts while a binary mask is labeled. Connectivity is 6 (face neighbours).
+    :param cfg: configuration manager. Uses DATASET.CC_SOURCE, CC_TARGET and CC_BLOCK.
+
+    :returns: (int) number of components.
+    '''
+    path = get_volume_store_path(cfg)
+    if not volume_store_exists(path):
+        raise ValueError('No volume store found in {}. Run MODE.PROCESS \'ingest\' first.'.format(path))
+    source, target = cfg.DATASET.CC_SOURCE, cfg.DATASET.CC_TARGET
+    cpus = cfg.SYSTEM.NUM_CPUS if cfg.SYSTEM.NUM_CPUS is not None else multiprocessing.cpu_count()
+    tmp_path = path + '.cc.tmp'
+
+    with h5py.File(path, 'r') as f:
+        shape = f[source].shape
+        chunks = f[source].chunks
+    blocks = get_blocks(shape, cfg.DATASET.CC_BLOCK)
+    print('Labeling {} of shape {} in {} blocks.'.format(source, shape, len(blocks)))
+
+    # 1. label every block independently.
+    n_labels = 0
+    with h5py.File(tmp_path, 'w') as tmp, multiprocessing.Pool(processes=cpus) as pool:
+        ds = tmp.create_dataset('cc', shape, dtype=np.uint32, chunks=chunks, compression='lzf')
+        tasks = [(path, source, block) for block in blocks]
+        for block, labels, num in tqdm(pool.imap(label_block, tasks), total=len(blocks)):
+            if n_labels + num >= np.iinfo(np.uint32).max:
+                raise ValueError('Too many provisional labels. Choose a larger DATASET.CC_BLOCK.')
+            labels[labels > 0] += n_labels
+            ds[block_slices(block)] = labels
+            n_labels += num
+
+    # 2. stitch the labels across block faces.
+    faces = [(path, tmp_path, source, block, axis) for block in blocks for axis in range(3)
+             if block[axis + 3] < shape[axis]]
+    with multiprocessing.Pool(processes=cpus) as pool:
+        pairs = [p for p in tqdm(pool.imap(face_pairs, faces), total=len(faces)) if p.shape[0] > 0]
+    pairs = np.concatenate(pairs) if len(pairs) > 0 else np.zeros((0, 2), dtype=np.uint32)
+    lut = merge_labels(n_labels, pairs)
+    n_components = int(lut.max())
+    print('{} provisional labels merged to {} components.'.format(n_labels, n_components))
+
+    # 3. relabel every block with the lookup table.
+    dt = np.uint16 if n_components <= np.iinfo(np.uint16).max else np.uint32
+    with h5py.File(path, 'a') as f, multiprocessing.Pool(processes=cpus, initializer=init_lut, initargs=(lut.astype(dt),)) as pool:
+        if target in f:
+            del f[target]
+        ds = f.create_dataset(target, shape, dtype=dt, chunks=chunks, **get_codec(cfg.DATASET.STORE_CODEC))
+        tasks = [(tmp_path, block) for block in blocks]
+        for block, labels in tqdm(pool.imap(relabel_block, tasks), total=len(blocks)):
+            ds[block_slices(block)] = labels
+
+    os.remove(tmp_path)
+    print('connected components written to \'{}\' in {}.'.format(target, path))
+    return n_components
+
+
+def merge_labels(n_labels, pairs):
+    '''
+    Union-find over the provisional labels. Every equivalence pair connects two labels; the
+    connected parts of this graph are the final components.
+    :param n_labels: (int) number of provisional labels (1..n_labels).
+    :param pairs: (np.array) (M x 2) of equivalent labels.
+    :returns lut: (np.array) that maps every provisional label to its consecutive final label. 0 stays 0.
+    '''
+    graph = coo_matrix((np.ones(pairs.shape[0], dtype=bool), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n_labels + 1, n_labels + 1))
+    _, roots = connected_components(graph, directed=False)
+    # components are numbered in order of their smallest label and label 0 is never paired.
+    return roots.astype(np.uint32)
+
+
+def get_blocks(shape, block_size):
+    '''returns all blocks (z0, y0, x0, z1, y1, x1) that cover a volume of shape.'''
+    ranges = [[(s, min(s + b, n)) for s in range(0, n, b)] for n, b in zip(shape, block_size)]
+    return [(z[0], y[0], x[0], z[1], y[1], x[1]) for z, y, x in itertools.product(*ranges)]
+
+
+def block_slices(block):
+    return tuple(slice(block[i], block[i + 3]) for i in range(3))
+
+
+def label_block(args):
+    '''Helper for 'label_volume_store' that labels one block.'''
+    path, source, block = args
+    with h5py.File(path, 'r') as f:
+        data = f[source][block_slices(block)]
+    labels, num = label(data, background=0, return_num=True, connectivity=1)
+    return block, labels.astype(np.uint32), num
+
+
+def face_pairs(args):
+    '''
+    Helper for 'label_volume_store' that compares the last plane of one block with the first
+    plane of its neighbour along axis.
+    :returns: (np.array) (M x 2) unique pairs of provisional labels that touch.
+    '''
+    path, tmp_path, source, block, axis = args
+    start = list(block[:3])
+    end = list(block[3:])
+    start[axis] = block[axis + 3] - 1
+    end[axis] = block[axis + 3] + 1
+    face = (start[0], start[1], start[2], end[0], end[1], end[2])
+
+    with h5py.File(tmp_path, 'r') as f:
+        labels = np.moveaxis(f['cc'][block_slices(face)], axis, 0)
+    with h5py.File(path, 'r') as f:
+        values = np.moveaxis(f[source][block_slices(face)], axis, 0)
+
+    mask = (labels[0] > 0) & (labels[1] > 0) & (values[0] == values[1])
+    if not mask.any():
+        return np.zeros((0, 2), dtype=np.uint32)
+    return np.unique(np.stack((labels[0][mask], labels[1][mask]), axis=1), axis=0)
+
+
+def init_lut(lut):
+    global LUT
+    LUT = lut
+
+
+def relabel_block(args):
+    '''Helper for 'label_volume_store' that applies the lookup table to one block.'''
+    tmp_path, block = args
+    with h5py.File(tmp_path, 'r') as f:
+        labels = f['cc'][block_slices(block)]
+    return block, LUT[labels]
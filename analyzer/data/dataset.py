@@ -16,7 +16,9 @@ from skimage.transform import resize
 from sklearn.cluster import KMeans
 from tqdm import tqdm
 
+from analyzer.data.region_index import RegionIndex, build_region_index, get_region_index_path, region_index_exists
 from analyzer.data.utils.data_raw import readvol, folder2Vol
+from analyzer.data.volume_store import VolumeStore, get_volume_store_path, volume_store_exists
 from analyzer.utils.eval_model import Evaluationmodel
 
 
@@ -69,6 +71,9 @@ class Dataloader():
         self.vae_feature = feature
         self.mito_volume_file_name = "{}mito_samples.h5".format(cfg.DATASET.ROOTD)
         self.exclude_borders = cfg.DATASET.EXCLUDE_BORDER_OBJECTS
+        self.region_index = None
+        self.volume_store = None
+        self.fns = None
 
     def __len__(self):
         '''
@@ -88,11 +93,41 @@ class Dataloader():
             return f["chunk"][idx], idx
 
     def get_fns(self):
-        '''returns the em, label and gt filenames of every image.'''
-        emfns = sorted(glob.glob(self.volpath + '*.' + self.ff))
-        labelfns = sorted(glob.glob(self.labelpath + '*.' + self.ff))
-        gtfns = sorted(glob.glob(self.gtpath + '*.' + self.ff))
-        return (emfns, labelfns, gtfns)
+        '''returns the em, label and gt filenames of every image. The folders are globbed only once.'''
+        if self.fns is None:
+            emfns = sorted(glob.glob(self.volpath + '*.' + self.ff))
+            labelfns = sorted(glob.glob(self.labelpath + '*.' + self.ff))
+            gtfns = sorted(glob.glob(self.gtpath + '*.' + self.ff))
+            self.fns = (emfns, labelfns, gtfns)
+        return self.fns
+
+    def get_volume_store(self):
+        '''returns the chunked volume store of the dataset or None if it has not been ingested.'''
+        if self.volume_store is None:
+            path = get_volume_store_path(self.cfg)
+            if volume_store_exists(path):
+                self.volume_store = VolumeStore(path)
+        return self.volume_store
+
+    def read_slice(self, vol, z, bbox=None):
+        '''
+        Read one slice of a stack, optionally cropped to a 2d bounding box.
+        The slice is taken from the volume store if it exists, otherwise from the image files.
+        :param vol: (string) 'em', 'label' or 'gt'.
+        :param z: (int) slice index.
+        :param bbox: (tuple) (minr, minc, maxr, maxc) with exclusive max values. None reads the full slice.
+        :returns: (np.array) 2d slice or crop.
+        '''
+        store = self.get_volume_store()
+        if store is not None and vol in store:
+            return store.read_slice(vol, z, bbox)
+
+        emfns, labelfns, gtfns = self.get_fns()
+        fns = {'em': emfns, 'label': labelfns, 'gt': gtfns}[vol]
+        img = imageio.imread(fns[z])
+        if bbox is None:
+            return img
+        return np.array(img[bbox[0]:bbox[2], bbox[1]:bbox[3]])
 
     def load_chunk(self, vol='all', mode='3d'):
         '''
@@ -115,15 +150,18 @@ class Dataloader():
         if mode == '3d':
             if (vol == 'em') or (vol == 'all'):
                 if self.volume is None:
-                    emdata = folder2Vol(self.volpath, self.chunk_size, file_format=self.ff)
+                    emdata = folder2Vol(self.volpath, self.chunk_size, file_format=self.ff,
+                                        store=self.get_volume_store(), dataset='em')
                     print('em data loaded: ', emdata.shape)
             if (vol == 'label') or (vol == 'all'):
                 if self.labels is None:
-                    labels = folder2Vol(self.labelpath, self.chunk_size, file_format=self.ff)
+                    labels = folder2Vol(self.labelpath, self.chunk_size, file_format=self.ff,
+                                        store=self.get_volume_store(), dataset='label')
                     print('label data loaded: ', labels.shape)
             if (vol == 'gt') or (vol == 'all'):
                 if self.gt is None:
-                    gt = folder2Vol(self.gtpath, self.chunk_size, file_format=self.ff)
+                    gt = folder2Vol(self.gtpath, self.chunk_size, file_format=self.ff,
+                                    store=self.get_volume_store(), dataset='gt')
                     print('gt data loaded: ', gt.shape)
 
         return (emdata, labels, gt)
@@ -185,98 +223,48 @@ class Dataloader():
 
         return (bbox_dict)
 
-    def prep_data_info(self, volopt='label', save=False):
+    def get_region_index(self, save=True, scan=None):
+        '''
+        Opens the persistent region index of the label stack. If it does not exist yet,
+        it is built by one scan over the label slices.
+        :param save: (bool) persist a newly built index to DATASET.REGION_INDEX. Otherwise it is kept in memory.
+        :param scan: (ScanResult) precomputed scan of the label stack that is reused if possible.
+        :returns: (RegionIndex)
+        '''
+        if self.region_index is None:
+            path = get_region_index_path(self.cfg)
+            if region_index_exists(path):
+                self.region_index = RegionIndex(path)
+            else:
+                print('region index not found. Will be computed.')
+                _, fns, _ = self.get_fns()
+                self.region_index = build_region_index(fns, path=path if save else None, cpus=self.cpus, scan=scan)
+        return self.region_index
+
+    def prep_data_info(self, volopt='label', save=False, scan=None):
         '''
         This function aims as an inbetween function iterating over the whole dataset in efficient
         and memory proof fashion in order to preserve information that is needed for further steps.
-        :param volopt: (string) this sets the volume you want to use for the operation. default: gt
-        :param kernel_n: (int) number of CPU kernels you want to use for multiprocessing.
-
-        :returns added: (dict) that contains the labels with respective information as (list): [pixelsize, [slice_index(s)]]
-        '''
-        if volopt == 'label':
-            fns = sorted(glob.glob(self.labelpath + '*.' + self.ff))
-        elif volopt == 'em':
-            fns = sorted(glob.glob(self.volpath + '*.' + self.ff))
-        else:
-            raise ValueError('Please enter the volume on which \'prep_data_info\' should run on.')
-
-        if self.exclude_borders:
-            fns = fns[1:-1]
-
-        with multiprocessing.Pool(processes=self.cpus) as pool:
-            result = pool.starmap(self.calc_props, enumerate(fns))
-
-        added = {}
-        for dicts in result:
-            for key, value in dicts.items():
-                if key in added:
-                    added[key][0] += value[0]
-                    added[key][1].append(value[1])
-                    if self.exclude_borders:
-                        if not added[key][2]:
-                            added[key].append(value[2])
+        The information is taken from the region index.
+        :param volopt: (string) this sets the volume you want to use for the operation. default: label
+        :param save: (bool) persist the region index if it has to be built.
+        :param scan: (ScanResult) precomputed scan of the label stack that is reused if it covers
+                     the needed properties.
 
-                else:
-                    added.setdefault(key, [])
-                    added[key].append(value[0])
-                    added[key].append([value[1]])
-                    if self.exclude_borders:
-                        added[key].append(value[2])
-
-        result_array = []
-        for result in added.keys():
-            if self.exclude_borders and added[result][2]:
-                continue
-            result_array.append({
-                'id': result,
-                'size': added[result][0],
-                'slices': added[result][1]
-            })
-        if save:
-            with open(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO), 'w') as f:
-                json.dump(result_array, f, cls=NumpyEncoder)
-                f.close()
-
-        return (result_array)
-
-    def calc_props(self, idx, fns):
+        :returns result_array: (list) of (dict)s that contain the labels with respective information: id, size, slices.
         '''
-        Helper function for 'prep_data_info'
-        :param idx: (int) this is the slice index that correspondes to the image slice. E.g. idx 100 belongs to image 100.
-        :param fns: (string) list of filenames.
-        :returns result: (dict) with each segment. key: idx of segment -- value: [number of pixels in segment, idx of slice].
-        '''
-        result = {}
-        if os.path.exists(fns):
-            tmp = imageio.imread(fns)
-            for region in regionprops(tmp):
-                result.setdefault(region.label, [])
-                result[region.label].append(region.area)
-                result[region.label].append(idx)
-                result[region.label].append(False)
-                if self.exclude_borders:
-                    minr, minc, maxr, maxc = region.bbox
-                    if minr == 0 or minc == 0:
-                        result[region.label][-1] = True
-                    if maxr == tmp.shape[0] or maxc == tmp.shape[0]:
-                        result[region.label][-1] = True
+        if volopt != 'label':
+            raise ValueError('Please enter the volume on which \'prep_data_info\' should run on. Only \'label\' is indexed.')
 
-        return result
+        return self.get_region_index(save=save, scan=scan).to_data_info(exclude_borders=self.exclude_borders)
 
     def precluster(self, mchn='simple', n_groups=5):
         '''
         Function preclusters the mitochondria into buckets of similar size in order to avoid
         sparsity and loss of information while extracting latent representation of the mitochondria.
         '''
-        if os.path.exists(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO)) \
-                and os.stat(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO)).st_size != 0:
-            with open(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO), 'r') as f:
-                data_info = json.loads(f.read())
-        else:
-            data_info = self.prep_data_info(save=True)
-
-        tmp = np.stack(([mito['id'] for mito in data_info], [mito['size'] for mito in data_info]), axis=-1)
+        index = self.get_region_index()
+        tmp = np.stack((np.asarray(index.ids), np.asarray(index.size)), axis=-1)
 
         if mchn == 'simple':
             sorted = tmp[tmp[:, 1].argsort()[::-1]]
@@ -299,18 +287,15 @@ class Dataloader():
         '''
         Function to extract the objects as volumes and scale them. Then its saves the scaled volumes to an h5 file.
         '''
-        if os.path.exists(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO)) \
-                and os.stat(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO)).st_size != 0:
-            with open(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.DATAINFO), 'r') as f:
-                regions = json.loads(f.read())
-        else:
-            regions = self.prep_data_info(save=False)
-
-        print("{} objects found in the ground truth".format(len(regions)))
+        index = self.get_region_index()
+        self.get_fns()
+        print("{} objects found in the ground truth".format(len(index)))
 
-        regions = pd.DataFrame(regions)
-        regions = regions[(self.upper_limit > regions['size']) & (self.lower_limit < regions['size']) & (
-                len(regions['slices']) > 1)].values.tolist()
+        size = np.asarray(index.size)
+        keep = (self.upper_limit > size) & (self.lower_limit < size) & (np.asarray(index.zmax) > np.asarray(index.zmin))
+        if self.exclude_borders:
+            keep &= ~np.asarray(index.border)
+        regions = [{'id': int(index.ids[r]), 'size': int(size[r])} for r in np.flatnonzero(keep)]
         filtered_length = len(regions)
         print("{} within limits {} and {}".format(filtered_length, self.lower_limit, self.upper_limit))
         if self.region_limit is not None:
@@ -347,7 +332,7 @@ class Dataloader():
     def get_mito_volume(self, region):
         '''
         Preprocessing function to extract and scale the mitochondria as volume
-        :param region: (dict) one region object provided by Dataloader.prep_data_info
+        :param region: (dict) one region object that contains at least the 'id'.
         :returns result: (numpy.array) a numpy array with the target dimensions and the mitochondria in it
         '''
         gt_volume, em_volume = self.get_volumes_from_slices(region)
@@ -377,29 +362,38 @@ class Dataloader():
         scaled_texture = scaled_texture / scaled_texture.max()
         scaled_texture = np.expand_dims(scaled_texture, 0)
         if scaled_shape.sum() < self.lower_limit * 0.1:
-            print("region {} was too small".format(region[0]))
+            print("region {} was too small".format(region["id"]))
             return [-1, np.zeros(shape=(1, *self.target_size)), np.zeros(shape=(1, *self.target_size))]
 
-        return [region[0], scaled_shape, scaled_texture]
+        return [region["id"], scaled_shape, scaled_texture]
 
     def get_volumes_from_slices(self, region):
         '''
-        #TODO
-        :param region:
-        :returns gt_volume, em_volume:
+        Stacks the slices the object appears in to a label and an em volume that only contain the object.
+        Only the 2d bounding box of the object (taken from the region index) is read from every slice.
+        With a volume store the whole 3d bounding box is read as one sub-block.
+        :param region: (dict) one region object that contains at least the 'id'.
+        :returns gt_volume, em_volume: (np.array)s of shape (slices, bbox height, bbox width).
         '''
-        gt_all_fn = sorted(glob.glob(self.labelpath + '*.' + self.ff))
-        em_all_fn = sorted(glob.glob(self.volpath + '*.' + self.ff))
-
-        gt_fns = [gt_all_fn[id] for id in region["slices"]]
-        em_fns = [em_all_fn[id] for id in region["slices"]]
+        index = self.get_region_index()
+        zmin, minr, minc, zmax, maxr, maxc = index.bbox(region["id"])
+        bbox = (minr, minc, maxr, maxc)
+
+        store = self.get_volume_store()
+        if store is not None and 'label' in store and 'em' in store:
+            rows = index.slices(region["id"]) - zmin
+            gt_volume = store.read('label', (zmin, minr, minc, zmax, maxr, maxc))[rows]
+            em_volume = store.read('em', (zmin, minr, minc, zmax, maxr, maxc))[rows]
+            em_volume[gt_volume != region["id"]] = 0
+            gt_volume[gt_volume != region["id"]] = 0
+            return gt_volume, em_volume
 
         gt_volume = []
         em_volume = []
 
-        for i in range(len(gt_fns)):
-            gt_slice = imageio.imread(gt_fns[i])
-            em_slice = imageio.imread(em_fns[i])
+        for z in index.slices(region["id"]):
+            gt_slice = self.read_slice('label', z, bbox)
+            em_slice = self.read_slice('em', z, bbox)
 
             gt_slice[gt_slice != region["id"]] = 0
             em_slice[gt_slice != region["id"]] = 0
@@ -412,12 +406,21 @@ class Dataloader():
     def extract_scale_mitos_samples(self):
         '''
         Function to extract the objects as volumes and scale them. Then its saves the scaled volumes to an h5 file.
+        AUTOENCODER.EXTRACT_MODE 'sweep' runs the slice-major extraction instead of one task per object.
         '''
+        regex = re.compile('([0-9]+)_mito_samples.h5')
+        if self.cfg.AUTOENCODER.EXTRACT_MODE == 'sweep':
+            for root, dirs, files in os.walk(self.cfg.DATASET.ROOTD):
+                for file in files:
+                    if regex.match(file):
+                        os.remove(self.cfg.DATASET.ROOTD + file)
+            return self.extract_scale_mitos_sweep()
+
         regions = self.prep_data_info(save=True)
+        self.get_fns()
 
         print("{} objects found in the ground truth".format(len(regions)))
 
-        regex = re.compile('([0-9]+)_mito_samples.h5')
         for root, dirs, files in os.walk(self.cfg.DATASET.ROOTD):
             for file in files:
                 if regex.match(file):
@@ -460,66 +463,132 @@ class Dataloader():
                     break
                 region = in_q.get(timeout=10)
                 gt_volume, em_volume = self.get_volumes_from_slices(region)
+                for sample in self.get_mito_samples(gt_volume, em_volume):
+                    counter = self.write_sample(chunks, ids, counter, sample, region["id"])
+
+        return
+
+    def get_mito_samples(self, gt_volume, em_volume):
+        '''
+        Cuts the texture of one object into samples of the target size. Objects that are larger than
+        the target size are sampled LARGE_OBJECT_SAMPLES times at random positions.
+        :param gt_volume: (np.array) label volume that only contains the object.
+        :param em_volume: (np.array) em volume that is masked by the object.
+        :returns samples: (list) of (np.array)s with shape target_size, normalized to [0, 1].
+        '''
+        samples = []
+        mito_regions = regionprops(gt_volume, cache=False)
+        if len(mito_regions) != 1:
+            return samples
+        mito_region = mito_regions[0]
+        texture = None
+
+        if len(mito_region.bbox) < 6:
+            texture = np.zeros((*em_volume.shape, 2))
+            texture[mito_region.bbox[0]:mito_region.bbox[2] + 1,
+            mito_region.bbox[1]:mito_region.bbox[3] + 1, 0] = em_volume[
+                                                              mito_region.bbox[0]:mito_region.bbox[2] + 1,
+                                                              mito_region.bbox[1]:mito_region.bbox[3] + 1]
+        else:
+            texture = em_volume[mito_region.bbox[0]:mito_region.bbox[3] + 1,
+                      mito_region.bbox[1]:mito_region.bbox[4] + 1,
+                      mito_region.bbox[2]:mito_region.bbox[5] + 1].astype(np.float32)
+
+        large = any([d > self.target_size[i] for i, d in enumerate(texture.shape)])
+
+        if large:
+            for i in range(self.large_samples):
 
-                mito_regions = regionprops(gt_volume, cache=False)
-                if len(mito_regions) != 1:
+                x, y, z = 0, 0, 0
+
+                if texture.shape[0] > self.target_size[0]:
+                    z = np.random.random_integers(0, texture.shape[0] - self.target_size[0])
+                if texture.shape[1] > self.target_size[1]:
+                    x = np.random.random_integers(0, texture.shape[1] - self.target_size[1])
+                if texture.shape[2] > self.target_size[2]:
+                    y = np.random.random_integers(0, texture.shape[2] - self.target_size[2])
+
+                sample = texture[
+                         z:z + self.target_size[0],
+                         x:x + self.target_size[1],
+                         y:y + self.target_size[2]]
+                if np.count_nonzero(sample) / sample.size < 0.1:
                     continue
-                mito_region = mito_regions[0]
-                texture = None
-
-                if len(mito_region.bbox) < 6:
-                    texture = np.zeros((*em_volume.shape, 2))
-                    texture[mito_region.bbox[0]:mito_region.bbox[2] + 1,
-                    mito_region.bbox[1]:mito_region.bbox[3] + 1, 0] = em_volume[
-                                                                      mito_region.bbox[0]:mito_region.bbox[2] + 1,
-                                                                      mito_region.bbox[1]:mito_region.bbox[3] + 1]
-                else:
-                    texture = em_volume[mito_region.bbox[0]:mito_region.bbox[3] + 1,
-                              mito_region.bbox[1]:mito_region.bbox[4] + 1,
-                              mito_region.bbox[2]:mito_region.bbox[5] + 1].astype(np.float32)
-
-                large = any([d > self.target_size[i] for i, d in enumerate(texture.shape)])
-
-                if large:
-                    for i in range(self.large_samples):
-
-                        x, y, z = 0, 0, 0
-
-                        if texture.shape[0] > self.target_size[0]:
-                            z = np.random.random_integers(0, texture.shape[0] - self.target_size[0])
-                        if texture.shape[1] > self.target_size[1]:
-                            x = np.random.random_integers(0, texture.shape[1] - self.target_size[1])
-                        if texture.shape[2] > self.target_size[2]:
-                            y = np.random.random_integers(0, texture.shape[2] - self.target_size[2])
-
-                        sample = texture[
-                                 z:z + self.target_size[0],
-                                 x:x + self.target_size[1],
-                                 y:y + self.target_size[2]]
-                        if np.count_nonzero(sample) / sample.size < 0.1:
-                            continue
-                        sample_padding = np.zeros(self.target_size)
-
-                        sample_padding[0:texture.shape[0], 0:texture.shape[1], 0:texture.shape[2]] = sample
-                        if len(chunks) <= counter:
-                            chunks.resize((chunks.shape[0] + 1), axis=0)
-                            ids.resize((ids.shape[0] + 1), axis=0)
-                        np.expand_dims(sample_padding, 0)
-                        chunks[counter] = sample_padding/sample_padding.max()
-                        ids[counter] = region["id"]
-                        counter += 1
+                sample_padding = np.zeros(self.target_size)
 
-                else:
-                    sample_padding = np.zeros(self.target_size)
-                    sample_padding[0:texture.shape[0], 0:texture.shape[1], 0:texture.shape[2]] = texture
-                    if len(chunks) <= counter:
-                        chunks.resize((chunks.shape[0] + 1), axis=0)
-                        ids.resize((ids.shape[0] + 1), axis=0)
-                    np.expand_dims(sample_padding, 0)
-                    chunks[counter] = sample_padding/sample_padding.max()
-                    ids[counter] = region["id"]
-                    counter += 1
+                sample_padding[0:texture.shape[0], 0:texture.shape[1], 0:texture.shape[2]] = sample
+                samples.append(sample_padding/sample_padding.max())
+
+        else:
+            sample_padding = np.zeros(self.target_size)
+            sample_padding[0:texture.shape[0], 0:texture.shape[1], 0:texture.shape[2]] = texture
+            samples.append(sample_padding/sample_padding.max())
+
+        return samples
+
+    def write_sample(self, chunks, ids, counter, sample, label):
+        '''
+        Helper that appends one sample to the resizable h5 datasets 'chunk' and 'id'.
+        :returns counter: (int) position of the next sample.
+        '''
+        if len(chunks) <= counter:
+            chunks.resize((chunks.shape[0] + 1), axis=0)
+            ids.resize((ids.shape[0] + 1), axis=0)
+        chunks[counter] = sample
+        ids[counter] = label
+        return counter + 1
+
+    def extract_scale_mitos_sweep(self):
+        '''
+        Slice-major alternative to the per object extraction. The stack is swept once in z order in slabs
+        (as deep as one chunk of the volume store, single slices without it). The workers decode a slab
+        and return only the masked bounding box crops of the objects that are active in it; as soon as
+        the z range of an object closes its volume is cut into samples.
+        Every slice is therefore decoded once instead of once per object that touches it.
+        '''
+        index = self.get_region_index()
+        emfns, labelfns, _ = self.get_fns()
+        keep = np.ones(len(index), dtype=bool)
+        if self.exclude_borders:
+            keep = ~np.asarray(index.border)
+        rows = np.flatnonzero(keep)
+        labels = np.asarray(index.ids)[rows].astype(np.int64)
+        zmin = np.asarray(index.zmin)[rows]
+        zmax = np.asarray(index.zmax)[rows]
+        boxes = np.array([index.bbox(label) for label in labels], dtype=np.int64).reshape(-1, 6)[:, [1, 2, 4, 5]]
+        print("{} objects will be extracted by sweeping over {} slices".format(len(labels), index.n_slices))
+
+        store = self.get_volume_store()
+        if store is None or 'label' not in store or 'em' not in store:
+            store = None
+        depth = store.slab_depth('label') if store is not None else 1
+        slabs = []
+        for z0 in range(0, index.n_slices, depth):
+            z1 = min(z0 + depth, index.n_slices)
+            sel = np.flatnonzero((zmin < z1) & (zmax >= z0))
+            slabs.append((z0, z1, labels[sel], boxes[sel], zmin[sel], zmax[sel]))
+
+        active = {}
+        counter = 0
+        with h5py.File(self.cfg.DATASET.ROOTD + "0_mito_samples.h5", "w") as f:
+            chunks = f.create_dataset("chunk", (1, 1, *self.target_size),
+                                      maxshape=(None, 1, *self.target_size))
+            ids = f.create_dataset("id", (1,), maxshape=(None,))
+
+            with multiprocessing.Pool(processes=self.cpus, initializer=init_sweep, initargs=(store, labelfns, emfns)) as pool:
+                for (z0, z1, _, _, _, _), crops in zip(slabs, tqdm(pool.imap(sweep_slab, slabs), total=len(slabs))):
+                    for z, items in zip(range(z0, z1), crops):
+                        for label, gt_crop, em_crop in items:
+                            gt_crops, em_crops = active.setdefault(label, ([], []))
+                            gt_crops.append(gt_crop)
+                            em_crops.append(em_crop)
+
+                        for label in labels[zmax == z].tolist():
+                            gt_crops, em_crops = active.pop(label, ([], []))
+                            for sample in self.get_mito_samples(np.array(gt_crops), np.array(em_crops)):
+                                counter = self.write_sample(chunks, ids, counter, sample, label)
 
+        self.cleanup_h5()
         return
 
     def cleanup_h5(self):
@@ -559,3 +628,63 @@ class Dataloader():
                 gts[i] = gt_lookup[str(id)]
 
             print("samples collected: {}".format(len(mainf["id"])))
+
+
+def init_sweep(store, labelfns, emfns):
+    global SWEEP_STORE, SWEEP_LABELFNS, SWEEP_EMFNS
+    SWEEP_STORE, SWEEP_LABELFNS, SWEEP_EMFNS = store, labelfns, emfns
+
+
+def sweep_slab(slab):
+    '''
+    Helper for 'extract_scale_mitos_sweep' that crops the objects of the slices z0..z1-1.
+    With a volume store the slab is read in bands of one chunk row, so every chunk is decoded once and
+    only one band is in memory next to the crops. The image files are read one slice at a time.
+    :param slab: (tuple) z0, z1 and the labels, 2d bboxes (minr, minc, maxr, maxc), zmin and zmax of the
+                 objects that are active in the slab.
+    :returns: (list) for every slice of (list)s of (label, gt_crop, em_crop) of the objects found in it.
+    '''
+    z0, z1, labels, boxes, zmin, zmax = slab
+    result = [[] for _ in range(z0, z1)]
+    if labels.shape[0] == 0:
+        return result
+    y0, x0 = int(boxes[:, 0].min()), int(boxes[:, 1].min())
+    y1, x1 = int(boxes[:, 2].max()), int(boxes[:, 3].max())
+
+    if SWEEP_STORE is not None:
+        chunks = SWEEP_STORE._open()['label'].chunks
+        step = chunks[1] if chunks is not None else y1 - y0
+        read = lambda vol, ya, yb: SWEEP_STORE.read(vol, (z0, ya, x0, z1, yb, x1))
+    else:
+        step = y1 - y0
+        read = lambda vol, ya, yb: np.stack([imageio.imread((SWEEP_LABELFNS if vol == 'label' else SWEEP_EMFNS)[z])[ya:yb, x0:x1]
+                                             for z in range(z0, z1)])
+
+    gt_vols, em_vols = {}, {}
+    # bands are aligned to the chunk rows of the store.
+    for ya in range((y0 // step) * step, y1, step):
+        ya, yb = max(ya, y0), min((ya // step + 1) * step, y1)
+        obj = np.flatnonzero((boxes[:, 0] < yb) & (boxes[:, 2] > ya))
+        if obj.size == 0:
+            continue
+        gt_band, em_band = read('label', ya, yb), read('em', ya, yb)
+        for o in obj.tolist():
+            minr, minc, maxr, maxc = boxes[o].tolist()
+            if o not in gt_vols:
+                gt_vols[o] = np.zeros((z1 - z0, maxr - minr, maxc - minc), dtype=gt_band.dtype)
+                em_vols[o] = np.zeros((z1 - z0, maxr - minr, maxc - minc), dtype=em_band.dtype)
+            ra, rb = max(minr, ya), min(maxr, yb)
+            gt_vols[o][:, ra - minr:rb - minr] = gt_band[:, ra - ya:rb - ya, minc - x0:maxc - x0]
+            em_vols[o][:, ra - minr:rb - minr] = em_band[:, ra - ya:rb - ya, minc - x0:maxc - x0]
+
+    for o, label in enumerate(labels.tolist()):
+        for z in range(max(z0, int(zmin[o])), min(z1, int(zmax[o]) + 1)):
+            gt_crop, em_crop = gt_vols[o][z - z0], em_vols[o][z - z0]
+            mask = gt_crop != label
+            if mask.all():
+                continue
+            gt_crop, em_crop = gt_crop.copy(), em_crop.copy()
+            gt_crop[mask] = 0
+            em_crop[mask] = 0
+            result[z - z0].append((label, gt_crop, em_crop))
+    return result
@@ -0,0 +1,121 @@
+import os, sys
+
+import h5py
+import numpy as np
+
+
+def label_join_index(base_labels, labels):
+    '''
+    Sort/searchsorted join of two id vectors in O(N log N).
+    :param base_labels: (np.array) This is the reference labels order.
+    :param labels: (np.array) ids of the rows of a feature file.
+    :returns idx: (np.array) row in labels of every id of base_labels (0 if the id is missing).
+    :returns found: (np.array) bool mask of the ids of base_labels that are in labels.
+    '''
+    labels = np.asarray(labels)
+    if labels.shape[0] == 0:
+        return np.zeros(len(base_labels), dtype=np.int64), np.zeros(len(base_labels), dtype=bool)
+    order = np.argsort(labels, kind='stable')
+    pos = np.minimum(np.searchsorted(labels[order], base_labels), labels.shape[0] - 1)
+    found = labels[order[pos]] == base_labels
+    return np.where(found, order[pos], 0), found
+
+
+class FeatureStore():
+    '''
+    Lazy access to the feature files ROOTF/<fns>.h5, each holding the dataset 'id' and one feature
+    dataset named fns without the trailing 'f' (e.g. sizef.h5 -> 'size'). Nothing is read before a
+    feature is requested. Uncompressed, contiguous datasets are opened as read-only memory maps,
+    all others are read through h5py, so in both cases only the requested rows are loaded.
+    The store can be handed to worker processes, every process opens its own views.
+
+    :param root: (string) folder of the feature files (DATASET.ROOTF).
+    :param dtype: (string) float features with a larger dtype are down-cast to it on read. None keeps the dtype.
+    '''
+    def __init__(self, root, dtype='float32'):
+        self.root = root
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self._files = {}
+        self._views = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_views'] = {}
+        return state
+
+    def path(self, fns):
+        return self.root + fns + '.h5'
+
+    def __contains__(self, fns):
+        return os.path.exists(self.path(fns))
+
+    def ids(self, fns):
+        '''(np.array) object ids of the rows of feature fns.'''
+        return np.array(self.view(fns, 'id'))
+
+    def shape(self, fns):
+        return self.view(fns).shape
+
+    def view(self, fns, name=None):
+        '''
+        Lazy view of one dataset of a feature file.
+        :param name: (string) dataset. Defaults to the feature itself.
+        :returns: (np.memmap) or (h5py.Dataset) that is read on indexing.
+        '''
+        name = fns[:-1] if name is None else name
+        if (fns, name) not in self._views:
+            if fns not in self._files:
+                self._files[fns] = h5py.File(self.path(fns), 'r')
+            ds = self._files[fns][name]
+            offset = ds.id.get_offset() if ds.chunks is None and ds.compression is None else None
+            if offset is not None and ds.size > 0:
+                self._views[(fns, name)] = np.memmap(self.path(fns), dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+            else:
+                self._views[(fns, name)] = ds
+        return self._views[(fns, name)]
+
+    def read(self, fns, ids=None, fill=0):
+        '''
+        Reads a feature, optionally only the rows of the objects ids and in their order.
+        :param fns: (string) feature name, e.g. 'sizef'.
+        :param ids: (np.array) object ids. None reads all rows in file order.
+        :param fill: value of the rows whose id is not in the file.
+        :returns: (np.array) of the feature rows.
+        '''
+        view = self.view(fns)
+        if ids is None:
+            return self.cast(view[:])
+
+        idx, found = label_join_index(ids, self.ids(fns))
+        rows = np.unique(idx[found])
+        # rows are read once each and in increasing order, which h5py needs for fancy indexing.
+        values = self.cast(view[rows] if rows.size > 0 else view[:0])
+        if found.all() and np.array_equal(rows, idx):
+            return values
+
+        dtype = values.dtype if found.all() else np.result_type(values.dtype, np.min_scalar_type(fill))
+        result = np.full((len(ids),) + values.shape[1:], fill, dtype=dtype)
+        result[found] = values[np.searchsorted(rows, idx[found])]
+        return result
+
+    def cast(self, values):
+        '''copies the values out of the file (never a view of it) and down-casts them.'''
+        values = np.array(values)
+        if self.dtype is not None and values.dtype.kind == 'f' and values.dtype.itemsize > self.dtype.itemsize:
+            return values.astype(self.dtype)
+        return values
+
+    def write(self, fns, ids, values):
+        '''writes a feature file with the object ids and the feature values (uncompressed, so it can be memory mapped).'''
+        self.close(fns)
+        with h5py.File(self.path(fns), 'w') as h5f:
+            h5f.create_dataset('id', data=ids)
+            h5f.create_dataset(fns[:-1], data=values)
+
+    def close(self, fns=None):
+        '''drops the open views and handles of one feature or of all.'''
+        for key in [key for key in self._views if fns is None or key[0] == fns]:
+            del self._views[key]
+        for key in [key for key in self._files if fns is None or key == fns]:
+            self._files.pop(key).close()
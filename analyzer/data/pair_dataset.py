@@ -5,6 +5,7 @@ import torch
 import torch.utils.data
 from analyzer.data.utils.data_raw import *
 from analyzer.data.utils.data_misc import *
+from analyzer.data.volume_store import VolumeStore, get_volume_store_path, volume_store_exists
 from analyzer.data.augmentation import Augmentor
 
 class PairDataset():
@@ -93,8 +94,13 @@ class PairDataset():
             vol = readvol(emfns[0])
             label = readvol(labelfns[0])
         else:
-            vol = folder2Vol(chunk_size=self.cfg.DATASET.CHUNK_SIZE, fns=emfns, file_format=self.cfg.DATASET.FILE_FORMAT)
-            label = folder2Vol(chunk_size=self.cfg.DATASET.CHUNK_SIZE, fns=labelfns, file_format=self.cfg.DATASET.FILE_FORMAT)
+            store = None
+            if volume_store_exists(get_volume_store_path(self.cfg)):
+                store = VolumeStore(get_volume_store_path(self.cfg))
+            vol = folder2Vol(chunk_size=self.cfg.DATASET.CHUNK_SIZE, fns=emfns, file_format=self.cfg.DATASET.FILE_FORMAT,
+                             store=store, dataset='em')
+            label = folder2Vol(chunk_size=self.cfg.DATASET.CHUNK_SIZE, fns=labelfns, file_format=self.cfg.DATASET.FILE_FORMAT,
+                               store=store, dataset='label')
 
         return vol, label
 
@@ -3,12 +3,12 @@ import random
 
 import numpy as np
 import h5py
-from scipy import stats
 from sklearn.preprocessing import normalize
-from tqdm import tqdm
-from sklearn.metrics import pairwise_distances
 import multiprocessing as mp
 
+from analyzer.data.ptc_store import PtcStore, is_ptc_store, open_ptc_store
+from analyzer.data.ptc_sampler import farthest_point_sample
+
 def normalize_ptc(ptc):
     '''
     Function normalizes the ptc (Nxd) by min-max-scaling.
@@ -19,6 +19,7 @@ def normalize_ptc(ptc):
 class PtcDataset():
     '''
     This is the Data module for the pointcloud autoencoder.
+    The point clouds are read from a ragged store (PtcStore), so a sample is one slice of the points array.
     '''
     def __init__(self, cfg, sample_size=2000, sample_mode=None):
         self.cfg = cfg
@@ -29,92 +30,44 @@ class PtcDataset():
         self.blue_noise_sample_points = cfg.PTC.BLUE_NOISE_SAMPLE_POINTS
         self.sampled_ptfn = self.cfg.PTC.INPUT_DATA_SAMPLED
         self.rptcfn = cfg.DATASET.ROOTD + 'vae/random_ptc' + '.h5'
+        self._store = None
 
-        if self.sample_mode == 'whitenoise':
-            if os.path.exists(self.rptcfn) or os.path.exists(self.sampled_ptfn):
-                print('{} exists and will be used.'.format(self.sampled_ptfn))
+        # the samples are computed beforehand by the mode 'ptcsample'. Samples written as ragged store
+        # are read by position, older files with one dataset per object by the object id.
+        self.sampled = None
+        if self.sample_mode is not None and self.sample_mode != 'partial':
+            if is_ptc_store(self.sampled_ptfn):
+                self.sampled = PtcStore(self.sampled_ptfn)
+            elif not os.path.exists(self.sampled_ptfn):
+                raise ValueError('No {} samples found in {}. Run the mode \'ptcsample\' first.'.format(self.sample_mode, self.sampled_ptfn))
             else:
-                print("Calculating random points via white noise sampling.")
-                with h5py.File(self.ptfn, 'r') as h5f:
-                    #with h5py.File(self.rptcfn, 'w') as random_points_file:
-                    with h5py.File(self.sampled_ptfn, 'w') as random_points_file:
-                        for key, cloud in tqdm(h5f['ptcs'].items(), total=len(h5f['ptcs'].keys())):
-                            idxs = np.random.randint(0, len(cloud), self.sample_size)
-                            random_points_file[key] = np.array(cloud)[idxs, :].astype(np.double)
-
-        if self.sample_mode == 'montecarlo':
-            if os.path.exists(self.rptcfn) or os.path.exists(self.sampled_ptfn):
                 print('{} exists and will be used.'.format(self.sampled_ptfn))
-            else:
-                print("Calculating random points via monte carlo (MC) sampling")
-                with h5py.File(self.ptfn, 'r') as h5f:
-                    #with h5py.File(self.rptcfn, 'w') as random_points_file:
-                    with h5py.File(self.sampled_ptfn, 'w') as random_points_file:
-                        group = h5f.get('ptcs')
-                        for idx in tqdm(group.keys(), total=len(group.keys())):
-                            cloud = np.array(group[idx])
-                            centroid = np.mean(cloud, axis=0)
-                            dists = []
-                            for point in cloud:
-                                dists.append(np.linalg.norm(point - centroid))
-                            dists /= sum(dists)
-                            xk = np.arange(len(dists))
-                            custm = stats.rv_discrete(name='custm', values=(xk, dists))
-                            random_points = cloud[custm.rvs(size=self.sample_size), :]
-                            random_points_file[idx] = random_points
 
-        if self.sample_mode == "bluenoise":
-            if os.path.exists(self.rptcfn) or os.path.exists(self.sampled_ptfn):
-                print('{} exists and will be used.'.format(self.sampled_ptfn))
-            else:
-                print("calculating random points via bluenoise sampling")
-                with h5py.File(self.ptfn, 'r') as h5f:
-                    # clouds = [(str(key), np.array(cloud)) for key, cloud in h5f['ptcs'].items()]
-                    # #clouds = clouds[:10]
-                    # pool = mp.Pool(processes=cfg.SYSTEM.NUM_CPUS)
-                    # results = [pool.apply(self.calculate_blue_noise_samples, args=(key, cloud,)) for key, cloud in
-                    #            tqdm(clouds, total=len(clouds))]
-                    # with h5py.File(self.rptcfn, 'w') as random_points_file:
-                    #     for result in results:
-                    #         random_points_file[result[0]] = result[1]
-                    with h5py.File(self.sampled_ptfn, 'w') as random_points_file:
-                        for k, c in tqdm(list(h5f['ptcs'].items()), total=len(h5f['ptcs'].items())):
-                            key = str(k)
-                            cloud = np.array(c)
-                            key, random_points = self.calculate_blue_noise_samples(key, cloud)
-                            random_points_file[key] = random_points
+    @property
+    def store(self):
+        '''
+        (PtcStore) of the point clouds of PTC.INPUT_DATA. It is opened on first use, so a file in the old
+        layout is only converted when the full clouds are read and not if the ragged samples are enough.
+        '''
+        if self._store is None:
+            self._store = open_ptc_store(self.ptfn, chunks=self.cfg.PTC.STORE_CHUNKS, codec=self.cfg.PTC.STORE_CODEC)
+        return self._store
 
     def calculate_blue_noise_samples(self, key, cloud):
-        '''helper for calculating blue noise.'''
-        idxs = []
-        dists = pairwise_distances(cloud)
-        possible_idx = list(np.arange(0, len(cloud)))
-        start = random.sample(possible_idx, 1)[0]
-        idxs.append(start)
-        for i in range(1, self.sample_size):
-            bnsp = self.blue_noise_sample_points
-            if bnsp > len(possible_idx):
-                bnsp = len(possible_idx)
-            candidates = np.random.randint(0, len(cloud), bnsp)
-            reduced_dists = dists[candidates, :][:, idxs]
-            sums = np.sum(reduced_dists, axis=1)
-            best_candidate = candidates[np.argmax(sums)]
-            idxs.append(best_candidate)
-        random_points = cloud[idxs, :]
-        return key, random_points
+        '''helper for calculating blue noise of a single cloud, see 'farthest_point_sample'.'''
+        idxs = farthest_point_sample([np.asarray(cloud)], self.sample_size, candidates=self.blue_noise_sample_points,
+                                     seed=random.randrange(2 ** 32))
+        return key, np.asarray(cloud)[idxs[0], :]
 
     def __len__(self):
         '''Required by torch to return the length of the dataset. Returns: (int).'''
-        if self.sample_mode == 'partial':
-            with h5py.File(self.ptfn, 'r') as h5f:
-                return len(list(h5f.get('ptcs').keys()))
-        elif self.sample_mode is not None:
+        if self.sampled is not None:
+            return len(self.sampled)
+        if self.sample_mode is not None and self.sample_mode != 'partial':
             #with h5py.File(self.rptcfn, 'r') as random_points_file:
             with h5py.File(self.sampled_ptfn, 'r') as random_points_file:
                 return len(random_points_file.keys())
-        else:
-            with h5py.File(self.ptfn, 'r') as h5f:
-                return len(list(h5f.get('ptcs').keys()))
+        return len(self.store)
 
     def __getitem__(self, idx):
         '''
@@ -122,10 +75,9 @@ class PtcDataset():
         :param idx: (int) index of the object. Please note that this is NOT the actual label.
         :returns: object from the volume. (np.array)
         '''
-        with h5py.File(self.ptfn, 'r') as h5f:
-            group = h5f.get('ptcs')
-            idx = sorted(list(group.keys()))[idx]
-            ptc = np.array(group[idx])
+        if self.sampled is not None:
+            return np.expand_dims(self.sampled[idx], axis=0), str(self.sampled.ids[idx])
+        idx, ptc = str(self.store.ids[idx]), self.store[idx]
         if self.sample_mode == 'partial':
                 if ptc.shape[0] > self.sample_size:
                     randome_indices = np.random.random_integers(ptc.shape[0] - 1, size=(self.sample_size))
@@ -136,24 +88,20 @@ class PtcDataset():
             with h5py.File(self.sampled_ptfn, 'r') as random_points_file:
                 return np.expand_dims(random_points_file[str(idx)], axis=0), idx
         else:
-            return np.expand_dims(ptc, axis=0), str(idx)
+            return np.expand_dims(ptc, axis=0), idx
 
     @property
     def keys(self):
         '''property that gives to a list of keys (ints) that are in the dataset.
         '''
-        with h5py.File(self.ptfn, 'r') as h5f:
-            return list(map(int, list(h5f.get('ptcs').keys())))
+        if self.sampled is not None:
+            return self.sampled.ids.tolist()
+        return self.store.ids.tolist()
 
     @property
     def dimlist(self):
         '''returns list of number of points that every point cloud contains.'''
-        dim_list = list()
-        with h5py.File(self.ptfn, 'r') as h5f:
-            group = h5f.get('ptcs')
-            for _, idx in enumerate(list(h5f.get('ptcs').keys())):
-                dim_list.append(np.array(group[str(idx)]).shape[0])
-        return dim_list
+        return self.store.sizes.tolist()
 
     def split_dataset(self):
         '''split dataset and keep order (avoid loss of label information).'''
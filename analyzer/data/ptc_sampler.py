@@ -0,0 +1,169 @@
+import os, sys
+import multiprocessing
+
+import numpy as np
+from tqdm import tqdm
+
+from analyzer.data.ptc_store import PtcStore, PtcWriter, open_ptc_store
+
+SAMPLE_MODES = ['whitenoise', 'montecarlo', 'bluenoise', 'farthest']
+
+
+def white_noise_sample(cloud, n, rng):
+    '''(np.array) n indices drawn uniformly (with replacement) from the points of cloud.'''
+    return rng.integers(0, cloud.shape[0], n)
+
+
+def monte_carlo_sample(cloud, n, rng):
+    '''
+    (np.array) n indices drawn (with replacement) with a probability proportional to the distance
+    of the point to the centroid of the cloud.
+    '''
+    dists = np.linalg.norm(cloud - cloud.mean(axis=0), axis=1)
+    total = dists.sum()
+    if total <= 0:
+        return white_noise_sample(cloud, n, rng)
+    return rng.choice(cloud.shape[0], n, p=dists / total)
+
+
+def farthest_point_sample(clouds, n, candidates=0, seed=0):
+    '''
+    Blue noise sampling of several point clouds at once. Only the distance of every point to its
+    nearest selected point is kept (one vector per cloud) and updated with the newly selected point,
+    so a step costs O(N) and no pairwise distance matrix is built. The clouds are padded into one
+    batch and stepped together; the distances are computed in place and in float32.
+    :param clouds: (list) of (N_i x d) np.arrays.
+    :param n: (int) number of points per cloud.
+    :param candidates: (int) 0: farthest point sampling, the point farthest from the selection is taken.
+                             k: best candidate sampling, the farthest of k random candidates is taken.
+    :param seed: (int) or np.random.Generator.
+    :returns: (np.array) (B x n) indices of the sampled points. Clouds with less than n points
+              hold all their points first and are filled up with random duplicates.
+    '''
+    rng = np.random.default_rng(seed)
+    sizes = np.array([cloud.shape[0] for cloud in clouds], dtype=np.int64)
+    if (sizes == 0).any():
+        raise ValueError('Empty point clouds can not be sampled.')
+    b, nmax = len(clouds), int(sizes.max())
+    # one (B x N_max) plane per coordinate, so every pass runs over contiguous memory.
+    planes = np.zeros((clouds[0].shape[1], b, nmax), dtype=np.float32)
+    mind = np.full((b, nmax), np.inf, dtype=np.float32)
+    for i, cloud in enumerate(clouds):
+        planes[:, i, :sizes[i]] = cloud.T
+        # padded points are never the farthest.
+        mind[i, sizes[i]:] = -1
+    dist, tmp = np.empty_like(mind), np.empty_like(mind)
+
+    rows = np.arange(b)
+    steps = np.minimum(sizes, n)
+    idxs = np.zeros((b, n), dtype=np.int64)
+    cur = rng.integers(0, sizes)
+    for step in range(int(steps.max())):
+        idxs[:, step] = cur
+        sel = planes[:, rows, cur][:, :, None]
+        np.subtract(planes[0], sel[0], out=dist)
+        np.multiply(dist, dist, out=dist)
+        for k in range(1, planes.shape[0]):
+            np.subtract(planes[k], sel[k], out=tmp)
+            np.multiply(tmp, tmp, out=tmp)
+            np.add(dist, tmp, out=dist)
+        np.minimum(mind, dist, out=mind)
+        if candidates > 0:
+            cand = rng.integers(0, sizes[:, None], (b, candidates))
+            cur = cand[rows, np.argmax(mind[rows[:, None], cand], axis=1)]
+        else:
+            cur = np.argmax(mind, axis=1)
+
+    for i in np.flatnonzero(steps < n):
+        idxs[i, steps[i]:] = rng.integers(0, sizes[i], n - steps[i])
+    return idxs
+
+
+def sample_batches(sizes, batch_points):
+    '''
+    Groups the objects into batches of similar size, so that little of a padded batch is padding.
+    :param sizes: (np.array) number of points of every object.
+    :param batch_points: (int) upper bound of the padded points (batch size x largest cloud) of a batch.
+    :returns: (list) of np.arrays with the positions of the objects in a batch.
+    '''
+    order = np.argsort(sizes, kind='stable')
+    batches, start = [], 0
+    for end in range(1, order.shape[0] + 1):
+        if end == order.shape[0] or (end + 1 - start) * sizes[order[end]] > batch_points:
+            batches.append(order[start:end])
+            start = end
+    return batches
+
+
+def sample_ptc_store(store, path, mode='bluenoise', sample_size=4096, candidates=10, cpus=None, batch_points=65536,
+                     seed=0, chunks=16384, codec='lz4'):
+    '''
+    Samples sample_size points of every object of a point cloud store and writes them into a new
+    ragged store. Batches of objects are sampled in parallel; the workers read the clouds themselves.
+    Every object has its slot in the order of store, so the samples are in the same order whichever
+    batch is finished first.
+    :param store: (PtcStore) point clouds.
+    :param path: (string) h5 file the samples are written to.
+    :param mode: (string) 'whitenoise': uniform sampling.
+                          'montecarlo': sampling weighted by the distance to the centroid.
+                          'bluenoise': best candidate sampling with candidates random candidates per step.
+                          'farthest': farthest point sampling.
+    :param batch_points: (int) padded points per batch, see 'sample_batches'.
+    :returns: (PtcStore) of the samples.
+    '''
+    if mode not in SAMPLE_MODES:
+        raise ValueError('No sample mode {}. Choose one of {}.'.format(mode, SAMPLE_MODES))
+    cpus = cpus if cpus is not None else multiprocessing.cpu_count()
+    batches = sample_batches(store.sizes, batch_points)
+    print('sampling {} points of {} objects in {} batches with {} processes ({}).'.format(
+        sample_size, len(store), len(batches), cpus, mode))
+
+    initargs = (store, mode, sample_size, candidates, seed)
+    with multiprocessing.Pool(processes=cpus, initializer=init_sampler, initargs=initargs) as pool:
+        with PtcWriter(path, chunks=chunks, codec=codec) as writer:
+            writer.reserve(store.ids, np.full(len(store), sample_size))
+            for batch, samples in tqdm(pool.imap_unordered(sample_batch, enumerate(batches)), total=len(batches)):
+                for pos, sample in zip(batch, samples):
+                    writer.put(pos, sample)
+    return PtcStore(path)
+
+
+def init_sampler(store, mode, sample_size, candidates, seed):
+    global SAMPLER_STORE, SAMPLER_MODE, SAMPLER_SIZE, SAMPLER_CANDIDATES, SAMPLER_SEED
+    SAMPLER_STORE, SAMPLER_MODE, SAMPLER_SIZE = store, mode, sample_size
+    SAMPLER_CANDIDATES, SAMPLER_SEED = candidates, seed
+
+
+def sample_batch(batch):
+    '''Helper for 'sample_ptc_store' that samples one batch of objects.'''
+    b, batch = batch
+    # every batch has its own stream of random numbers, so the result does not depend on the scheduling.
+    rng = np.random.default_rng([SAMPLER_SEED, b])
+    clouds = [np.asarray(SAMPLER_STORE[pos]) for pos in batch]
+    if SAMPLER_MODE == 'whitenoise':
+        idxs = [white_noise_sample(cloud, SAMPLER_SIZE, rng) for cloud in clouds]
+    elif SAMPLER_MODE == 'montecarlo':
+        idxs = [monte_carlo_sample(cloud, SAMPLER_SIZE, rng) for cloud in clouds]
+    else:
+        candidates = SAMPLER_CANDIDATES if SAMPLER_MODE == 'bluenoise' else 0
+        idxs = farthest_point_sample(clouds, SAMPLER_SIZE, candidates=candidates, seed=rng)
+    return batch, [cloud[idx] for cloud, idx in zip(clouds, idxs)]
+
+
+def sample_point_clouds(cfg):
+    '''
+    Preprocessing mode 'ptcsample': samples PTC.SAMPLE_SIZE points of every point cloud of PTC.INPUT_DATA
+    with PTC.SAMPLE_MODE and writes them to PTC.INPUT_DATA_SAMPLED.
+    :param cfg: configuration manager.
+    :returns: (PtcStore) of the samples.
+    '''
+    if cfg.PTC.SAMPLE_MODE not in SAMPLE_MODES:
+        raise ValueError('PTC.SAMPLE_MODE {} does not write samples. Choose one of {}.'.format(cfg.PTC.SAMPLE_MODE, SAMPLE_MODES))
+    if not cfg.PTC.INPUT_DATA_SAMPLED:
+        raise ValueError('No output file given. Set PTC.INPUT_DATA_SAMPLED.')
+    store = open_ptc_store(cfg.PTC.INPUT_DATA, chunks=cfg.PTC.STORE_CHUNKS, codec=cfg.PTC.STORE_CODEC)
+    samples = sample_ptc_store(store, cfg.PTC.INPUT_DATA_SAMPLED, mode=cfg.PTC.SAMPLE_MODE, sample_size=cfg.PTC.SAMPLE_SIZE,
+                               candidates=cfg.PTC.BLUE_NOISE_SAMPLE_POINTS, cpus=cfg.SYSTEM.NUM_CPUS,
+                               batch_points=cfg.PTC.SAMPLE_BATCH_POINTS, chunks=cfg.PTC.STORE_CHUNKS, codec=cfg.PTC.STORE_CODEC)
+    print('saved {} samples to {}.'.format(cfg.PTC.SAMPLE_MODE, cfg.PTC.INPUT_DATA_SAMPLED))
+    return samples
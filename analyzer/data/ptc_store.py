@@ -0,0 +1,237 @@
+import os, sys
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from analyzer.data.volume_store import get_codec
+
+
+def is_ptc_store(path):
+    '''checks if path holds a complete ragged point cloud store (and not the ptcs/<id> layout).'''
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, 'r') as f:
+        return 'offsets' in f and f.attrs.get('complete', False)
+
+
+def get_ptc_store_path(path):
+    '''file the ptcs/<id> layout in path is converted to.'''
+    root, ext = os.path.splitext(path)
+    return root + '_ragged' + (ext if ext else '.h5')
+
+
+class PtcWriter():
+    '''
+    Writes point clouds into one ragged store: all points concatenated in the (M x 3) dataset 'points',
+    the object ids in 'ids' and the start of every object in 'offsets' (N + 1 entries), so the points of
+    object i are points[offsets[i]:offsets[i + 1]]. The points are buffered and written in whole chunks,
+    so every chunk is compressed only once. Objects whose sizes are known beforehand can instead be
+    'reserve'd in their order and 'put' into their slots in any order.
+    :param path: (string) h5 file of the store.
+    :param chunks: (int) number of points per chunk.
+    :param codec: (string) compression, see 'get_codec'.
+    '''
+    def __init__(self, path, chunks=16384, codec='lz4'):
+        self.path = path
+        self.chunks = chunks
+        self.codec = get_codec(codec)
+        self.ids = []
+        self.offsets = [0]
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # the chunk cache holds the chunks that are filled out of order by 'put' until they are complete;
+        # many hash slots avoid collisions and complete chunks are evicted first.
+        self.h5f = h5py.File(path, 'w', rdcc_nbytes=64 * 1024 ** 2, rdcc_nslots=100003, rdcc_w0=1)
+        self.points = None
+        self.reserved = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, label, ptc):
+        '''
+        adds one point cloud.
+        :param label: (int) object id.
+        :param ptc: (np.array) (n x d) points of the object.
+        '''
+        ptc = np.asarray(ptc)
+        if self.points is None:
+            self.points = self.h5f.create_dataset('points', (0, ptc.shape[1]), maxshape=(None, ptc.shape[1]),
+                                                  dtype=ptc.dtype, chunks=(self.chunks, ptc.shape[1]), **self.codec)
+        self.ids.append(int(label))
+        self.offsets.append(self.offsets[-1] + ptc.shape[0])
+        self.buffer.append(ptc)
+        self.buffered += ptc.shape[0]
+        if self.buffered >= self.chunks:
+            self.flush(self.buffered - self.buffered % self.chunks)
+
+    def reserve(self, labels, sizes):
+        '''
+        fixes the order of the objects and their number of points, see 'put'.
+        :param labels: (np.array) object ids in the order of the store.
+        :param sizes: (np.array) number of points of every object.
+        '''
+        if len(self.ids) > 0:
+            raise ValueError('Objects can only be reserved in an empty store.')
+        self.ids = [int(label) for label in labels]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).tolist()
+        self.reserved = True
+
+    def put(self, idx, ptc):
+        '''
+        writes the point cloud of the idx-th reserved object.
+        :param idx: (int) position of the object in 'reserve'.
+        :param ptc: (np.array) (n x d) points of the object, n as reserved.
+        '''
+        ptc = np.asarray(ptc)
+        if not self.reserved:
+            raise ValueError('No objects reserved in {}.'.format(self.path))
+        if ptc.shape[0] != self.offsets[idx + 1] - self.offsets[idx]:
+            raise ValueError('Object {} has {} points, {} are reserved.'.format(
+                self.ids[idx], ptc.shape[0], self.offsets[idx + 1] - self.offsets[idx]))
+        if self.points is None:
+            # a fixed size dataset can not have chunks larger than itself.
+            rows = min(self.chunks, max(self.offsets[-1], 1))
+            self.points = self.h5f.create_dataset('points', (self.offsets[-1], ptc.shape[1]), dtype=ptc.dtype,
+                                                  chunks=(rows, ptc.shape[1]), **self.codec)
+        self.points[self.offsets[idx]:self.offsets[idx + 1]] = ptc
+
+    def flush(self, n=None):
+        '''writes the first n buffered points (all if None) to the file.'''
+        if self.buffered == 0:
+            return
+        block = np.concatenate(self.buffer, axis=0)
+        n = block.shape[0] if n is None else n
+        self.points.resize(self.written + n, axis=0)
+        self.points[self.written:self.written + n] = block[:n]
+        self.written += n
+        self.buffer = [block[n:]] if n < block.shape[0] else []
+        self.buffered = block.shape[0] - n
+
+    def close(self, complete=True):
+        '''writes the remaining points, the ids and the offsets. The flag is set last and marks the store as complete.'''
+        if self.h5f is None:
+            return
+        # an incomplete store is closed on an error, which must not be hidden by this check.
+        if complete and self.reserved and self.points is None and self.offsets[-1] > 0:
+            raise ValueError('No reserved object was written to {}.'.format(self.path))
+        if self.points is None:
+            self.points = self.h5f.create_dataset('points', (0, 3), maxshape=(None, 3), dtype=np.float64, chunks=(self.chunks, 3))
+        self.flush()
+        self.h5f.create_dataset('ids', data=np.array(self.ids, dtype=np.int64))
+        self.h5f.create_dataset('offsets', data=np.array(self.offsets, dtype=np.int64))
+        if complete:
+            self.h5f.attrs['complete'] = True
+        self.h5f.close()
+        self.h5f = None
+
+
+def convert_ptc_store(src, dst=None, chunks=16384, codec='lz4'):
+    '''
+    Converts point clouds stored as one dataset per object (ptcs/<id>) into a ragged store.
+    The objects are written in ascending id order.
+    :param src: (string) h5 file with the group 'ptcs'.
+    :param dst: (string) h5 file of the store. Defaults to 'get_ptc_store_path(src)'.
+    :returns: (PtcStore) opened store.
+    '''
+    dst = get_ptc_store_path(src) if dst is None else dst
+    with h5py.File(src, 'r') as h5f:
+        if 'ptcs' not in h5f:
+            raise ValueError('{} holds no group \'ptcs\' to convert.'.format(src))
+        group = h5f['ptcs']
+        keys = sorted(group.keys(), key=int)
+        print('Converting {} point clouds from {} to the ragged store {}.'.format(len(keys), src, dst))
+        with PtcWriter(dst, chunks=chunks, codec=codec) as writer:
+            for key in tqdm(keys):
+                writer.append(int(key), group[key][()])
+    return PtcStore(dst)
+
+
+def open_ptc_store(path, chunks=16384, codec='lz4'):
+    '''
+    Opens the point clouds in path as ragged store. A file in the layout with one dataset per
+    object (ptcs/<id>) is converted once into a store next to it.
+    :returns: (PtcStore)
+    '''
+    if is_ptc_store(path):
+        return PtcStore(path)
+    ragged = get_ptc_store_path(path)
+    if is_ptc_store(ragged):
+        print('{} exists and will be used.'.format(ragged))
+        return PtcStore(ragged)
+    return convert_ptc_store(path, ragged, chunks=chunks, codec=codec)
+
+
+class PtcStore():
+    '''
+    Read access to a ragged point cloud store. The ids and offsets are read once when the file is
+    opened, a point cloud is then one slice of 'points'. The file is opened on first use and again in
+    every new process, so the store can be handed to the workers of a torch DataLoader.
+    :param path: (string) h5 file of the store.
+    '''
+    def __init__(self, path):
+        if not is_ptc_store(path):
+            raise ValueError('No point cloud store found in {}.'.format(path))
+        self.path = path
+        self._file = None
+        self._pid = None
+        with h5py.File(path, 'r') as f:
+            self.ids = f['ids'][()]
+            self.offsets = f['offsets'][()]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        return state
+
+    def _open(self):
+        # h5 handles must not be shared with forked processes.
+        if self._file is None or self._pid != os.getpid():
+            # a chunk cache of several chunks keeps neighbouring small objects from being decompressed twice.
+            self._file = h5py.File(self.path, 'r', rdcc_nbytes=32 * 1024 ** 2)
+            self._pid = os.getpid()
+        return self._file
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __getitem__(self, idx):
+        '''(np.array) points of the idx-th object of the store.'''
+        return self._open()['points'][self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield int(self.ids[idx]), self[idx]
+
+    def index(self, label):
+        '''position of the object id label in the store.'''
+        idx = np.flatnonzero(self.ids == label)
+        if idx.size == 0:
+            raise ValueError('Object {} is not in {}.'.format(label, self.path))
+        return int(idx[0])
+
+    def get(self, label):
+        '''(np.array) points of the object id label.'''
+        return self[self.index(label)]
+
+    @property
+    def sizes(self):
+        '''(np.array) number of points of every object.'''
+        return np.diff(self.offsets)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
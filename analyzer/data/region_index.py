@@ -0,0 +1,224 @@
+import os, sys
+import json
+
+import numpy as np
+
+from analyzer.model.utils.scanner import scan_label_stack
+
+# Properties of the label stack that are needed to build the index.
+INDEX_PROPS = ['size', 'slices', 'centroid', 'surface_to_volume', 'random_pt', 'border', 'bbox']
+
+# Columns of the index. Object columns have one row per segment, record columns have
+# one row per (segment, slice) and are addressed by 'offsets'.
+OBJECT_COLUMNS = ['ids', 'size', 'zmin', 'zmax', 'border', 'offsets', 'lut']
+RECORD_COLUMNS = ['rec_z', 'rec_bbox', 'rec_centroid', 'rec_area', 'rec_perimeter', 'rec_sample']
+
+
+def get_region_index_path(cfg):
+    '''returns the folder of the region index that belongs to the label stack of cfg.'''
+    return os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.REGION_INDEX)
+
+
+def region_index_exists(path):
+    '''checks if a complete region index is stored in path.'''
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def build_region_index(fns=None, path=None, cpus=None, scan=None):
+    '''
+    Builds the per-object region index from the label stack and stores it columnar as .npy files.
+    :param fns: (list) of sorted label image filenames.
+    :param path: (string) folder where the index is written. If None the index is kept in memory.
+    :param cpus: (int) number of worker processes used if the stack has to be scanned.
+    :param scan: (ScanResult) precomputed scan that is reused if it covers INDEX_PROPS.
+
+    :returns: (RegionIndex) opened index.
+    '''
+    if scan is None or not scan.covers(INDEX_PROPS, records=True):
+        scan = scan_label_stack(fns, INDEX_PROPS, cpus=cpus)
+
+    ids = np.array(sorted(scan.keys()), dtype=np.int64)
+    counts = np.array([len(scan[key]['slices']) for key in ids], dtype=np.int64)
+    offsets = np.zeros(ids.shape[0] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    arrays = {
+        'ids': ids,
+        'offsets': offsets,
+        'size': np.array([sum(scan[key]['size']) for key in ids], dtype=np.int64),
+        'rec_z': np.array([z for key in ids for z in scan[key]['slices']], dtype=np.int32).reshape(-1),
+        'rec_bbox': np.array([b for key in ids for b in scan[key]['bbox']], dtype=np.int32).reshape(-1, 4),
+        'rec_centroid': np.array([c for key in ids for c in scan[key]['centroid']], dtype=np.float32).reshape(-1, 2),
+        'rec_area': np.array([a for key in ids for a, _ in scan[key]['surface_to_volume']], dtype=np.int64),
+        'rec_perimeter': np.array([p for key in ids for _, p in scan[key]['surface_to_volume']], dtype=np.float32),
+        'rec_sample': np.array([s for key in ids for s in scan[key]['random_pt']], dtype=np.int32).reshape(-1, 2),
+    }
+    arrays['zmin'] = arrays['rec_z'][offsets[:-1]] if ids.size else np.zeros(0, dtype=np.int32)
+    arrays['zmax'] = arrays['rec_z'][offsets[1:] - 1] if ids.size else np.zeros(0, dtype=np.int32)
+
+    n_slices = len(fns) if fns is not None else int(arrays['rec_z'].max()) + 1
+    border = np.array([any(scan[key]['border']) for key in ids], dtype=bool)
+    arrays['border'] = border | (arrays['zmin'] == 0) | (arrays['zmax'] == n_slices - 1)
+
+    lut = np.full(int(ids.max()) + 1 if ids.size else 1, -1, dtype=np.int32)
+    lut[ids] = np.arange(ids.shape[0], dtype=np.int32)
+    arrays['lut'] = lut
+
+    meta = {'n_objects': int(ids.shape[0]), 'n_records': int(offsets[-1]), 'n_slices': n_slices}
+    if path is None:
+        return RegionIndex(arrays=arrays, meta=meta)
+
+    os.makedirs(path, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), arr)
+    # meta.json is written last and marks the index as complete.
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print('region index with {} objects and {} slice records stored in {}.'.format(meta['n_objects'], meta['n_records'], path))
+    return RegionIndex(path)
+
+
+class RegionIndex():
+    '''
+    Persistent, columnar index of every segment in the label stack. All columns are
+    opened as read-only memory maps, so opening the index costs nothing and lookups by
+    label id are O(1) through a dense lookup table.
+
+    Object columns: ids, size (voxel count), zmin, zmax, border.
+    Slice record columns (per object and slice): z, bbox (minr, minc, maxr, maxc),
+    centroid (r, c), area, perimeter, sample voxel (r, c).
+
+    :param path: (string) folder that holds the index.
+    :param arrays: (dict) of in-memory columns. Used instead of path.
+    :param meta: (dict) meta information that belongs to arrays.
+    '''
+    def __init__(self, path=None, arrays=None, meta=None):
+        self.path = path
+        self._arrays = arrays
+        self.meta = meta
+        if path is not None:
+            if not region_index_exists(path):
+                raise ValueError('No region index found in {}.'.format(path))
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                self.meta = json.load(f)
+
+    def __getstate__(self):
+        # memory maps are reopened in the worker instead of being copied by pickle.
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['_arrays'] = None
+        return state
+
+    def __len__(self):
+        return self.meta['n_objects']
+
+    def __contains__(self, label):
+        return self.row(label) >= 0
+
+    def _col(self, name):
+        if self._arrays is None:
+            self._arrays = {}
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def ids(self):
+        return self._col('ids')
+
+    @property
+    def size(self):
+        return self._col('size')
+
+    @property
+    def zmin(self):
+        return self._col('zmin')
+
+    @property
+    def zmax(self):
+        return self._col('zmax')
+
+    @property
+    def border(self):
+        return self._col('border')
+
+    @property
+    def n_slices(self):
+        return self.meta['n_slices']
+
+    def row(self, label):
+        '''returns the row of label in the object columns or -1 if label is not indexed.'''
+        lut = self._col('lut')
+        label = int(label)
+        if label < 0 or label >= lut.shape[0]:
+            return -1
+        return int(lut[label])
+
+    def _rows(self, label):
+        r = self.row(label)
+        if r < 0:
+            raise KeyError('label {} is not part of the region index.'.format(label))
+        offsets = self._col('offsets')
+        return r, int(offsets[r]), int(offsets[r + 1])
+
+    def slices(self, label):
+        '''slice indices the object appears in.'''
+        _, start, end = self._rows(label)
+        return np.array(self._col('rec_z')[start:end])
+
+    def records(self, label):
+        '''
+        All slice records of one object.
+        :returns: (dict) with z, bbox, centroid, area, perimeter, sample as (np.array)s.
+        '''
+        _, start, end = self._rows(label)
+        return {name[4:]: np.array(self._col(name)[start:end]) for name in RECORD_COLUMNS}
+
+    def bbox(self, label):
+        '''3d bounding box (zmin, minr, minc, zmax, maxr, maxc) of one object. Max values are exclusive.'''
+        r, start, end = self._rows(label)
+        bbox = self._col('rec_bbox')[start:end]
+        return (int(self.zmin[r]), int(bbox[:, 0].min()), int(bbox[:, 1].min()),
+                int(self.zmax[r]) + 1, int(bbox[:, 2].max()), int(bbox[:, 3].max()))
+
+    def sample_voxel(self, label):
+        '''one voxel (z, r, c) that belongs to the object.'''
+        _, start, _ = self._rows(label)
+        sample = self._col('rec_sample')[start]
+        return (int(self._col('rec_z')[start]), int(sample[0]), int(sample[1]))
+
+    def centroids(self):
+        '''
+        Area weighted 3d centroid (r, c, z) of every object, in the order of ids. Computed from the
+        slice records in one vectorised pass.
+        '''
+        offsets = np.asarray(self._col('offsets'))
+        if len(self) == 0:
+            return np.zeros((0, 3), dtype=np.float64)
+        area = np.asarray(self._col('rec_area'), dtype=np.float64)
+        pts = np.concatenate([np.asarray(self._col('rec_centroid'), dtype=np.float64),
+                              np.asarray(self._col('rec_z'), dtype=np.float64)[:, None]], axis=1)
+        weighted = np.add.reduceat(area[:, None] * pts, offsets[:-1], axis=0)
+        return weighted / np.add.reduceat(area, offsets[:-1])[:, None]
+
+    def starting_in(self, z):
+        '''ids of all objects whose z range starts in slice z.'''
+        return np.array(self.ids[np.asarray(self.zmin) == z])
+
+    def to_data_info(self, exclude_borders=False):
+        '''
+        Converts the index to the list of (dict)s {id, size, slices} used by older consumers.
+        :param exclude_borders: (bool) drop objects that touch a face of the volume.
+        '''
+        offsets = self._col('offsets')
+        rec_z = self._col('rec_z')
+        result_array = []
+        for r in range(len(self)):
+            if exclude_borders and self.border[r]:
+                continue
+            result_array.append({
+                'id': int(self.ids[r]),
+                'size': int(self.size[r]),
+                'slices': rec_z[offsets[r]:offsets[r + 1]].tolist()
+            })
+        return result_array
@@ -4,26 +4,30 @@ import glob
 import numpy as np
 import imageio
 
-def readh5(filename, dataset=''):
+def readh5(filename, dataset='', bbox=None):
     '''
     Read in the data volume in h5.
     :param filename: (string)
     :param dataset: (str) name of the volume.
+    :param bbox: (tuple) (zmin, minr, minc, zmax, maxr, maxc) sub-block that is read. Only the chunks it touches are decoded.
     '''
-    hfile = h5py.File(filename, 'r')
-    if dataset=='':
-        dataset = list(hfile)[0]
-    return np.array(hfile[dataset])
+    with h5py.File(filename, 'r') as hfile:
+        if dataset=='':
+            dataset = list(hfile)[0]
+        if bbox is None:
+            return np.array(hfile[dataset])
+        return hfile[dataset][bbox[0]:bbox[3], bbox[1]:bbox[4], bbox[2]:bbox[5]]
 
-def readvol(filename, dataset=''):
+def readvol(filename, dataset='', bbox=None):
     '''
     Read in the data in different formats.
     :param filename: (string)
-    :param dataset: (str) name of the volume.
+    :param dataset: (str) name of the volume. For a volume store: 'em', 'label' or 'gt'.
+    :param bbox: (tuple) (zmin, minr, minc, zmax, maxr, maxc) sub-block. Only supported for h5.
     '''
     image = filename[filename.rfind('.')+1:]
     if image == 'h5':
-        data = readh5(filename, dataset)
+        data = readh5(filename, dataset, bbox=bbox)
     elif 'tif' in image:
         data = imageio.volread(filename).squeeze()
     elif 'png' in image:
@@ -50,7 +54,7 @@ def readimgs(filename):
 
     return data
 
-def folder2Vol(filepath=None, chunk_size=None, fns=None, file_format='png', dt=np.uint16):
+def folder2Vol(filepath=None, chunk_size=None, fns=None, file_format='png', dt=np.uint16, store=None, dataset=None):
     '''
     Convert single image files (2D) to 3D h5 volume.
     :param filepath: (string) filepath
@@ -58,22 +62,34 @@ def folder2Vol(filepath=None, chunk_size=None, fns=None, file_format='png', dt=n
     :param fns: (string) defines the filenames.
     :param file_format: (string) defines the input dataformat.
     :param dt: (dataformat) default: np.uint16
+    :param store: (VolumeStore) if given together with dataset, the slices are read from the store instead of the images.
+    :param dataset: (string) 'em', 'label' or 'gt'.
 
     :returns: numpy array that contains the raw data (em & labels).
               shape: (500, 4096, 4096)
               Chunks that part the images will look like this (4, 100, 2048, 2048).
     '''
-    if fns is None:
-        fns = sorted(glob.glob(filepath + '*.' + file_format))
-    if len(fns) == 0:
-        raise ValueError("Please enter valid filepath.")
+    if store is not None and dataset is not None and dataset in store:
+        if chunk_size is None:
+            return store.read(dataset).astype(dt)
+        shape = store.shape(dataset)
+        fns = list(range(min(chunk_size[0], shape[0])))
+        # one sub-block read decodes every chunk once, slice by slice reads would decode it per slice.
+        block = store.read(dataset, (0, 0, 0, len(fns), shape[1], shape[2]))
+        read = lambda zi: block[zi]
+    else:
+        if fns is None:
+            fns = sorted(glob.glob(filepath + '*.' + file_format))
+        if len(fns) == 0:
+            raise ValueError("Please enter valid filepath.")
+        read = lambda zi: imageio.imread(fns[zi]) if os.path.exists(fns[zi]) else None
 
-    sz = np.array(imageio.imread(fns[0]).shape)[:2]
+    sz = np.array(read(0).shape)[:2]
     if chunk_size is None:
         vol = np.zeros((len(fns), sz[0], sz[1]), dtype=dt)
         for zi in range(len(fns)):
-            if os.path.exists(fns[zi]):
-                tmp = imageio.imread(fns[zi])
+            tmp = read(zi)
+            if tmp is not None:
                 if tmp.ndim >= 3:
                     tmp = np.squeeze(tmp)
                 vol[zi] = tmp
@@ -88,9 +104,9 @@ def folder2Vol(filepath=None, chunk_size=None, fns=None, file_format='png', dt=n
         else:
             vol = np.zeros((chunk_size[0], chunk_size[1], chunk_size[2]), dtype=dt)
 
-        for zi in range(chunk_size[0]):
-            if os.path.exists(fns[zi]):
-                tmp = imageio.imread(fns[zi])
+        for zi in range(min(chunk_size[0], len(fns))):
+            tmp = read(zi)
+            if tmp is not None:
                 if tmp.ndim >= 3:
                     tmp = np.squeeze(tmp)
 
@@ -133,11 +149,12 @@ def savelabvol(vol, filename, labels=None, dataset='main', format='h5'):
             ld[:] = labels
     h5.close()
 
-def save_m_to_image(img, filename, fp, idx=None, ff='png'):
+def save_m_to_image(img, filename, fp, idx=None, ff='png', dtype=np.uint8):
     '''
     Save the data volume.
     :param filename: (string)
     :param img: 2d (np.array) that contains the information you want to save.
+    :param dtype: pixel type of the image. Use np.uint16 for more than 255 labels.
     '''
     if idx is not None:
         if len(str(abs(idx))) == 1:
@@ -148,4 +165,4 @@ def save_m_to_image(img, filename, fp, idx=None, ff='png'):
             fn = filename + '_' + str(idx) + '.' + ff
     else:
         fn = filename + '.' + ff
-    imageio.imwrite(os.path.join(fp, fn), img.astype(np.uint8))
+    imageio.imwrite(os.path.join(fp, fn), img.astype(dtype))
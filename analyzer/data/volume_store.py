@@ -0,0 +1,164 @@
+import os, sys
+import glob
+
+import h5py
+import imageio
+import numpy as np
+from tqdm import tqdm
+
+# Stacks that are converted into the store. Each is saved as one 3d dataset of the same name.
+STORE_VOLUMES = ['em', 'label', 'gt']
+
+
+def get_volume_store_path(cfg):
+    '''returns the h5 file of the volume store that belongs to the dataset of cfg.'''
+    return os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.VOLUME_STORE)
+
+
+def volume_store_exists(path):
+    '''checks if a complete volume store is stored in path.'''
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get('complete', False)
+
+
+def get_codec(codec):
+    '''
+    Translates the codec name into the h5py dataset arguments. 'lz4' and 'blosc' need the
+    optional package hdf5plugin, without it the store falls back to 'lzf'.
+    :param codec: (string) 'lz4', 'blosc', 'lzf', 'gzip' or 'none'.
+    :returns: (dict) keyword arguments for create_dataset.
+    '''
+    codec = str(codec).lower()
+    if codec in ['lz4', 'blosc']:
+        try:
+            import hdf5plugin
+        except ImportError:
+            print('hdf5plugin is not installed. Codec \'{}\' is replaced by \'lzf\'.'.format(codec))
+            return {'compression': 'lzf'}
+        if codec == 'lz4':
+            return dict(hdf5plugin.LZ4())
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if codec in ['lzf', 'gzip']:
+        return {'compression': codec}
+    if codec == 'none':
+        return {}
+    raise ValueError('Codec {} is not supported. Choose \'lz4\', \'blosc\', \'lzf\', \'gzip\' or \'none\'.'.format(codec))
+
+
+def build_volume_store(cfg):
+    '''
+    Converts the em, label and gt image folders of the dataset into one chunked and compressed
+    h5 volume. Every image is decoded exactly once; the slices are written in slabs that match
+    the chunk depth so that every chunk is compressed only once.
+    :param cfg: configuration manager.
+    :returns: (VolumeStore) opened store.
+    '''
+    path = get_volume_store_path(cfg)
+    paths = {'em': cfg.DATASET.EM_PATH, 'label': cfg.DATASET.LABEL_PATH, 'gt': cfg.DATASET.GT_PATH}
+    codec = get_codec(cfg.DATASET.STORE_CODEC)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with h5py.File(path, 'w') as f:
+        for vol in STORE_VOLUMES:
+            fns = sorted(glob.glob(paths[vol] + '*.' + cfg.DATASET.FILE_FORMAT))
+            if len(fns) == 0:
+                print('No {} images found in {}. Skipped.'.format(vol, paths[vol]))
+                continue
+
+            first = np.squeeze(imageio.imread(fns[0]))
+            shape = (len(fns), *first.shape)
+            chunks = tuple(min(c, s) for c, s in zip(cfg.DATASET.STORE_CHUNKS, shape))
+            ds = f.create_dataset(vol, shape, dtype=first.dtype, chunks=chunks, **codec)
+            ds.attrs['fns'] = [os.path.basename(fn) for fn in fns]
+
+            print('Converting {} {} images to a volume of shape {} with chunks {}.'.format(len(fns), vol, shape, chunks))
+            for start in tqdm(range(0, len(fns), chunks[0])):
+                end = min(start + chunks[0], len(fns))
+                slab = np.zeros((end - start, *first.shape), dtype=first.dtype)
+                for z in range(start, end):
+                    slab[z - start] = np.squeeze(imageio.imread(fns[z]))
+                ds[start:end] = slab
+        # the flag is set last and marks the store as complete.
+        f.attrs['complete'] = True
+
+    print('volume store written to {}.'.format(path))
+    return VolumeStore(path)
+
+
+class VolumeStore():
+    '''
+    Read access to the chunked volume store. Arbitrary 3d sub-blocks are read without decoding
+    more than the chunks they touch. The h5 file is opened on first use, so the store can be
+    handed to worker processes and every worker opens its own handle.
+
+    :param path: (string) h5 file of the store.
+    '''
+    def __init__(self, path):
+        if not volume_store_exists(path):
+            raise ValueError('No volume store found in {}.'.format(path))
+        self.path = path
+        self._file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def _open(self):
+        if self._file is None:
+            self._file = h5py.File(self.path, 'r')
+        return self._file
+
+    def __contains__(self, vol):
+        return vol in self._open()
+
+    def shape(self, vol):
+        '''shape (z, y, x) of one volume.'''
+        return self._open()[vol].shape
+
+    def read(self, vol, bbox=None):
+        '''
+        Reads a 3d sub-block of one volume.
+        :param vol: (string) 'em', 'label' or 'gt'.
+        :param bbox: (tuple) (zmin, minr, minc, zmax, maxr, maxc) with exclusive max values. None reads the whole volume.
+        :returns: (np.array) 3d block.
+        '''
+        ds = self._open()[vol]
+        if bbox is None:
+            return ds[:]
+        return ds[bbox[0]:bbox[3], bbox[1]:bbox[4], bbox[2]:bbox[5]]
+
+    def slab_depth(self, vol):
+        '''number of slices of one chunk of a volume. Slabs of this depth decode every chunk once.'''
+        chunks = self._open()[vol].chunks
+        return chunks[0] if chunks is not None else 1
+
+    def read_slice(self, vol, z, bbox=None):
+        '''
+        Reads one slice of one volume, optionally cropped to a 2d bounding box. Every chunk the slice
+        touches is decoded, so consecutive slices are read much faster with 'iter_slices'.
+        :param bbox: (tuple) (minr, minc, maxr, maxc) with exclusive max values.
+        '''
+        ds = self._open()[vol]
+        if bbox is None:
+            return ds[z]
+        return ds[z, bbox[0]:bbox[2], bbox[1]:bbox[3]]
+
+    def iter_slices(self, vol, start=0, end=None):
+        '''
+        Yields the slices start..end-1 of one volume in order. They are read in slabs that are aligned
+        to the chunks, so every chunk is decoded once and only one slab is in memory.
+        :returns: generator of (np.array) 2d slices.
+        '''
+        shape = self.shape(vol)
+        end = shape[0] if end is None else min(end, shape[0])
+        depth = self.slab_depth(vol)
+        z = start
+        while z < end:
+            stop = min((z // depth + 1) * depth, end)
+            slab = self.read(vol, (z, 0, 0, stop, shape[1], shape[2]))
+            for s in slab:
+                yield s
+            z = stop
@@ -1,18 +1,64 @@
 import os, sys
+import json
+import time
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import h5py
 import imageio
 #import hdbscan
 from scipy.spatial import distance
-from sklearn.cluster import KMeans, AffinityPropagation, SpectralClustering, DBSCAN, AgglomerativeClustering
+from scipy.sparse import save_npz, load_npz
+from sklearn.cluster import KMeans, MiniBatchKMeans, AffinityPropagation, SpectralClustering, DBSCAN, AgglomerativeClustering
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
+from sklearn.metrics import normalized_mutual_info_score, adjusted_rand_score
 
 from analyzer.model.utils.helper import *
+from analyzer.model.utils.matrix_cache import feature_key, matrix_key, cache_path, tmp_path
+from analyzer.model.utils.feature_stream import FeatureStream, stream_fit_predict
+from analyzer.model.utils.dist_engine import SingleLinkage, build_distance_store, combine_distance_stores, open_distance_store, knn_from_store, knn_graph, knn_affinity
+from analyzer.data.feature_store import FeatureStore
+from analyzer.data.region_index import INDEX_PROPS, get_region_index_path, region_index_exists
 from analyzer.data.data_vis import visvol, vissegments
 from analyzer.utils.eval_model import Evaluationmodel
 
 from .feat_extr_model import FeatureExtractor
 
+# Algorithms that cluster the precomputed (N x N) distance store. All others cluster the feature matrix.
+PRECOMPUTED_ALGS = ['aggloCl', 'specCl']
+# Algorithms that cluster a sparse kNN graph of the feature matrix if CLUSTER.KNN_MODE is set.
+GRAPH_ALGS = ['aggloCl', 'specCl', 'dbscan']
+
+def get_model(cfg, mn='kmeans', n_cluster=5):
+    '''
+    Builds the clustering object of one algorithm.
+    :param cfg: configuration manager.
+    :param mn: (string) that is the name of the algoritm to go with.
+    :param n_cluster: (int) number of clusters.
+    '''
+    if mn == 'kmeans':
+        model = KMeans(n_clusters=n_cluster)
+    elif mn == 'minibatch_kmeans':
+        model = MiniBatchKMeans(n_clusters=n_cluster, batch_size=cfg.CLUSTER.BATCH_SIZE, random_state=0)
+    elif mn == 'affprop':
+        model = AffinityPropagation()
+    elif mn == 'specCl':
+        model = SpectralClustering(n_clusters=n_cluster, affinity='precomputed')
+    elif mn == 'dbscan':
+        if cfg.CLUSTER.KNN_MODE:
+            model = DBSCAN(eps=0.05, metric='precomputed', n_jobs=-1)
+        else:
+            model = DBSCAN(eps=0.05, n_jobs=-1)
+    elif mn == 'hdbscan':
+        model = hdbscan.HDBSCAN(min_cluster_size=n_cluster, min_samples=500, gen_min_span_tree=True)
+    elif mn == 'aggloCl':
+        model = SingleLinkage(n_clusters=n_cluster)
+    else:
+        raise ValueError('Please enter a valid clustering algorithm. -- \'kmeans\', \'minibatch_kmeans\', \'affprop\', \'specCl\', \'dbscan\', \'hdbscan\', \'aggloCl\'')
+
+    return model
+
+
 class Clustermodel():
     '''
     Setups up the model for running a clustering algoritm on the loaded data.
@@ -21,6 +67,7 @@ class Clustermodel():
     :param dl: (class object) This is the dataloader class object.
     :param alg: sets the clustering algorithm that should be used. (default: KMeans)
                 - 'kmeans': KMeans
+                - 'minibatch_kmeans': MiniBatchKMeans, streamed from the feature files.
                 - 'affprop': AffinityPropagation
                 - 'specCl': SpectralClustering
                 - 'aggloCl': AgglomerativeClustering
@@ -43,6 +90,7 @@ class Clustermodel():
 
         self.model = self.set_model(mn=self.alg)
         self.fe = FeatureExtractor(self.cfg)
+        self.store = FeatureStore(self.cfg.DATASET.ROOTF, dtype=self.cfg.CLUSTER.FEATURE_DTYPE)
         self.eval = Evaluationmodel(self.cfg, self.dl)
 
         print(' --- model is set. algorithm: {}, clustering by the features: {} --- '.format(self.alg, str(self.feat_list).strip('[]')))
@@ -52,35 +100,26 @@ class Clustermodel():
         This function enables the usage of different algoritms when setting the model overall.
         :param mn: (string) that is the name of the algoritm to go with.
         '''
-        if mn == 'kmeans':
-            model = KMeans(n_clusters=self.n_cluster)
-        elif mn == 'affprop':
-            model = AffinityPropagation()
-        elif mn == 'specCl':
-            model = SpectralClustering(n_clusters=self.n_cluster)
-        elif mn == 'dbscan':
-            model = DBSCAN(eps=0.05, n_jobs=-1)
-        elif mn == 'hdbscan':
-            model = hdbscan.HDBSCAN(min_cluster_size=self.n_cluster, min_samples=500, gen_min_span_tree=True)
-        elif mn == 'aggloCl':
-            model = AgglomerativeClustering(n_clusters=self.n_cluster, affinity='precomputed', linkage='single')
-        else:
-            raise ValueError('Please enter a valid clustering algorithm. -- \'kmeans\', \'affprop\', \'specCl\', \'dbscan\', \'hdbscan\', \'aggloCl\'')
-
-        return model
+        return get_model(self.cfg, mn, self.n_cluster)
 
     def get_features(self):
         '''
         This function will load different features vectors that were extracted and saved to be used for clustering.
         :param feat_list: (list) of (string)s that states which features should be computed and/or load to cache for
                             further processing.
+        Stored features are read lazily through the feature store: only the rows of the clustered objects
+        are loaded, aligned to one common id order and float features are down-cast to CLUSTER.FEATURE_DTYPE.
         :returns labels: (np.array) that contains the labels.
         :returns rs_feat_list: (list) of (np.array)s that contain the related features.
         '''
-        rs_feat_list = list()
-        labels = np.array([])
+        # every missing geometric feature (and the evaluation, if needed) is served by one scan.
+        missing = [fns for fns in self.feat_list if not self.feature_cached(fns)]
+        eval_props = None
+        if self.cfg.CLUSTER.GENERATE_MASKS and not region_index_exists(get_region_index_path(self.cfg)):
+            eval_props = INDEX_PROPS
+        self.fe.prepare_scan(missing, extra_props=eval_props)
         for idx, fns in enumerate(self.feat_list):
-            if os.path.exists(self.cfg.DATASET.ROOTF + fns + '.h5') is False:
+            if fns in missing:
                 print('This file {} does not exist, will be computed.'.format(self.cfg.DATASET.ROOTF + fns + '.h5'))
 
                 if fns == 'sizef':
@@ -111,79 +150,310 @@ class Clustermodel():
                     print('No function for computing {} features.'.format(fns))
                     raise ValueError('Please check {} if it is correct.'.format(fns))
 
-                label, values = self.fe.save_single_feat_h5(feat, filen=fns)
-                if labels.size == 0:
-                    labels = np.array(label, dtype=np.uint16)
-                rs_feat_list.append(np.array(values))
-            else:
-                fn = self.cfg.DATASET.ROOTF + fns + '.h5'
-                with h5py.File(fn, "r") as h5f:
-                    if labels.size == 0:
-                        labels = np.array(h5f['id'], dtype=np.uint16)
-
-                    rs_feat_list.append(np.array(h5f[fns[:-1]]))
-                    print('Loaded {} features to cache.'.format(fns[:-1]))
-                    test = np.array(h5f[fns[:-1]])
-                    print('\nfeature vector {} has shape {}'.format(fn, test.shape))
-
-            if idx == 0:
-                base_labels = labels
-            else:
-                if check_feature_order(base_labels, labels) is False:
-                    print('ORDER IS WRONG. Correct the order of {} features.'.format(fns))
-                    ordered_feat = correct_idx_feat(base_labels, labels, rs_feat_list[idx])
-                    rs_feat_list[idx] = ordered_feat
+                self.store.close(fns)
+                self.fe.save_single_feat_h5(feat, filen=fns)
+
+        labels = self.feature_labels()
+        rs_feat_list = list()
+        for fns in self.feat_list:
+            rs_feat_list.append(self.store.read(fns, ids=labels, fill=self.cfg.CLUSTER.ID_FILL))
+            print('Loaded {} features of shape {} from {}.'.format(fns[:-1], rs_feat_list[-1].shape, self.store.path(fns)))
 
         return labels, rs_feat_list
 
-    def prep_cluster_matrix(self, labels, feat_list, load=False, save=False):
+    def feature_labels(self):
+        '''
+        ids of the objects that are clustered, in row order: the ids of the feature files joined by
+        CLUSTER.ID_JOIN, without the objects left out by 'selected_ids'.
+        '''
+        # all features are aligned to one common id order by a sort/searchsorted join.
+        labels = join_labels([self.store.ids(fns) for fns in self.feat_list], how=self.cfg.CLUSTER.ID_JOIN)
+        selected = self.selected_ids()
+        if selected is not None:
+            labels = labels[np.isin(labels, selected)]
+        return labels
+
+    def selected_ids(self):
+        '''
+        ids of the objects that are clustered or None for all objects. With DATASET.EXCLUDE_BORDER_OBJECTS the
+        objects that touch the border of the volume are left out.
+        '''
+        if not self.cfg.DATASET.EXCLUDE_BORDER_OBJECTS or self.dl is None:
+            return None
+        index = self.dl.get_region_index()
+        return index.ids[~index.border]
+
+    def feature_cached(self, fns):
+        '''
+        Checks if the feature fns is stored in ROOTF. distf files of older runs hold the (N x N) distance
+        graph instead of the centroids and are computed again.
+        '''
+        fn = self.cfg.DATASET.ROOTF + fns + '.h5'
+        if not os.path.exists(fn):
+            return False
+        if fns == 'distf':
+            with h5py.File(fn, 'r') as h5f:
+                shape = h5f[fns[:-1]].shape
+            if len(shape) == 2 and shape[0] == shape[1] and shape[1] != 3:
+                print('{} holds a distance graph of an older version. It will be replaced by the centroids.'.format(fn))
+                return False
+        return True
+
+    def prep_feature_matrix(self, labels, feat_list):
+        '''
+        Function builds the (N x D) feature matrix for clustering in feature space. Every feature is
+        scaled to [0, 1] and weighted by CLUSTER.WEIGHTSF (self.weightsf), then all features are concatenated.
+        Memory grows linearly with the number of objects.
+        :param labels: (np.array) of the object ids.
+        :param feat_list: (list) of (np.array)s that are the feature vectors/matrices.
+        :returns feat_m: (np.array) of shape (N x D).
+        '''
+        print('computing the feature matrix.')
+        scaler = MinMaxScaler()
+        feat_m = []
+        for idx, feat in enumerate(feat_list):
+            if feat.ndim <= 1:
+                tmp = scaler.fit_transform(feat.reshape(-1, 1))
+            else:
+                tmp = min_max_scale(feat)
+            feat_m.append(self.weightsf[idx] * np.nan_to_num(tmp).astype(np.float32))
+
+        feat_m = np.concatenate(feat_m, axis=1)
+        print('feature matrix of shape {} computed.'.format(feat_m.shape))
+        return feat_m
+
+    def prep_cluster_matrix(self, labels, feat_list, cache=None, keep=True):
         '''
         Function computes clustering matrix from different features for the actual clustering.
-        :param labels:
+        The weighted (N x N) distance matrix is computed in row blocks and stored as .npy file,
+        which is opened as memory map. So the matrix never has to fit into memory.
+        With CLUSTER.CACHE every feature gets its own distance store, named by a hash of its content and
+        the scaler. The weighted sum is stored under a hash of the feature keys in order and the weights.
+        A run with the same inputs reuses the sum, a run with other weights only sums up the parts again.
+        :param labels: (np.array) of the object ids.
         :param feat_list: (list) of (np.array)s that are the feature vectors/matrices.
-        :param weights: (np.array) of weighting factor for different features.
-        :returns clst_m: (np.array) of NxN clustering distance from each feature to another. N is a sample.
-        '''
-        #Preload if possible.
-        if load and os.path.exists(os.path.join(self.cfg.DATASET.ROOTF, 'clstm.h5')) \
-                and os.stat(os.path.join(self.cfg.DATASET.ROOTF, 'clstm.h5')).st_size != 0:
-            print('preload the clustering matrix.')
-            with h5py.File(os.path.join(self.cfg.DATASET.ROOTF, 'clstm.h5'), "r") as h5f:
-                clst_m = np.array(h5f['clstm'])
-                h5f.close()
-        else:
+        :param cache: (bool) use the cache. Defaults to CLUSTER.CACHE.
+        :param keep: (bool) keep the weighted sum in the cache. Otherwise it is written to
+                     cache/clstm_sweep.npy, which is overwritten by the next call.
+        :returns clst_m: (np.memmap) of NxN clustering distance from each feature to another. N is a sample.
+        '''
+        cache = self.cfg.CLUSTER.CACHE if cache is None else cache
+        if not cache:
             print('computing the clustering matrix.')
-            scaler = MinMaxScaler()
-            clst_m = np.zeros(shape=feat_list[0].shape[0], dtype=np.float16)
-            for idx, feat in enumerate(feat_list):
-                if feat.ndim <= 1:
-                    tmp = scaler.fit_transform(feat.reshape(-1,1))
-                    clst_m = np.add(clst_m, self.cfg.CLUSTER.WEIGHTSF[idx] * distance.cdist(tmp, tmp, 'euclidean'))
-                else:
-                    if feat.shape[0] == feat.shape[1]:
-                        clst_m = np.add(clst_m, self.cfg.CLUSTER.WEIGHTSF[idx] * min_max_scale(feat))
-                    else:
-                        tmp = min_max_scale(feat)
-                        clst_m = np.add(clst_m, self.cfg.CLUSTER.WEIGHTSF[idx] * distance.cdist(tmp, tmp, 'euclidean'))
-
-            clst_m = np.vstack(clst_m)
-            if save == True:
-                self.fe.save_feats_h5(labels, clst_m, filen='clstm')
+            return build_distance_store(os.path.join(self.cfg.DATASET.ROOTF, 'clstm.npy'), feat_list, self.weightsf,
+                                        block_rows=self.cfg.CLUSTER.BLOCK_ROWS, cpus=self.cfg.SYSTEM.NUM_CPUS)
+
+        feature_keys = self.feature_keys(labels, feat_list)
+        if keep:
+            path = cache_path(self.get_cache_dir(), 'clstm', matrix_key(feature_keys, self.weightsf, 'dist'))
+            if os.path.exists(path):
+                print('preload the clustering matrix {}.'.format(path))
+                return open_distance_store(path)
+        else:
+            path = os.path.join(self.get_cache_dir(), 'clstm_sweep.npy')
+
+        parts = []
+        for fns, feat, key in zip(self.feat_list, feat_list, feature_keys):
+            part_path = cache_path(self.get_cache_dir(), 'dist_' + fns, key)
+            if not os.path.exists(part_path):
+                print('computing the distance matrix of {}.'.format(fns))
+                build_distance_store(tmp_path(part_path), [feat], [1],
+                                     block_rows=self.cfg.CLUSTER.BLOCK_ROWS, cpus=self.cfg.SYSTEM.NUM_CPUS)
+                os.replace(tmp_path(part_path), part_path)
+            parts.append(open_distance_store(part_path))
+
+        combine_distance_stores(tmp_path(path), parts, self.weightsf, block_rows=self.cfg.CLUSTER.BLOCK_ROWS)
+        os.replace(tmp_path(path), path)
+        return open_distance_store(path)
+
+    def prep_knn_graph(self, labels, feat_list, cache=None):
+        '''
+        Sparse kNN graph of the feature matrix. With CLUSTER.CACHE it is stored as .npz file that is
+        keyed like the clustering matrix and additionally by CLUSTER.KNN and CLUSTER.KNN_MODE.
+        :returns graph: (csr_matrix) (N x N) kNN distance graph.
+        '''
+        cache = self.cfg.CLUSTER.CACHE if cache is None else cache
+        if cache:
+            key = matrix_key(self.feature_keys(labels, feat_list), self.weightsf, 'knn',
+                             k=self.cfg.CLUSTER.KNN, mode=self.cfg.CLUSTER.KNN_MODE)
+            path = cache_path(self.get_cache_dir(), 'knn', key, ext='.npz')
+            if os.path.exists(path):
+                print('preload the kNN graph {}.'.format(path))
+                return load_npz(path).tocsr()
+
+        graph = knn_graph(self.prep_feature_matrix(labels, feat_list), self.cfg.CLUSTER.KNN,
+                          mode=self.cfg.CLUSTER.KNN_MODE, block_rows=self.cfg.CLUSTER.BLOCK_ROWS)
+        if cache:
+            save_npz(tmp_path(path), graph)
+            os.replace(tmp_path(path), path)
+        return graph
+
+    def feature_keys(self, labels, feat_list):
+        '''content hash of every feature, see 'feature_key'.'''
+        return [feature_key(fns, labels, feat) for fns, feat in zip(self.feat_list, feat_list)]
+
+    def get_cache_dir(self):
+        return os.path.join(self.cfg.DATASET.ROOTF, 'cache')
+
+    def prep_input(self, labels, feat, keep=True):
+        '''
+        Input of the clustering algorithm: the kNN graph, the distance store or the feature matrix.
+        :param keep: (bool) see 'prep_cluster_matrix'.
+        '''
+        if self.alg in GRAPH_ALGS and self.cfg.CLUSTER.KNN_MODE:
+            clst_m = self.prep_knn_graph(labels, feat)
+            if self.alg == 'specCl':
+                clst_m = knn_affinity(clst_m)
+        elif self.alg in PRECOMPUTED_ALGS:
+            clst_m = self.prep_cluster_matrix(labels, feat, keep=keep)
+            if self.alg == 'specCl':
+                clst_m = knn_affinity(knn_from_store(clst_m, self.cfg.CLUSTER.KNN, block_rows=self.cfg.CLUSTER.BLOCK_ROWS))
+        else:
+            clst_m = self.prep_feature_matrix(labels, feat)
         return clst_m
 
+    def run_in_memory(self):
+        '''
+        Loads all features and clusters the feature matrix, the distance store or the kNN graph.
+        :returns labels: (np.array) of the object ids.
+        :returns res_labels: (np.array) cluster of every object.
+        '''
+        labels, feat = self.get_features()
+        res_labels = self.model.fit_predict(self.prep_input(labels, feat))
+        return labels, res_labels
+
+    def run_streaming(self):
+        '''
+        Clusters with 'partial_fit' on batches of CLUSTER.BATCH_SIZE rows that are read from the feature
+        files, so the feature matrix is never in memory. Missing features are computed and saved first.
+        The objects are the same as in 'get_features' (see 'feature_labels').
+        :returns labels: (np.array) of the object ids.
+        :returns res_labels: (np.array) cluster of every object.
+        '''
+        if not all(self.feature_cached(fns) for fns in self.feat_list):
+            self.get_features()
+        stream = FeatureStream(self.feat_list, self.store, self.weightsf, self.feature_labels(),
+                               batch_size=self.cfg.CLUSTER.BATCH_SIZE, fill=self.cfg.CLUSTER.ID_FILL)
+        res_labels = stream_fit_predict(self.model, stream, epochs=self.cfg.CLUSTER.STREAM_EPOCHS)
+        return stream.labels, res_labels
+
+    def sweep(self):
+        '''
+        Clusters once for every combination of the weight vectors in CLUSTER.SWEEP_WEIGHTSF and the numbers
+        of clusters in CLUSTER.SWEEP_N_CLUSTER (an empty list uses WEIGHTSF or N_CLUSTER). The features are
+        loaded once and the per-feature distances are reused, so every weight vector only costs the weighted
+        sum. Every result is compared to the ground truth by the normalized mutual information.
+        :returns results: (list) of (dict)s with the weights, n_cluster and nmi of every run.
+        '''
+        weights_grid = [list(w) for w in self.cfg.CLUSTER.SWEEP_WEIGHTSF] or [list(self.cfg.CLUSTER.WEIGHTSF)]
+        n_grid = list(self.cfg.CLUSTER.SWEEP_N_CLUSTER) or [self.cfg.CLUSTER.N_CLUSTER]
+        for weights in weights_grid:
+            if len(weights) != len(self.feat_list):
+                raise ValueError('Weights {} do not match the features {}.'.format(weights, self.feat_list))
+
+        labels, feat = self.get_features()
+        gt_vector = self.eval.get_gt_vector(labels=labels)
+
+        results = []
+        for weights in weights_grid:
+            self.weightsf = weights
+            clst_m = self.prep_input(labels, feat, keep=False)
+            for n_cluster in n_grid:
+                self.n_cluster = n_cluster
+                self.model = self.set_model(mn=self.alg)
+                res_labels = self.model.fit_predict(clst_m)
+                nmi = normalized_mutual_info_score(gt_vector, res_labels)
+                results.append({'weights': weights, 'n_cluster': n_cluster, 'nmi': float(nmi)})
+                print('weights: {}, n_cluster: {}, nmi: {:.4f}'.format(weights, n_cluster, nmi))
+            del clst_m
+
+        self.weightsf = self.cfg.CLUSTER.WEIGHTSF
+        self.n_cluster = self.cfg.CLUSTER.N_CLUSTER
+
+        print('\n{:>30} {:>10} {:>8}'.format('weights', 'n_cluster', 'nmi'))
+        for res in sorted(results, key=lambda r: -r['nmi']):
+            print('{:>30} {:>10} {:>8.4f}'.format(str(res['weights']), res['n_cluster'], res['nmi']))
+        os.makedirs(self.cfg.CLUSTER.OUTPUTPATH, exist_ok=True)
+        with open(os.path.join(self.cfg.CLUSTER.OUTPUTPATH, 'sweep.json'), 'w') as f:
+            json.dump({'alg': self.alg, 'features': list(self.feat_list), 'results': results}, f, indent=2)
+        print('sweep results saved to {}.'.format(os.path.join(self.cfg.CLUSTER.OUTPUTPATH, 'sweep.json')))
+        return results
+
+    def compare(self):
+        '''
+        Runs every algorithm of CLUSTER.COMPARE_ALGS with every number of clusters of CLUSTER.SWEEP_N_CLUSTER
+        (or N_CLUSTER) concurrently in a process pool. The features are read once; the feature matrix is put
+        into shared memory and the distance store or kNN graph is built once for all algorithms that need it.
+        Every result and its metrics against the ground truth are written to OUTPUTPATH/compare/.
+        :returns results: (list) of (dict)s with alg, n_cluster, n_found, nmi, ari and seconds of every run.
+        '''
+        algs = list(self.cfg.CLUSTER.COMPARE_ALGS)
+        n_grid = list(self.cfg.CLUSTER.SWEEP_N_CLUSTER) or [self.cfg.CLUSTER.N_CLUSTER]
+        if 'minibatch_kmeans' in algs:
+            raise ValueError('\'minibatch_kmeans\' streams the features and cannot be compared. Use \'kmeans\'.')
+        # algorithms that find the number of clusters themselves run only once.
+        tasks = [(alg, n_cluster) for alg in algs for n_cluster in (n_grid[:1] if alg in ['affprop', 'dbscan', 'hdbscan'] else n_grid)]
+
+        labels, feat = self.get_features()
+        gt_vector = self.eval.get_gt_vector(labels=labels)
+        feat_m = self.prep_feature_matrix(labels, feat)
+        graph, store_path = None, None
+        if self.cfg.CLUSTER.KNN_MODE and any(alg in GRAPH_ALGS for alg in algs):
+            graph = self.prep_knn_graph(labels, feat)
+        if any(alg in PRECOMPUTED_ALGS and not (self.cfg.CLUSTER.KNN_MODE and alg in GRAPH_ALGS) for alg in algs):
+            store_path = self.prep_cluster_matrix(labels, feat).filename
+
+        out_dir = os.path.join(self.cfg.CLUSTER.OUTPUTPATH, 'compare')
+        os.makedirs(out_dir, exist_ok=True)
+        cpus = self.cfg.SYSTEM.NUM_CPUS if self.cfg.SYSTEM.NUM_CPUS is not None else multiprocessing.cpu_count()
+        shm = shared_memory.SharedMemory(create=True, size=max(feat_m.nbytes, 1))
+        try:
+            np.ndarray(feat_m.shape, dtype=feat_m.dtype, buffer=shm.buf)[:] = feat_m
+            initargs = (self.cfg, shm.name, feat_m.shape, feat_m.dtype, graph, store_path)
+            del feat_m
+            print('running {} clustering configurations in {} processes.'.format(len(tasks), min(cpus, len(tasks))))
+            results = []
+            with multiprocessing.Pool(processes=min(cpus, len(tasks)), initializer=init_runner, initargs=initargs) as pool:
+                for alg, n_cluster, res_labels, seconds in pool.imap_unordered(run_config, tasks):
+                    np.savez(os.path.join(out_dir, '{}_{}.npz'.format(alg, n_cluster)), id=labels, cluster=res_labels)
+                    results.append({'alg': alg, 'n_cluster': n_cluster, 'n_found': int(np.unique(res_labels[res_labels >= 0]).shape[0]),
+                                    'nmi': float(normalized_mutual_info_score(gt_vector, res_labels)),
+                                    'ari': float(adjusted_rand_score(gt_vector, res_labels)), 'seconds': seconds})
+                    print('{} with n_cluster {} done in {:.2f} s.'.format(alg, n_cluster, seconds))
+        finally:
+            shm.close()
+            shm.unlink()
+
+        results = sorted(results, key=lambda r: (algs.index(r['alg']), r['n_cluster']))
+        columns = ['alg', 'n_cluster', 'n_found', 'nmi', 'ari', 'seconds']
+        with open(os.path.join(out_dir, 'results.csv'), 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for res in results:
+                f.write(','.join(str(res[c]) for c in columns) + '\n')
+
+        print('\n{:>10} {:>10} {:>8} {:>8} {:>8} {:>10}'.format(*columns))
+        for res in results:
+            print('{:>10} {:>10} {:>8} {:>8.4f} {:>8.4f} {:>10.2f}'.format(*[res[c] for c in columns]))
+        print('results saved to {}.'.format(os.path.join(out_dir, 'results.csv')))
+        return results
+
     def run(self):
         '''
         Running the main clustering algoritm on the features (feature list) extracted.
         '''
-        labels, feat = self.get_features()
-        clst_m = self.prep_cluster_matrix(labels, feat)
-        res_labels = self.model.fit_predict(clst_m)
+        if self.alg == 'minibatch_kmeans':
+            labels, res_labels = self.run_streaming()
+        else:
+            labels, res_labels = self.run_in_memory()
         gt_values, gt_counts = self.eval.eval(res_labels)
 
         if self.cfg.CLUSTER.GENERATE_MASKS:
             _, gtfns = self.fe.get_fns()
-            _ = recompute_from_res(labels, res_labels, volfns=gtfns, dprc=self.cfg.MODE.DPRC, fp=self.cfg.CLUSTER.OUTPUTPATH + "masks/", neuroglancer=self.cfg.CLUSTER.NEUROGLANCER, em_path=self.cfg.DATASET.EM_PATH)
-            self.eval.eval_volume(res_labels, gt_values, gt_counts)
+            store = self.dl.get_volume_store() if self.dl is not None else None
+            _ = recompute_from_res(labels, res_labels, volfns=gtfns, dprc=self.cfg.MODE.DPRC, fp=self.cfg.CLUSTER.OUTPUTPATH + "masks/", neuroglancer=self.cfg.CLUSTER.NEUROGLANCER, em_path=self.cfg.DATASET.EM_PATH,
+                                   store=store.path if store is not None else None, output=self.cfg.CLUSTER.MASK_OUTPUT, cpus=self.cfg.SYSTEM.NUM_CPUS,
+                                   chunks=self.cfg.DATASET.STORE_CHUNKS, codec=self.cfg.DATASET.STORE_CODEC)
+            self.eval.eval_volume(res_labels, gt_values, gt_counts, scan=self.fe.scan)
 
         if self.cfg.CLUSTER.VISUALIZATION:
             # For visualization purposes.
@@ -196,3 +466,28 @@ class Clustermodel():
                 visvol(em, labeled, filename=(self.cfg.CLUSTER.OUTPUTPATH + "overlay/{}".format(idx)), save=True)
 
         print('\nfinished clustering.')
+
+
+def init_runner(cfg, shm_name, shape, dtype, graph, store_path):
+    global RUNNER_CFG, RUNNER_SHM, RUNNER_X, RUNNER_GRAPH, RUNNER_STORE
+    RUNNER_CFG, RUNNER_GRAPH = cfg, graph
+    RUNNER_SHM = shared_memory.SharedMemory(name=shm_name)
+    RUNNER_X = np.ndarray(shape, dtype=dtype, buffer=RUNNER_SHM.buf)
+    RUNNER_STORE = open_distance_store(store_path) if store_path is not None else None
+
+
+def run_config(task):
+    '''Helper for 'Clustermodel.compare' that clusters with one algorithm and number of clusters.'''
+    alg, n_cluster = task
+    cfg = RUNNER_CFG
+    t = time.perf_counter()
+    if alg in GRAPH_ALGS and cfg.CLUSTER.KNN_MODE:
+        clst_m = knn_affinity(RUNNER_GRAPH) if alg == 'specCl' else RUNNER_GRAPH
+    elif alg in PRECOMPUTED_ALGS:
+        clst_m = RUNNER_STORE
+        if alg == 'specCl':
+            clst_m = knn_affinity(knn_from_store(clst_m, cfg.CLUSTER.KNN, block_rows=cfg.CLUSTER.BLOCK_ROWS))
+    else:
+        clst_m = RUNNER_X
+    res_labels = get_model(cfg, alg, n_cluster).fit_predict(clst_m)
+    return alg, n_cluster, np.asarray(res_labels), time.perf_counter() - t
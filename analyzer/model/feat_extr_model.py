@@ -6,6 +6,7 @@ import h5py
 from numpyencoder import NumpyEncoder
 
 from analyzer.model.utils.extracting import *
+from analyzer.model.utils.scanner import props_for_features, scan_label_stack
 from analyzer.model.utils.helper import convert_dict_mtx
 
 class FeatureExtractor():
@@ -33,26 +34,45 @@ class FeatureExtractor():
         else:
             self.emfns = None
             self.gtfns = None
+        self.scan = None
 
     def get_fns(self):
         '''Funtion returns the attribute fns of the feature extractor.'''
         return self.emfns, self.gtfns
 
+    def prepare_scan(self, feat_list, extra_props=None):
+        '''
+        Scan the label stack once for the union of all properties that the geometric features
+        in feat_list need. Every following compute_seg_* call reuses this scan.
+        :param feat_list: (list) of feature names that will be computed.
+        :param extra_props: (list) of additional properties other consumers (e.g. evaluation) need.
+                            These consumers work on the per slice records, so the scan keeps them.
+        '''
+        prop_list = props_for_features(feat_list)
+        records = extra_props is not None
+        if records:
+            prop_list = list(set(prop_list) | set(extra_props))
+        if not prop_list or self.gtfns is None:
+            return self.scan
+        if self.scan is None or not self.scan.covers(prop_list, records=records):
+            self.scan = scan_label_stack(self.gtfns, prop_list, cpus=self.cfg.SYSTEM.NUM_CPUS, records=records)
+        return self.scan
+
     def compute_seg_size(self):
         '''Extract the size of each mitochondria segment.
         :returns result_dict: (dict) where the label is the key and the size of the segment is the corresponding value.
         '''
-        return compute_region_size(self.gtvol, fns=self.gtfns, dprc=self.dprc)
+        return compute_region_size(self.gtvol, fns=self.gtfns, dprc=self.dprc, scan=self.scan)
 
     def compute_seg_slength(self):
         '''Extract the skeleton length of each mitochondria segment.
         :returns result_dict: (dict) where the label is the key and the size of the segment is the corresponding value.
         '''
-        return compute_skeleton(fns=self.gtfns)
+        return compute_skeleton(fns=self.gtfns, scan=self.scan)
 
     def compute_seg_dist(self):
         '''Compute the distances of mitochondria to each other and extract it as a graph matrix.'''
-        return compute_dist_graph(self.gtvol, fns=self.gtfns, dprc=self.dprc)
+        return compute_dist_graph(self.gtvol, fns=self.gtfns, dprc=self.dprc, scan=self.scan)
 
     def compute_vae_shape(self):
         '''
@@ -88,11 +108,11 @@ class FeatureExtractor():
 
     def compute_seg_circ(self):
         '''Computes the circularity features from mitochondria volume.'''
-        return compute_circularity(self.gtvol, fns=self.gtfns, dprc=self.dprc)
+        return compute_circularity(self.gtvol, fns=self.gtfns, dprc=self.dprc, scan=self.scan)
 
     def compute_seg_surface_to_volume(self):
         '''Computes the surface to volume ratio features from mitochondria volume.'''
-        return compute_surface_to_volume(self.gtvol, fns=self.gtfns, dprc=self.dprc)
+        return compute_surface_to_volume(self.gtvol, fns=self.gtfns, dprc=self.dprc, scan=self.scan)
 
     def save_single_feat_h5(self, rsl_dict, filen='feature_vector'):
         '''
@@ -0,0 +1,311 @@
+import os, sys
+import multiprocessing
+
+import numpy as np
+from scipy.spatial import distance
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from scipy.sparse import issparse
+from sklearn.preprocessing import MinMaxScaler
+from tqdm import tqdm
+
+from analyzer.model.utils.helper import min_max_scale
+
+
+def prep_distance_features(feat_list):
+    '''
+    Scales the features the same way the dense clustering matrix does.
+    :param feat_list: (list) of (np.array)s that are the feature vectors/matrices.
+    :returns: (list) of (tuple)s (kind, array). kind is 'vec' for feature vectors and 'dist' for
+              (N x N) matrices that already hold distances.
+    '''
+    prepared = []
+    for feat in feat_list:
+        if feat.ndim <= 1:
+            prepared.append(('vec', MinMaxScaler().fit_transform(feat.reshape(-1, 1))))
+        elif feat.shape[0] == feat.shape[1]:
+            prepared.append(('dist', min_max_scale(feat)))
+        else:
+            prepared.append(('vec', min_max_scale(feat)))
+    return prepared
+
+
+def distance_rows(features, weights, start, end):
+    '''
+    Weighted multi-feature distance of the rows start..end-1 to all objects.
+    :param features: (list) result of 'prep_distance_features'.
+    :param weights: (list) of weighting factors, one per feature.
+    :returns: (np.array) of shape (end - start, N) and dtype float32.
+    '''
+    block = None
+    for (kind, feat), w in zip(features, weights):
+        if kind == 'dist':
+            tmp = w * np.asarray(feat[start:end], dtype=np.float64)
+        else:
+            tmp = w * distance.cdist(feat[start:end], feat, 'euclidean')
+        block = tmp if block is None else block + tmp
+    return block.astype(np.float32)
+
+
+def build_distance_store(path, feat_list, weights, block_rows=2048, cpus=None):
+    '''
+    Computes the (N x N) weighted multi-feature distance matrix in row blocks and writes it to
+    an .npy file that is used as memory map afterwards. Only one block per worker is in memory.
+    :param path: (string) .npy file of the store.
+    :param feat_list: (list) of (np.array)s that are the feature vectors/matrices.
+    :param weights: (list) of weighting factors, one per feature.
+    :param block_rows: (int) number of rows that are computed at once.
+    :param cpus: (int) number of worker processes.
+    :returns: (np.memmap) read-only (N x N) distance matrix.
+    '''
+    features = prep_distance_features(feat_list)
+    n = features[0][1].shape[0]
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+
+    store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, n))
+    del store
+    blocks = [(start, min(start + block_rows, n)) for start in range(0, n, block_rows)]
+    print('computing the {} x {} distance matrix in {} blocks.'.format(n, n, len(blocks)))
+    with multiprocessing.Pool(processes=cpus, initializer=init_features, initargs=(features, weights, path)) as pool:
+        for _ in tqdm(pool.imap_unordered(write_distance_block, blocks), total=len(blocks)):
+            pass
+
+    return open_distance_store(path)
+
+
+def combine_distance_stores(path, parts, weights, block_rows=2048):
+    '''
+    Weighted sum of per-feature distance stores, written block-wise to a new store. No distance
+    is computed again, so changing the weights only costs one pass over the parts.
+    :param path: (string) .npy file of the combined store.
+    :param parts: (list) of (np.memmap)s (N x N), one distance store per feature.
+    :param weights: (list) of weighting factors, one per part.
+    :returns: (np.memmap) read-only (N x N) distance matrix.
+    '''
+    n = parts[0].shape[0]
+    store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, n))
+    print('combining {} distance matrices of {} x {}.'.format(len(parts), n, n))
+    for start in tqdm(range(0, n, block_rows)):
+        end = min(start + block_rows, n)
+        block = np.zeros((end - start, n), dtype=np.float64)
+        for part, w in zip(parts, weights):
+            if w != 0:
+                block += w * np.asarray(part[start:end], dtype=np.float64)
+        store[start:end] = block.astype(np.float32)
+    store.flush()
+    del store
+    return open_distance_store(path)
+
+
+def open_distance_store(path):
+    '''opens the distance store read-only as memory map.'''
+    return np.load(path, mmap_mode='r')
+
+
+def init_features(features, weights, path):
+    global FEATURES, WEIGHTS, STORE_PATH
+    FEATURES, WEIGHTS, STORE_PATH = features, weights, path
+
+
+def write_distance_block(block):
+    '''Helper for 'build_distance_store' that writes the rows of one block.'''
+    start, end = block
+    store = np.load(STORE_PATH, mmap_mode='r+')
+    store[start:end] = distance_rows(FEATURES, WEIGHTS, start, end)
+    store.flush()
+    del store
+    return block
+
+
+def knn_from_store(store, k, block_rows=2048):
+    '''
+    Sparse k-nearest-neighbour graph of the objects, read block-wise from the distance store.
+    :param store: (np.array) or (np.memmap) (N x N) distance matrix.
+    :param k: (int) number of neighbours of every object (without itself).
+    :returns: (csr_matrix) (N x N) with the distances to the k nearest neighbours of every row.
+    '''
+    n = store.shape[0]
+    k = min(k, n - 1)
+    rows, cols, vals = [], [], []
+    for start in range(0, n, block_rows):
+        block = np.array(store[start:start + block_rows], dtype=np.float64)
+        idx = np.arange(start, start + block.shape[0])
+        block[np.arange(block.shape[0]), idx] = np.inf
+        nn = np.argpartition(block, k - 1, axis=1)[:, :k]
+        rows.append(np.repeat(idx, k))
+        cols.append(nn.ravel())
+        vals.append(np.take_along_axis(block, nn, axis=1).ravel())
+    return csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+
+
+def knn_graph(X, k, mode='exact', block_rows=2048, n_trees=8, seed=0):
+    '''
+    Sparse k-nearest-neighbour graph of the rows of a feature matrix (euclidean distance).
+    :param X: (np.array) (N x D) feature matrix.
+    :param k: (int) number of neighbours of every object (without itself).
+    :param mode: (string) 'exact': blocked matrix multiply over all pairs.
+                          'approx': random projection forest, only the objects that share a leaf are compared.
+    :param block_rows: (int) rows per block in 'exact' mode.
+    :param n_trees: (int) number of random projection trees in 'approx' mode.
+    :returns: (csr_matrix) (N x N) with the distances to the k nearest neighbours of every row.
+    '''
+    X = np.asarray(X, dtype=np.float32)
+    n = X.shape[0]
+    k = min(k, n - 1)
+    if mode == 'exact':
+        dist, nn = exact_knn(X, k, block_rows)
+    elif mode == 'approx':
+        dist, nn = approx_knn(X, k, n_trees=n_trees, seed=seed)
+    else:
+        raise ValueError('No kNN mode {}. Choose \'exact\' or \'approx\'.'.format(mode))
+
+    # zero distances (identical objects) would vanish from the sparse matrix.
+    dist = np.maximum(dist, np.finfo(np.float32).tiny)
+    found = nn >= 0
+    rows = np.repeat(np.arange(n), k).reshape(n, k)
+    return csr_matrix((dist[found], (rows[found], nn[found])), shape=(n, n))
+
+
+def exact_knn(X, k, block_rows=2048):
+    '''
+    Exact kNN in row blocks. The squared distances of a block to all rows are computed as
+    |a|^2 + |b|^2 - 2ab with one matrix multiply, so only (block_rows x N) values are in memory.
+    :returns dist, nn: (np.array)s (N x k) with the distances and the indices of the neighbours.
+    '''
+    n = X.shape[0]
+    sq = np.einsum('ij,ij->i', X, X)
+    dist = np.zeros((n, k), dtype=np.float32)
+    nn = np.zeros((n, k), dtype=np.int64)
+    for start in range(0, n, block_rows):
+        end = min(start + block_rows, n)
+        block = X[start:end] @ X.T
+        block *= -2
+        block += sq[None, :]
+        block += sq[start:end, None]
+        block[np.arange(end - start), np.arange(start, end)] = np.inf
+        part = np.argpartition(block, k - 1, axis=1)[:, :k]
+        dist[start:end] = np.sqrt(np.maximum(np.take_along_axis(block, part, axis=1), 0))
+        nn[start:end] = part
+    return dist, nn
+
+
+def approx_knn(X, k, n_trees=8, leaf_size=None, seed=0):
+    '''
+    Approximate kNN with a random projection forest. Every tree splits the objects recursively at
+    the median of a random projection until a leaf holds at most leaf_size objects. The candidates
+    of an object are the objects of its leaves, the best k of them are kept.
+    :returns dist, nn: (np.array)s (N x k) with the distances and the indices of the neighbours (-1 if not found).
+    '''
+    n = X.shape[0]
+    leaf_size = leaf_size if leaf_size is not None else max(4 * k, 64)
+    rng = np.random.default_rng(seed)
+    dist = np.full((n, k), np.inf, dtype=np.float32)
+    nn = np.full((n, k), -1, dtype=np.int64)
+
+    for _ in tqdm(range(n_trees)):
+        for leaf in rp_leaves(X, leaf_size, rng):
+            d = distance.cdist(X[leaf], X[leaf], 'sqeuclidean').astype(np.float32)
+            np.fill_diagonal(d, np.inf)
+            cand_d = np.concatenate([dist[leaf] ** 2, d], axis=1)
+            cand_i = np.concatenate([nn[leaf], np.broadcast_to(leaf, (leaf.shape[0], leaf.shape[0]))], axis=1)
+            # an object that is found by several trees is only kept once.
+            order = np.argsort(cand_i, axis=1, kind='stable')
+            cand_i = np.take_along_axis(cand_i, order, axis=1)
+            cand_d = np.take_along_axis(cand_d, order, axis=1)
+            cand_d[:, 1:][cand_i[:, 1:] == cand_i[:, :-1]] = np.inf
+            cand_d[cand_i < 0] = np.inf
+
+            m = min(k, cand_d.shape[1])
+            part = np.argpartition(cand_d, m - 1, axis=1)[:, :m]
+            best_d = np.take_along_axis(cand_d, part, axis=1)
+            best_i = np.take_along_axis(cand_i, part, axis=1)
+            best_i[np.isinf(best_d)] = -1
+            dist[leaf, :m] = np.sqrt(best_d)
+            nn[leaf, :m] = best_i
+    return dist, nn
+
+
+def rp_leaves(X, leaf_size, rng):
+    '''leaves (index arrays) of one random projection tree over the rows of X.'''
+    leaves = []
+    stack = [np.arange(X.shape[0])]
+    while stack:
+        idx = stack.pop()
+        if idx.shape[0] <= leaf_size:
+            leaves.append(idx)
+            continue
+        proj = X[idx] @ rng.standard_normal(X.shape[1]).astype(np.float32)
+        order = np.argsort(proj, kind='stable')
+        half = idx.shape[0] // 2
+        stack.append(idx[order[:half]])
+        stack.append(idx[order[half:]])
+    return leaves
+
+
+def knn_affinity(graph):
+    '''
+    Symmetric heat kernel affinity of a kNN distance graph. The kernel width is the mean
+    neighbour distance.
+    :param graph: (csr_matrix) kNN distance graph.
+    :returns: (csr_matrix) affinity matrix for algorithms that take a precomputed affinity.
+    '''
+    graph = graph.maximum(graph.T).tocsr()
+    sigma = graph.data.mean() if graph.nnz > 0 and graph.data.mean() > 0 else 1.0
+    affinity = graph.copy()
+    affinity.data = np.exp(-(graph.data ** 2) / (2 * sigma ** 2))
+    affinity.setdiag(1.0)
+    return affinity
+
+
+class SingleLinkage():
+    '''
+    Single linkage agglomerative clustering on the distance store or on a sparse kNN graph.
+    The minimum spanning tree is cut at its n_clusters - 1 longest edges. On the store the tree
+    is built with Prim's algorithm, which only needs one row of the store at a time, and the
+    result equals AgglomerativeClustering(linkage='single'). A kNN graph that falls apart into more
+    than n_clusters components keeps these components as clusters.
+    :param n_clusters: (int) number of clusters.
+    '''
+    def __init__(self, n_clusters=5):
+        self.n_clusters = n_clusters
+
+    def fit_predict(self, store):
+        if issparse(store):
+            return self.fit_predict_graph(store)
+
+        n = store.shape[0]
+        in_tree = np.zeros(n, dtype=bool)
+        best = np.full(n, np.inf)
+        parent = np.full(n, -1, dtype=np.int64)
+        u, v, w = [], [], []
+
+        current = 0
+        in_tree[current] = True
+        for _ in tqdm(range(n - 1)):
+            row = np.asarray(store[current], dtype=np.float64)
+            closer = ~in_tree & (row < best)
+            best[closer] = row[closer]
+            parent[closer] = current
+
+            current = int(np.argmin(np.where(in_tree, np.inf, best)))
+            u.append(parent[current])
+            v.append(current)
+            w.append(best[current])
+            in_tree[current] = True
+
+        keep = np.argsort(w, kind='stable')[:max(n - self.n_clusters, 0)]
+        graph = coo_matrix((np.ones(keep.shape[0]), (np.array(u, dtype=np.int64)[keep], np.array(v, dtype=np.int64)[keep])),
+                           shape=(n, n))
+        _, self.labels_ = connected_components(graph, directed=False)
+        return self.labels_
+
+    def fit_predict_graph(self, graph):
+        n = graph.shape[0]
+        graph = graph.maximum(graph.T)
+        mst = minimum_spanning_tree(graph).tocoo()
+
+        keep = np.argsort(mst.data, kind='stable')[:max(n - self.n_clusters, 0)]
+        tree = coo_matrix((np.ones(keep.shape[0]), (mst.row[keep], mst.col[keep])), shape=(n, n))
+        _, self.labels_ = connected_components(tree, directed=False)
+        return self.labels_
@@ -9,11 +9,12 @@ import functools
 import imageio
 import matplotlib.pyplot as plt
 from skimage.measure import label, regionprops
-from scipy.spatial import distance
 from tqdm import tqdm
 
+from analyzer.model.utils.scanner import FEATURE_PROPS, scan_label_stack, calc_props, cc
 
-def compute_region_size(vol=None, dprc='full', fns=None, mode='3d'):
+
+def compute_region_size(vol=None, dprc='full', fns=None, mode='3d', scan=None):
     '''
     Compute the region properties of the groundtruth labels.
 
@@ -21,6 +22,7 @@ def compute_region_size(vol=None, dprc='full', fns=None, mode='3d'):
     :param dprc: (string) data processing mode that sets how your data should be threated down the pipe.
     :param fns: (list) list of filenames that should be used for iterating over.
     :param mode: (string)
+    :param scan: (ScanResult) precomputed scan of the label stack. Only used in 'iter' mode.
 
     :returns result_array: (np.array) which contains (dicts) where the label is the key and the size of the segment is the corresponding value.
     '''
@@ -69,22 +71,13 @@ def compute_region_size(vol=None, dprc='full', fns=None, mode='3d'):
                 })
 
     elif dprc == 'iter':
-        with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-            tmp = pool.starmap(functools.partial(calc_props, prop_list=['size']), enumerate(fns))
-
-        for dicts in tmp:
-            for key, value in dicts.items():
-                if key in result_dict:
-                    result_dict[key][0] += value[0]
-                else:
-                    result_dict.setdefault(key, [])
-                    result_dict[key].append(value[0])
+        scan = get_scan(scan, fns, 'sizef')
 
         result_array = []
-        for result in result_dict.keys():
+        for key, size in zip(scan.acc.labels.tolist(), scan.acc.get('area').astype(np.int64)):
             result_array.append({
-                'id': result,
-                'size': result_dict[result],
+                'id': key,
+                'size': [size],
             })
     else:
         raise ValueError('No proper dprc found. Choose \'full\' or \'iter\'.')
@@ -92,15 +85,16 @@ def compute_region_size(vol=None, dprc='full', fns=None, mode='3d'):
     return (result_array)
 
 
-def compute_dist_graph(vol, dprc='full', fns=None):
+def compute_dist_graph(vol, dprc='full', fns=None, scan=None):
     '''
-    This function computes a graph matrix that represents the distances from each segment to all others.
+    This function computes the centroid of each segment. The euclidean distances between the segments are
+    taken in the feature space of the clustering, so the (N x N) distance graph never has to be stored.
     :param vol: volume (np.array) that contains the groundtruth mask (= labels). (2d || 3d)
     :param dprc: (string) data processing mode that sets how your data should be threated down the pipe.
-    :returns: (np.array) (N x N) matrix gives you the feature vector--> N: number of segments
+    :param scan: (ScanResult) precomputed scan of the label stack. Only used in 'iter' mode.
+    :returns: (np.array) (N x 3) matrix gives you the feature vector--> N: number of segments
     '''
-    print('Starting to compute distances between mitochondria.')
-    result_dict = {}
+    print('Starting to compute the centroids of mitochondria.')
     if dprc == 'full':
         if vol.ndim <= 2:
             raise ValueError('Volume is lacking on dimensionality(at least 3d): {}'.format(vol.shape))
@@ -113,175 +107,87 @@ def compute_dist_graph(vol, dprc='full', fns=None):
             centerpts.append(props.centroid)
 
         centerpts = np.array(centerpts, dtype=np.int16)
-        dist_m = distance.cdist(centerpts, centerpts, 'euclidean')
-
-        for idx in range(len(labels)):
-            result_dict[labels[idx]] = dist_m[idx]
-
-        result_array = []
-        for result in result_dict.keys():
-            result_array.append({
-                'id': result,
-                'dist': result_dict[result],
-            })
 
     elif dprc == 'iter':
-        with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-            tmp = pool.starmap(functools.partial(calc_props, prop_list=['size', 'slices', 'centroid']), enumerate(fns))
-
-        for dicts in tmp:
-            for key, value in dicts.items():
-                if key in result_dict:
-                    result_dict[key][0].append(value[0])
-                    result_dict[key][1].append(value[1])
-                    result_dict[key][2].append(value[2])
-                else:
-                    result_dict.setdefault(key, [])
-                    result_dict[key].append([value[0]])
-                    result_dict[key].append([value[1]])
-                    result_dict[key].append([value[2]])
+        scan = get_scan(scan, fns, 'distf')
 
-        labels = list(result_dict.keys())
-        centerpts = []
-        for key, value in result_dict.items():
-            pt = list(map(int, [sum(x) / len(x) for x in zip(*value[2])]))
-            tmp_z = 0.0
-            for i in range(len(value[0])):
-                tmp_z += (value[0][i] / sum(value[0])) * value[1][i]
-            z = int(tmp_z / len(value[1]))
-            pt.append(z)
-            centerpts.append(pt)
-
-        centerpts = np.array(centerpts, dtype=np.int16)
-        dist_m = distance.cdist(centerpts, centerpts, 'euclidean')
-
-        for idx in range(len(labels)):
-            result_dict[labels[idx]].append([dist_m[idx]])
-
-        result_array = []
-        for result in result_dict.keys():
-            result_array.append({
-                'id': result,
-                'dist': result_dict[result][3],
-            })
+        labels = scan.acc.labels.tolist()
+        centerpts = scan.acc.centroids().astype(np.int16)
     else:
         raise ValueError('No proper dprc found. Choose \'full\' or \'iter\'.')
+
+    result_array = []
+    for idx in range(len(labels)):
+        result_array.append({
+            'id': labels[idx],
+            'dist': [centerpts[idx]],
+        })
     print('Distance feature extraction finished. {} x {} features extracted.'.format(len(result_array),
-                                                                                     len(result_array)))
+                                                                                     centerpts.shape[1]))
     return (result_array)
 
 
-def compute_circularity(vol, dprc='full', fns=None):
+def compute_circularity(vol, dprc='full', fns=None, scan=None):
     '''
     This function aims to calculate the circularity of an object.
+    :param scan: (ScanResult) precomputed scan of the label stack.
     '''
     print('Starting to compute a circularity estimation of mitochondria.')
-    result_dict = {}
     if dprc == 'full':
         fns = fns[:vol.shape[0]]
-
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        tmp = pool.starmap(functools.partial(calc_props, prop_list=['slices', 'circ']), enumerate(fns))
-
-    for dicts in tmp:
-        for key, value in dicts.items():
-            if key in result_dict:
-                result_dict[key][0].append(value[0])
-                result_dict[key][1] += value[1]
-            else:
-                result_dict.setdefault(key, [])
-                result_dict[key].append([value[0]])
-                result_dict[key].append([value[1]])
+    scan = get_scan(scan, fns, 'circf')
 
     result_array = []
-    for result in result_dict.keys():
+    for key, circ, n_slices in zip(scan.acc.labels.tolist(), scan.acc.get('circ'), scan.acc.get('n_slices')):
         result_array.append({
-            'id': result,
-            'circ': (result_dict[result][1][0] / len(result_dict[result][0])),
+            'id': key,
+            'circ': (circ / n_slices),
         })
 
     print('Circularity feature extraction finished. {} features extracted.'.format(len(result_array)))
     return (result_array)
 
 
-def compute_surface_to_volume(vol, dprc='full', fns=None):
+def compute_surface_to_volume(vol, dprc='full', fns=None, scan=None):
     '''
     This function aims to calculate the surface to volume ratio of an object.
+    The surface is the number of exposed voxel faces (in-plane and between slices), the volume
+    the number of voxels. Both are counted in the same sweep over the stack.
+    :param scan: (ScanResult) precomputed scan of the label stack.
     '''
     print('Starting to compute a surface to volume estimation of mitochondria.')
-    result_dict = {}
     if dprc == 'full':
         fns = fns[:vol.shape[0]]
-
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        tmp = pool.starmap(functools.partial(calc_props, prop_list=['slices', 'surface_to_volume']), enumerate(fns))
-
-    for dicts in tmp:
-        for key, value in dicts.items():
-            if key in result_dict:
-                result_dict[key][0].append(value[0])
-                result_dict[key][1] += value[1][0]
-                result_dict[key][2] += value[1][1]
-            else:
-                result_dict.setdefault(key, [])
-                result_dict[key].append([value[0]])
-                result_dict[key].append([value[1][0]])
-                result_dict[key].append([value[1][1]])
+    scan = get_scan(scan, fns, 'surface_to_volumef')
 
     result_array = []
-    for result in result_dict.keys():
+    for key, surface, volume in zip(scan.acc.labels.tolist(), scan.acc.get('surface').astype(np.int64),
+                                    scan.acc.get('area').astype(np.int64)):
         result_array.append({
-            'id': result,
-            'surface_to_volume': (result_dict[result][2][0] / result_dict[result][1][0]),
+            'id': key,
+            'surface': surface,
+            'volume': volume,
+            'surface_to_volume': (surface / volume),
         })
 
     print('Surface to volume feature extraction finished. {} features extracted.'.format(len(result_array)))
     return (result_array)
 
 
-def compute_skeleton(fns=None):
+def compute_skeleton(fns=None, scan=None):
     '''
-    This function aims to calculate the circularity of an object.
+    This function aims to calculate the skeleton length of an object.
     :params fns: (list) of filenames
+    :param scan: (ScanResult) precomputed scan of the label stack.
     '''
     print('Starting to compute a skeleton length estimation of mitochondria.')
-    result_dict = {}
-
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        tmp = pool.starmap(functools.partial(calc_props, prop_list=['slices', 'centroid']), enumerate(fns))
-
-    for dicts in tmp:
-        for key, value in dicts.items():
-            if key in result_dict:
-                result_dict[key][0].append(value[0])
-                result_dict[key][1].append(value[1])
-            else:
-                result_dict.setdefault(key, [])
-                result_dict[key].append([value[0]])
-                result_dict[key].append([value[1]])
-
-    labels = list(result_dict.keys())
-    ext_cpt = list()
-    for key, value in result_dict.items():
-        tmp_list = list()
-        for i in range(len(value[0])):
-            cpt = list(value[1][i])
-            cpt.append(value[0][i])
-            tmp_list.append(cpt)
-
-        dist = 0.0
-        for k in range(len(tmp_list)):
-            if k == 0:
-                continue
-            else:
-                dist += np.linalg.norm(np.array(tmp_list[k]) - np.array(tmp_list[k - 1]))
-        result_dict[key].append(dist)
+    scan = get_scan(scan, fns, 'slenf')
 
     result_array = []
-    for result in result_dict.keys():
+    for key, dist in zip(scan.acc.labels.tolist(), scan.acc.skeleton_length()):
         result_array.append({
-            'id': result,
-            'slen': (result_dict[result][2]),
+            'id': key,
+            'slen': dist,
         })
 
     print('Skeleton length extraction finished. {} features extracted.'.format(len(result_array)))
@@ -319,66 +225,17 @@ def compute_spatial_density(fns, n_block=10):
 
 
 ### HELPER SECTION ###
-def calc_props(idx, fns, prop_list=['size', 'slices', 'centroid', 'circ', 'surface_to_volume']):
+def get_scan(scan, fns, feat):
     '''
-    Helper function for 'compute_regions'
-    :param fns: (string) list of filenames. sorted.
-    :param prop_list: (list) of (strings) that contain the properties that should be stored in result.
-    :returns result: (dict) with each segment. key: idx of segment -- value: [number of pixels in segment, idx of slice].
+    Helper that returns a scan covering the properties of feature 'feat'. The given scan is
+    reused if possible, otherwise the label stack is scanned for this feature alone.
+    :param scan: (ScanResult) or None.
+    :param fns: (list) of label filenames.
+    :param feat: (string) feature name, e.g. 'sizef'.
     '''
-    result = {}
-    if os.path.exists(fns):
-        tmp = imageio.imread(fns)
-        regions = regionprops(tmp, cache=False)
-
-        labels = []
-        num_labels = []
-        c_list = []
-        circ_list = []
-        surface_to_volume_list = []
-        random_pt_list = []
-        for props in regions:
-            labels.append(props.label)
-            if 'size' in prop_list:
-                num_labels.append(props.area)
-            if 'centroid' in prop_list:
-                c_list.append(tuple(map(int, props.centroid)))
-            if 'circ' in prop_list:
-                circ_list.append(cc(props.area, props.perimeter))
-            if 'surface_to_volume' in prop_list:
-                surface_to_volume_list.append((props.area, props.perimeter))
-            if 'random_pt' in prop_list:
-                random_pt_list.append(np.argwhere(tmp == props.label)[0])
-
-        for l in range(len(labels)):
-            if labels[l] == 0:
-                continue
-            result.setdefault(labels[l], [])
-            if 'size' in prop_list:
-                result[labels[l]].append(num_labels[l])
-            if 'slices' in prop_list:
-                result[labels[l]].append(idx)
-            if 'centroid' in prop_list:
-                result[labels[l]].append(c_list[l])
-            if 'circ' in prop_list:
-                result[labels[l]].append(circ_list[l])
-            if 'surface_to_volume' in prop_list:
-                result[labels[l]].append(surface_to_volume_list[l])
-            if 'random_pt' in prop_list:
-                result[labels[l]].append(random_pt_list[l])
-
-    return result
-
-
-def cc(area, perimeter):
-    '''
-    The circularity of a circle is 1, and much less than one for a starfish footprint.
-    '''
-    if math.isnan(perimeter) or (perimeter == 0):
-        circ = np.float64(0.0)
-    else:
-        circ = (4 * np.pi * area) / (perimeter ** 2)
-    return (circ)
+    if scan is not None and scan.covers(FEATURE_PROPS[feat]):
+        return scan
+    return scan_label_stack(fns, FEATURE_PROPS[feat], records=False)
 
 
 #### deprecated ####
@@ -0,0 +1,121 @@
+import os, sys
+
+import numpy as np
+from tqdm import tqdm
+
+from analyzer.data.feature_store import label_join_index
+
+
+class FeatureStream():
+    '''
+    Reads the (N x D) feature matrix batch-wise from the feature files in ROOTF. Every feature
+    is scaled to [0, 1] with its global min and max and weighted, like 'prep_feature_matrix'
+    does, but only one batch of rows is in memory at a time.
+    :param fns: (list) of feature file names without .h5, e.g. ['sizef', 'circf'].
+    :param store: (FeatureStore) of the feature files.
+    :param weights: (list) of weighting factors, one per feature.
+    :param labels: (np.array) ids of the objects in row order (see Clustermodel.feature_labels).
+    :param batch_size: (int) number of rows per batch.
+    :param fill: value of the rows whose id is not in a feature file.
+    '''
+    def __init__(self, fns, store, weights, labels, batch_size=4096, fill=0):
+        self.fns = fns
+        self.store = store
+        self.paths = [store.path(fn) for fn in fns]
+        self.weights = weights
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.fill = fill
+
+        # files that hold exactly the labels in their order are read as they are, the rows of all others are looked up.
+        self.rows = []
+        for path, fn in zip(self.paths, fns):
+            ids = store.ids(fn)
+            if np.array_equal(ids, self.labels):
+                self.rows.append(None)
+                continue
+            rows, found = label_join_index(self.labels, ids)
+            if not found.all():
+                print('{} of {} objects are not in {}, their rows are filled with {}.'.format(
+                    int((~found).sum()), self.n, path, fill))
+            self.rows.append((rows, found))
+
+        self.batches = [(start, min(start + batch_size, self.n)) for start in range(0, self.n, batch_size)]
+        self.scale = self.get_scale()
+
+    @property
+    def n(self):
+        return self.labels.shape[0]
+
+    def get_scale(self):
+        '''one pass over all batches that collects the min and max of every feature.'''
+        scale = []
+        for f, fn in enumerate(self.fns):
+            low, high = np.inf, -np.inf
+            for start, end in self.batches:
+                raw = self.read_raw(f, start, end)
+                low, high = min(low, np.nanmin(raw)), max(high, np.nanmax(raw))
+            scale.append((low, high))
+        return scale
+
+    def read_raw(self, f, start, end):
+        '''rows start..end-1 of the feature f as float64 (rows x d) array.'''
+        view = self.store.view(self.fns[f])
+        if self.rows[f] is None:
+            raw = view[start:end]
+        else:
+            rows, found = self.rows[f][0][start:end], self.rows[f][1][start:end]
+            # every row is read once and in increasing order, which h5py needs for fancy indexing.
+            sel = np.unique(rows[found])
+            raw = np.full((rows.shape[0],) + view.shape[1:], self.fill, dtype=np.float64)
+            if sel.size > 0:
+                raw[found] = view[sel][np.searchsorted(sel, rows[found])]
+        raw = np.asarray(raw, dtype=np.float64)
+        return raw.reshape(raw.shape[0], -1)
+
+    def read(self, start, end):
+        '''
+        Scaled and weighted rows start..end-1 of the feature matrix.
+        :returns: (np.array) of shape (end - start, D) and dtype float32.
+        '''
+        batch = []
+        for f in range(len(self.fns)):
+            low, high = self.scale[f]
+            tmp = (self.read_raw(f, start, end) - low) / (high - low)
+            batch.append(self.weights[f] * np.nan_to_num(tmp).astype(np.float32))
+        return np.concatenate(batch, axis=1)
+
+    def __iter__(self):
+        for start, end in self.batches:
+            yield start, end, self.read(start, end)
+
+
+def stream_fit_predict(model, stream, epochs=3, seed=0):
+    '''
+    Fits a model that supports 'partial_fit' (e.g. MiniBatchKMeans) batch by batch and assigns
+    the labels in a second pass. The batches are visited in a new random order every epoch.
+    :param model: clustering object with 'partial_fit' and 'predict'.
+    :param stream: (FeatureStream) of the feature matrix.
+    :param epochs: (int) number of passes over all batches for fitting.
+    :returns: (np.array) cluster label of every object.
+    '''
+    n_clusters = getattr(model, 'n_clusters', 1)
+    if stream.n < n_clusters:
+        raise ValueError('{} objects can not be split into {} clusters.'.format(stream.n, n_clusters))
+    rng = np.random.default_rng(seed)
+    print('fitting {} on {} objects in {} batches.'.format(type(model).__name__, stream.n, len(stream.batches)))
+    for epoch in range(epochs):
+        order = rng.permutation(len(stream.batches))
+        if epoch == 0:
+            # the model is initialised on the first call, which needs at least n_clusters rows. The first
+            # batch is grown to n_clusters rows if it is smaller (CLUSTER.BATCH_SIZE < N_CLUSTER).
+            order = order[order != 0]
+            model.partial_fit(stream.read(0, max(stream.batches[0][1], n_clusters)))
+        for b in tqdm(order):
+            start, end = stream.batches[b]
+            model.partial_fit(stream.read(start, end))
+
+    res_labels = np.zeros(stream.n, dtype=np.int32)
+    for start, end, batch in tqdm(stream, total=len(stream.batches)):
+        res_labels[start:end] = model.predict(batch)
+    return res_labels
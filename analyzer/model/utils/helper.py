@@ -10,6 +10,8 @@ from skimage.color import label2rgb
 from tqdm import tqdm
 
 from analyzer.data.utils.data_raw import save_m_to_image
+from analyzer.data.feature_store import label_join_index
+from analyzer.model.utils.relabel import build_lut, relabel_stack
 
 def convert_to_sparse(inputs):
     '''
@@ -40,7 +42,8 @@ def convert_to_sparse(inputs):
 
     return (sparse)
 
-def recompute_from_res(labels, result, vol= None, volfns=None, dprc='full', fp='', mode='3d', neuroglancer=False, em_path=None):
+def recompute_from_res(labels, result, vol= None, volfns=None, dprc='full', fp='', mode='3d', neuroglancer=False, em_path=None,
+                       store=None, output='png', cpus=None, chunks=(16, 256, 256), codec='lz4'):
     '''
     Take the result labels from clustering algorithm and adjust the old labels. NOTE: '3d' mode is way faster.
     :param labels: (np.array) vector that contains old labels that you want to adjust.
@@ -49,6 +52,8 @@ def recompute_from_res(labels, result, vol= None, volfns=None, dprc='full', fp='
     :param volfns: (list) of image filenames that contain the groundtruth mask.
     :param fp: (string) this should give you the folder path where the resulting image should be stored.
     :param dprc: (string)
+    :param store: (string) path of the volume store. In 'iter' mode its label volume is read instead of volfns.
+    :param output: (string) 'iter' mode writes 'png' (uint16) images or a chunked h5 volume ('store'), see 'relabel_stack'.
     :returns cld_labels: (np.array) vol matrix that is the same shape as vol mask. But with adjusted labels.
     '''
     print('\nStarting to relabel the mask with the results from the clustering results.')
@@ -63,72 +68,62 @@ def recompute_from_res(labels, result, vol= None, volfns=None, dprc='full', fp='
 
                 cld_labels[r] = tmp
         else:
-            ldict = {}
-            for k, v in zip(labels, result):
-                ldict[k] = v + 1  # + 1 in order to secure that label 0 is not missed.
-
-            k = np.array(list(ldict.keys()))
-            v = np.array(list(ldict.values()))
-
-            mapv = np.zeros(k.max() + 1)
-            mapv[k] = v
-            cld_labels = mapv[vol]
+            lut = build_lut(labels, result)
+            cld_labels = np.where(vol < lut.shape[0], lut[np.minimum(vol, lut.shape[0] - 1)], 0)
     elif dprc == 'iter':
-        ldict = {}
-        for k, v in zip(labels, result):
-            ldict[k] = v + 1  # + 1 in order to secure that label 0 is not missed.
-
-        k = np.array(list(ldict.keys()))
-        v = np.array(list(ldict.values()))
-
         if neuroglancer:
-            emfns = glob.glob(em_path+"*.png")
-            recompute_from_res_per_slice_h5(volfns, emfns, k=k, v=v, fp=fp)
+            emfns = sorted(glob.glob(em_path+"*.png"))
+            recompute_from_res_per_slice_h5(volfns, emfns, build_lut(labels, result), fp=fp)
         else:
-            with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-                pool.starmap(functools.partial(recompute_from_res_per_slice, k=k, v=v, fp=fp), enumerate(volfns))
+            relabel_stack(labels, result, fns=volfns, store=store, fp=fp, output=output, cpus=cpus, chunks=chunks, codec=codec)
         cld_labels = 0 #Just to avoid error message.
     else:
         raise ValueError('No valid data processing option choosen. Please choose \'full\' or \'iter\'.')
     print('Relabeling of the mask is done.\n')
     return cld_labels
 
-def recompute_from_res_per_slice(idx, fns, k, v, fp):
+def join_labels(label_list, how='inner'):
     '''
-    Helper function to iterate over the whole dataset in order to replace the labels with its
-    clustering labels.
+    Common id order of several feature files.
+    :param label_list: (list) of (np.array)s with the ids of every feature file.
+    :param how: (string) 'inner': ids that are in every file. 'outer': ids that are in any file.
+                         'first': the ids of the first file in their order.
+    :returns: (np.array) of the common ids. 'inner' and 'outer' are sorted ascending.
     '''
-    if idx % 50 == 0:
-        print('relabeling of image {} done.'.format(idx))
-    if os.path.exists(fns):
-        vol = imageio.imread(fns)
-        mapv = np.zeros(k.max() + 1)
-        mapv[k] = v
-        cld_labels = mapv[vol]
-    else:
-        raise ValueError('image {} not found.'.format(fns))
-    save_m_to_image(cld_labels, 'cluster_mask', fp=fp, idx=idx, ff='png')
+    if how == 'first':
+        return np.asarray(label_list[0])
+    common = np.unique(label_list[0])
+    for labels in label_list[1:]:
+        if how == 'inner':
+            common = np.intersect1d(common, labels, assume_unique=False)
+        elif how == 'outer':
+            common = np.union1d(common, labels)
+        else:
+            raise ValueError('No id join {}. Choose \'inner\', \'outer\' or \'first\'.'.format(how))
+    return common
 
-def correct_idx_feat(base_labels, labels, features):
+def correct_idx_feat(base_labels, labels, features, fill=0):
     '''
     This function should check and if necessary correct the labeling order and their
     corresponding features to not mix up different features for the clustering.
     :param base_labels: (np.array) This is the reference labels order.
     :param labels: (np.array) labels that do not fit the base_labels.
     :param features: features that should be aligned according to the base_labels.
+    :param fill: value of the rows whose id is not in labels.
     :returns : ordered features.
     '''
-    ordered_feat = np.array(shape=features.shape)
-    for i in range(base_labels.shape[0]):
-        feat_idx = np.where(labels == base_labels[i])
-        ordered_feat[i] = features[feat_idx]
+    features = np.asarray(features)
+    idx, found = label_join_index(base_labels, labels)
+    dtype = features.dtype if found.all() else np.result_type(features.dtype, np.min_scalar_type(fill))
+    ordered_feat = np.full((len(base_labels),) + features.shape[1:], fill, dtype=dtype)
+    ordered_feat[found] = features[idx[found]]
 
     return ordered_feat
 
 def check_feature_order(base_labels, labels):
     '''checking the label order of the features, to secure that the order is correct
     an the features are not mixed up for the clustering. Very important!'''
-    return (base_labels == labels).all()
+    return len(base_labels) == len(labels) and (np.asarray(base_labels) == np.asarray(labels)).all()
 
 def convert_dict_mtx(inputs, valn):
     '''
@@ -167,24 +162,23 @@ def min_max_scale(X, desired_range=(0,1)):
     X_scaled = X_std * (max_v - min_v) + min_v
     return X_scaled
 
-def recompute_from_res_per_slice_h5(volfns, emfns, k, v, fp, limit=100):
+def recompute_from_res_per_slice_h5(volfns, emfns, lut, fp, limit=100):
     '''
     Helper function to iterate over the whole dataset in order to replace the labels with its
     clustering labels and save them in h5 files.
+    :param lut: (np.array) lookup table from object id to cluster, see 'build_lut'.
     '''
     with h5py.File(fp+'neuroglancer.h5', 'w') as f:
         if limit is not None:
             volfns = volfns[:limit]
         vol = imageio.imread(volfns[0])
-        ds = f.create_dataset('label', shape=(len(volfns), *vol.shape))
+        ds = f.create_dataset('label', shape=(len(volfns), *vol.shape), dtype=np.uint16)
         ds2 = f.create_dataset('image', shape=(len(volfns), *vol.shape))
         for idx, fns in tqdm(enumerate(volfns), total=len(volfns)):
             if os.path.exists(fns):
                 vol = imageio.imread(fns)
                 em = imageio.imread(emfns[idx])
-                mapv = np.zeros(k.max() + 1)
-                mapv[k] = v
-                cld_labels = mapv[vol]
+                cld_labels = np.where(vol < lut.shape[0], lut[np.minimum(vol, lut.shape[0] - 1)], 0)
             else:
                 raise ValueError('image {} not found.'.format(fns))
 
@@ -0,0 +1,60 @@
+import os, sys
+import hashlib
+
+import numpy as np
+
+# Name and version of the feature scaling. It is part of every key, so changing the scaling
+# invalidates all cached matrices.
+SCALER = 'minmax-v1'
+
+
+def array_digest(h, arr):
+    '''feeds dtype, shape and content of arr into the hash object h.'''
+    arr = np.ascontiguousarray(arr)
+    h.update(str(arr.dtype).encode())
+    h.update(str(arr.shape).encode())
+    h.update(arr.tobytes())
+
+
+def feature_key(fns, labels, feat):
+    '''
+    Content hash of one feature: its name, the object ids, the values and the scaler.
+    :param fns: (string) name of the feature, e.g. 'sizef'.
+    :param labels: (np.array) object ids in row order.
+    :param feat: (np.array) feature vector/matrix.
+    :returns: (string) hex digest.
+    '''
+    h = hashlib.sha1()
+    h.update(fns.encode())
+    h.update(SCALER.encode())
+    array_digest(h, labels)
+    array_digest(h, feat)
+    return h.hexdigest()
+
+
+def matrix_key(feature_keys, weights, kind, **params):
+    '''
+    Key of a matrix that combines features: the feature keys in their order, the weights,
+    the kind of matrix (e.g. 'dist' or 'knn') and all further parameters it depends on.
+    :returns: (string) hex digest.
+    '''
+    h = hashlib.sha1()
+    h.update(kind.encode())
+    for key, w in zip(feature_keys, weights):
+        h.update(key.encode())
+        h.update(repr(float(w)).encode())
+    for name in sorted(params):
+        h.update('{}={}'.format(name, params[name]).encode())
+    return h.hexdigest()
+
+
+def cache_path(cache_dir, name, key, ext='.npy'):
+    '''file of a cached matrix. The key is shortened, 16 hex digits are plenty to tell runs apart.'''
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, '{}_{}{}'.format(name, key[:16], ext))
+
+
+def tmp_path(path):
+    '''matrices are written to this file first and renamed when complete, so a crash never leaves a valid entry.'''
+    root, ext = os.path.splitext(path)
+    return root + '.tmp' + ext
@@ -0,0 +1,112 @@
+import os, sys
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import h5py
+import imageio
+import numpy as np
+from tqdm import tqdm
+
+from analyzer.data.utils.data_raw import save_m_to_image
+from analyzer.data.volume_store import VolumeStore, get_codec
+
+
+def build_lut(labels, result):
+    '''
+    Lookup table from object id to cluster. Cluster c is written as c + 1 so that label 0 stays
+    background; ids without a result (and noise, -1) map to 0.
+    :param labels: (np.array) object ids.
+    :param result: (np.array) cluster of every object.
+    :returns: (np.array) of length max(id) + 1 with the smallest unsigned dtype that holds all clusters.
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    values = np.maximum(np.asarray(result, dtype=np.int64) + 1, 0)
+    top = int(values.max()) if values.size else 0
+    dtype = np.uint8 if top <= np.iinfo(np.uint8).max else np.uint16 if top <= np.iinfo(np.uint16).max else np.uint32
+    lut = np.zeros(int(labels.max()) + 1 if labels.size else 1, dtype=dtype)
+    lut[labels] = values
+    return lut
+
+
+def relabel_stack(labels, result, fns=None, store=None, fp='', output='png', cpus=None, chunks=(16, 256, 256), codec='lz4'):
+    '''
+    Replaces every object id of the label stack by its cluster. The lookup table is built once and
+    shared by all workers through shared memory. The workers relabel slabs of slices in parallel; only
+    one slab per worker is in memory.
+    :param labels: (np.array) object ids.
+    :param result: (np.array) cluster of every object.
+    :param fns: (list) of label image filenames. Used if store is None.
+    :param store: (string) path of the volume store whose 'label' volume is relabeled.
+    :param fp: (string) output folder.
+    :param output: (string) 'png': one uint16 image per slice (cluster_mask_<z>.png).
+                            'store': one chunked volume 'cluster' in fp/masks.h5.
+    :returns: (string) the output folder or the h5 file.
+    '''
+    if store is None and not fns:
+        raise ValueError('No label images and no volume store to relabel.')
+    if output not in ['png', 'store']:
+        raise ValueError('No relabel output {}. Choose \'png\' or \'store\'.'.format(output))
+    cpus = cpus if cpus is not None else multiprocessing.cpu_count()
+    lut = build_lut(labels, result)
+    if output == 'png' and lut.dtype == np.uint32:
+        raise ValueError('{} clusters do not fit into uint16 images. Choose the output \'store\'.'.format(int(lut.max())))
+
+    if store is not None:
+        shape = VolumeStore(store).shape('label')
+    else:
+        shape = (len(fns), *np.squeeze(imageio.imread(fns[0])).shape)
+    depth = chunks[0] if output == 'store' else max(1, min(chunks[0], -(-shape[0] // cpus)))
+    slabs = [(z, min(z + depth, shape[0])) for z in range(0, shape[0], depth)]
+    os.makedirs(fp, exist_ok=True)
+
+    shm = shared_memory.SharedMemory(create=True, size=lut.nbytes)
+    try:
+        np.ndarray(lut.shape, dtype=lut.dtype, buffer=shm.buf)[:] = lut
+        initargs = (shm.name, lut.shape, lut.dtype, fns, store, fp, output)
+        t = time.perf_counter()
+        with multiprocessing.Pool(processes=cpus, initializer=init_relabel, initargs=initargs) as pool:
+            if output == 'png':
+                for _ in tqdm(pool.imap_unordered(relabel_slab, slabs), total=len(slabs)):
+                    pass
+                target = fp
+            else:
+                target = os.path.join(fp, 'masks.h5')
+                chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+                with h5py.File(target, 'w') as f:
+                    ds = f.create_dataset('cluster', shape, dtype=lut.dtype, chunks=chunks, **get_codec(codec))
+                    for start, block in tqdm(pool.imap_unordered(relabel_slab, slabs), total=len(slabs)):
+                        ds[start:start + block.shape[0]] = block
+                    f.attrs['complete'] = True
+        elapsed = time.perf_counter() - t
+    finally:
+        shm.close()
+        shm.unlink()
+
+    print('relabeled {} slices in {:.1f} s ({:.1f} slices/s) to {}.'.format(shape[0], elapsed, shape[0] / max(elapsed, 1e-9), target))
+    return target
+
+
+def init_relabel(shm_name, shape, dtype, fns, store, fp, output):
+    global LUT_SHM, LUT, RELABEL_FNS, RELABEL_STORE, RELABEL_FP, RELABEL_OUTPUT
+    LUT_SHM = shared_memory.SharedMemory(name=shm_name)
+    LUT = np.ndarray(shape, dtype=dtype, buffer=LUT_SHM.buf)
+    RELABEL_FNS, RELABEL_FP, RELABEL_OUTPUT = fns, fp, output
+    RELABEL_STORE = VolumeStore(store) if store is not None else None
+
+
+def relabel_slab(slab):
+    '''Helper for 'relabel_stack' that relabels the slices start..end-1.'''
+    start, end = slab
+    if RELABEL_STORE is not None:
+        block = RELABEL_STORE.read('label', (start, 0, 0, end) + RELABEL_STORE.shape('label')[1:])
+    else:
+        block = np.stack([np.squeeze(imageio.imread(RELABEL_FNS[z])) for z in range(start, end)])
+    # ids beyond the table (objects that were not clustered) are background.
+    block = np.where(block < LUT.shape[0], LUT[np.minimum(block, LUT.shape[0] - 1)], 0).astype(LUT.dtype)
+
+    if RELABEL_OUTPUT == 'png':
+        for z in range(start, end):
+            save_m_to_image(block[z - start], 'cluster_mask', fp=RELABEL_FP, idx=z, ff='png', dtype=np.uint16)
+        return start, None
+    return start, block
@@ -0,0 +1,454 @@
+import os, sys
+import math
+import multiprocessing
+import functools
+
+import numpy as np
+import imageio
+
+# Per-region properties that 'calc_props' is able to compute. The order is the order
+# in which the values are appended for every region. 'surface' is the number of exposed voxel
+# faces of the region in one slice (in-plane and towards both neighbouring slices).
+PROP_ORDER = ['size', 'slices', 'centroid', 'circ', 'surface_to_volume', 'random_pt', 'border', 'bbox', 'surface']
+
+# Weights of the 3x3 border pixel codes that skimage.measure.perimeter uses (4-neighbourhood).
+PERIMETER_WEIGHTS = np.zeros(50, dtype=np.float64)
+PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+# Properties that each of the geometric features needs from the label stack. The features are
+# served by the per-label aggregates of the scan, the per slice records are not needed.
+FEATURE_PROPS = {
+    'sizef': ['size'],
+    'distf': ['size', 'centroid'],
+    'circf': ['circ'],
+    'surface_to_volumef': ['size', 'surface'],
+    'slenf': ['centroid'],
+}
+
+
+class ScanResult(dict):
+    '''
+    Aggregated outcome of a single scan over the label stack.
+    acc holds the per-label aggregates (RegionAccumulator) of the whole stack.
+    If the scan keeps records, keys are the segment labels and values are (dict)s that map every
+    scanned property to a (list) with one entry per slice the segment appears in (in slice order).
+    :param prop_list: (list) of (string)s that were computed during the scan.
+    :param records: (bool) the per slice records are part of the scan.
+    '''
+    def __init__(self, prop_list, records=True):
+        super().__init__()
+        self.props = list(prop_list)
+        self.records = records
+        self.acc = None
+
+    def covers(self, prop_list, records=False):
+        '''Returns True if every property in prop_list is part of this scan (and the records, if needed).'''
+        return all(p in self.props for p in prop_list) and (self.records or not records)
+
+
+class RegionAccumulator():
+    '''
+    Per-label aggregates that are updated slice by slice. While slices are added, the values are
+    kept in dense arrays indexed by the label, so an update costs O(regions in the slice) and
+    the memory is O(labels), independent of the number of slices. 'compact' reduces the arrays to
+    the labels that were seen; compact accumulators of consecutive slabs are combined by 'merge'.
+
+    Kept per label: number of slices, voxel count, area weighted sums of r, c and z, the
+    centroids of the first and the last slice, the path length along the per slice centroids
+    (skeleton), the sum of the per slice circularities and the number of exposed voxel faces.
+    '''
+    FIELDS = {'n_slices': (), 'area': (), 'weighted': (3,), 'first': (3,), 'last': (3,),
+              'path': (), 'circ': (), 'surface': ()}
+
+    def __init__(self):
+        self.ids = None
+        self.values = {name: np.zeros((0, *shape)) for name, shape in self.FIELDS.items()}
+
+    def _grow(self, max_label):
+        size = self.values['area'].shape[0]
+        if max_label < size:
+            return
+        extra = max(max_label + 1, 2 * size) - size
+        for name, shape in self.FIELDS.items():
+            self.values[name] = np.concatenate([self.values[name], np.zeros((extra, *shape))])
+
+    def update(self, z, labels, area, centroid, circ=None):
+        '''
+        Adds one slice. Slices have to be added in ascending z order.
+        :param z: (int) slice index.
+        :param labels: (np.array) labels of the regions in the slice. Unique.
+        :param area: (np.array) pixel count of every region.
+        :param centroid: (np.array) (N x 2) centroid (r, c) of every region.
+        :param circ: (np.array) circularity of every region.
+        '''
+        if self.ids is not None:
+            raise ValueError('A compact accumulator can only be merged.')
+        if labels.shape[0] == 0:
+            return
+        self._grow(int(labels.max()))
+        v = self.values
+        pt = np.concatenate([centroid, np.full((labels.shape[0], 1), z)], axis=1).astype(np.float64)
+
+        seen = v['n_slices'][labels] > 0
+        v['path'][labels[seen]] += np.linalg.norm(pt[seen] - v['last'][labels[seen]], axis=1)
+        v['first'][labels[~seen]] = pt[~seen]
+        v['last'][labels] = pt
+        v['n_slices'][labels] += 1
+        v['area'][labels] += area
+        v['weighted'][labels] += area[:, None] * pt
+        if circ is not None:
+            v['circ'][labels] += circ
+
+    def add_surface(self, labels, counts):
+        '''adds the number of exposed faces of the regions of one slice.'''
+        if labels.shape[0] == 0:
+            return
+        self._grow(int(labels.max()))
+        self.values['surface'][labels] += counts
+
+    def compact(self):
+        '''keeps only the labels that were seen. Returns self.'''
+        if self.ids is None:
+            self.ids = np.flatnonzero(self.values['n_slices'])
+            self.values = {name: value[self.ids] for name, value in self.values.items()}
+        return self
+
+    @staticmethod
+    def merge(upper, lower):
+        '''
+        Combines the compact accumulators of two consecutive slabs. upper has to lie above lower
+        (smaller z). The merge is associative, so partial results can be combined in a tree.
+        :returns: (RegionAccumulator) compact accumulator of both slabs.
+        '''
+        merged = RegionAccumulator()
+        merged.ids = np.union1d(upper.ids, lower.ids)
+        iu = np.searchsorted(merged.ids, upper.ids)
+        il = np.searchsorted(merged.ids, lower.ids)
+        u, l = upper.values, lower.values
+
+        for name, shape in RegionAccumulator.FIELDS.items():
+            value = np.zeros((merged.ids.shape[0], *shape))
+            if name == 'first':
+                value[il] = l[name]
+                value[iu] = u[name]
+            elif name == 'last':
+                value[iu] = u[name]
+                value[il] = l[name]
+            else:
+                value[iu] += u[name]
+                value[il] += l[name]
+            merged.values[name] = value
+
+        # the path of a label that continues from upper into lower is joined between the slabs.
+        both, bu, bl = np.intersect1d(upper.ids, lower.ids, assume_unique=True, return_indices=True)
+        merged.values['path'][np.searchsorted(merged.ids, both)] += np.linalg.norm(
+            l['first'][bl] - u['last'][bu], axis=1)
+        return merged
+
+    def _rows(self, labels):
+        labels = self.labels if labels is None else np.asarray(labels)
+        if self.ids is None:
+            return labels
+        return np.searchsorted(self.ids, labels)
+
+    @property
+    def labels(self):
+        '''all labels that have been seen, ascending.'''
+        return self.ids if self.ids is not None else np.flatnonzero(self.values['n_slices'])
+
+    def get(self, name, labels=None):
+        '''values of one field for labels. (default: all labels ascending)'''
+        return self.values[name][self._rows(labels)]
+
+    def centroids(self, labels=None):
+        '''area weighted 3d centroid (r, c, z) of every label. (default: all labels ascending)'''
+        return self.get('weighted', labels) / self.get('area', labels)[:, None]
+
+    def skeleton_length(self, labels=None):
+        '''length of the path through the per slice centroids of every label. (default: all labels ascending)'''
+        return self.get('path', labels)
+
+
+def props_for_features(feat_list):
+    '''
+    Union of all the properties that are needed to compute the features in feat_list.
+    :param feat_list: (list) of feature names, e.g. ['sizef', 'circf'].
+    :returns: (list) of property names, ordered like PROP_ORDER.
+    '''
+    needed = set()
+    for feat in feat_list:
+        needed.update(FEATURE_PROPS.get(feat, []))
+    return [p for p in PROP_ORDER if p in needed]
+
+
+def scan_label_stack(fns, prop_list, cpus=None, records=True):
+    '''
+    Decodes every label slice exactly once and computes all requested per-region properties
+    in that single pass. The result can be handed to every feature consumer.
+    The stack is split into consecutive z-slabs that are scanned in parallel. Every worker
+    reduces its slab to compact per-label aggregates, which are merged pairwise in a tree.
+    Within a slab the slices are read in order, so only the current and the previous slice have
+    to be resident to count the faces between them.
+    :param fns: (list) of sorted label image filenames.
+    :param prop_list: (list) of (string)s; any subset of PROP_ORDER.
+    :param cpus: (int) number of worker processes. (default: all cores)
+    :param records: (bool) keep the per slice records of every label. Without them the memory
+                    of the scan only scales with the number of labels.
+
+    :returns scan: (ScanResult) with the aggregates in scan.acc and, if records is set,
+                   label -> {property: [value per slice]}.
+    '''
+    prop_list = [p for p in PROP_ORDER if p in prop_list]
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+
+    print('Scanning {} label slices for the properties: {}.'.format(len(fns), str(prop_list).strip('[]')))
+    scan = ScanResult(prop_list, records=records)
+    with multiprocessing.Pool(processes=cpus) as pool:
+        tmp = pool.starmap(functools.partial(scan_slab, fns=fns, prop_list=prop_list, records=records),
+                           get_slabs(len(fns), cpus))
+        partials = [acc for acc, _ in tmp]
+        while len(partials) > 1:
+            pairs = [(partials[i], partials[i + 1]) for i in range(0, len(partials) - 1, 2)]
+            partials = pool.starmap(RegionAccumulator.merge, pairs) + partials[2 * len(pairs):]
+    scan.acc = partials[0] if partials else RegionAccumulator().compact()
+
+    if records:
+        for dicts in (d for _, slab in tmp for d in slab):
+            for key, value in dicts.items():
+                if key not in scan:
+                    scan[key] = {p: [] for p in prop_list}
+                for p, v in zip(prop_list, value):
+                    scan[key][p].append(v)
+
+    print('Scan finished. {} segments found.'.format(scan.acc.labels.shape[0]))
+    return scan
+
+
+def get_slabs(n_slices, cpus, slabs_per_cpu=4):
+    '''returns the (start, end) slice ranges of consecutive slabs that split a stack of n_slices.'''
+    n_slabs = max(1, min(n_slices, cpus * slabs_per_cpu))
+    bounds = np.linspace(0, n_slices, n_slabs + 1).astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(n_slabs) if bounds[i] < bounds[i + 1]]
+
+
+def scan_slab(start, end, fns, prop_list, records=True):
+    '''
+    Helper function for 'scan_label_stack' that scans the slices start..end-1 in order.
+    For 'surface' the slices start-1 and end are read as halo.
+    :returns acc, results: compact (RegionAccumulator) of the slab and (list) with one result of
+                           'calc_props' per slice (empty if records is not set).
+    '''
+    acc = RegionAccumulator()
+    results = []
+    surface = 'surface' in prop_list
+    perimeter = 'circ' in prop_list or 'surface_to_volume' in prop_list
+
+    prev = read_label_slice(fns, start - 1) if surface else None
+    # exposed faces of the previous slice that still miss the faces towards the current slice.
+    pending = None
+    for idx in range(start, end + 1 if surface else end):
+        img = read_label_slice(fns, idx)
+        if surface:
+            upper_faces, lower_faces = z_faces(prev, img)
+            if pending is not None:
+                labels, counts = np.unique(np.concatenate([pending, upper_faces]), return_counts=True)
+                acc.add_surface(labels, counts)
+                if records:
+                    add_surface(results[-1], labels, counts)
+            pending = np.concatenate([xy_faces(img), lower_faces]) if img is not None and idx < end else None
+            prev = img
+        if idx == end:
+            break
+
+        stats = slice_stats(img, perimeter=perimeter) if img is not None else None
+        if stats is not None:
+            circ = np.array([cc(a, p) for a, p in zip(stats['area'], stats['perimeter'])]) if 'circ' in prop_list else None
+            acc.update(idx, stats['labels'].astype(np.int64), stats['area'],
+                       stats['centroid'].astype(int), circ=circ)
+        if records:
+            results.append(slice_props(idx, img, prop_list, stats=stats) if img is not None else {})
+
+    return acc.compact(), results
+
+
+def read_label_slice(fns, idx):
+    '''reads slice idx of the stack. None if it is outside of the stack or missing.'''
+    if 0 <= idx < len(fns) and os.path.exists(fns[idx]):
+        return imageio.imread(fns[idx])
+    return None
+
+
+def add_surface(result, labels, counts):
+    '''appends the number of exposed faces to every region of one slice result.'''
+    counts = dict(zip(labels.tolist(), counts.tolist()))
+    for key, value in result.items():
+        value.append(counts.get(key, 0))
+
+
+def xy_faces(img):
+    '''labels of all in-plane voxel faces that do not touch the same label. One entry per face.'''
+    pad = np.pad(img, 1, mode='constant', constant_values=0)
+    fg = img > 0
+    faces = []
+    for shifted in [pad[:-2, 1:-1], pad[2:, 1:-1], pad[1:-1, :-2], pad[1:-1, 2:]]:
+        faces.append(img[fg & (shifted != img)])
+    return np.concatenate(faces)
+
+
+def z_faces(upper, lower):
+    '''
+    Faces between two consecutive slices that separate different labels. A missing slice (None)
+    counts as background.
+    :returns: (np.array)s with the labels of the exposed faces of upper and of lower.
+    '''
+    if upper is None and lower is None:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    upper = upper if upper is not None else np.zeros_like(lower)
+    lower = lower if lower is not None else np.zeros_like(upper)
+    exposed = upper != lower
+    return upper[exposed & (upper > 0)], lower[exposed & (lower > 0)]
+
+
+def calc_props(idx, fns, prop_list=['size', 'slices', 'centroid', 'circ', 'surface_to_volume']):
+    '''
+    Helper function for 'scan_label_stack'
+    :param fns: (string) list of filenames. sorted.
+    :param prop_list: (list) of (strings) that contain the properties that should be stored in result.
+    :returns result: (dict) with each segment. key: idx of segment -- value: [number of pixels in segment, idx of slice].
+    '''
+    result = {}
+    if os.path.exists(fns):
+        result = slice_props(idx, imageio.imread(fns), prop_list)
+    return result
+
+
+def slice_props(idx, tmp, prop_list, stats=None):
+    '''
+    Properties of every region of one decoded label slice. 'surface' is not part of the result as
+    it needs the neighbouring slices, see 'scan_slab'.
+    :param idx: (int) slice index.
+    :param tmp: (np.array) 2d label image.
+    :param stats: (dict) result of 'slice_stats' for tmp, if already computed.
+    :returns result: (dict) key: label -- value: (list) of the properties in PROP_ORDER.
+    '''
+    result = {}
+    if stats is None:
+        stats = slice_stats(tmp, perimeter='circ' in prop_list or 'surface_to_volume' in prop_list)
+
+    for l, label in enumerate(stats['labels'].tolist()):
+        value = result.setdefault(label, [])
+        if 'size' in prop_list:
+            value.append(int(stats['area'][l]))
+        if 'slices' in prop_list:
+            value.append(idx)
+        if 'centroid' in prop_list:
+            value.append(tuple(map(int, stats['centroid'][l])))
+        if 'circ' in prop_list:
+            value.append(cc(stats['area'][l], stats['perimeter'][l]))
+        if 'surface_to_volume' in prop_list:
+            value.append((int(stats['area'][l]), stats['perimeter'][l]))
+        if 'random_pt' in prop_list:
+            value.append(stats['first'][l])
+        if 'border' in prop_list:
+            minr, minc, maxr, maxc = stats['bbox'][l]
+            value.append(bool(minr == 0 or minc == 0 or maxr == tmp.shape[0] or maxc == tmp.shape[1]))
+        if 'bbox' in prop_list:
+            value.append(tuple(map(int, stats['bbox'][l])))
+
+    return result
+
+
+def slice_stats(img, perimeter=True):
+    '''
+    Vectorised statistics of all labels of one 2d label image. Every statistic is computed in a
+    single pass over the pixels (np.unique / np.bincount) instead of one pass per region.
+    The values are identical to the ones of skimage.measure.regionprops.
+    :param img: (np.array) 2d label image. 0 is background.
+    :param perimeter: (bool) compute the perimeter and the number of boundary pixels.
+
+    :returns: (dict) of (np.array)s with one row per label:
+              labels, area, centroid (r, c), bbox (minr, minc, maxr, maxc) with exclusive max,
+              first (r, c) first pixel in row-major order, n_boundary, perimeter.
+    '''
+    flat = img.ravel()
+    labels, first, inverse, area = np.unique(flat, return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    if labels.shape[0] > 0 and labels[0] == 0:
+        labels, first, area = labels[1:], first[1:], area[1:]
+        inverse = inverse - 1
+    n = labels.shape[0]
+    fg = inverse >= 0
+    pos = inverse[fg]
+
+    rows, cols = np.divmod(np.flatnonzero(fg), img.shape[1])
+    stats = {
+        'labels': labels,
+        'area': area,
+        'centroid': np.stack((np.bincount(pos, weights=rows, minlength=n),
+                              np.bincount(pos, weights=cols, minlength=n)), axis=1) / area[:, None],
+        'first': np.stack(np.divmod(first, img.shape[1]), axis=1),
+    }
+
+    bbox = np.zeros((n, 4), dtype=np.int64)
+    if n > 0:
+        bbox[:, 0] = img.shape[0]
+        bbox[:, 1] = img.shape[1]
+        np.minimum.at(bbox[:, 0], pos, rows)
+        np.minimum.at(bbox[:, 1], pos, cols)
+        np.maximum.at(bbox[:, 2], pos, rows + 1)
+        np.maximum.at(bbox[:, 3], pos, cols + 1)
+    stats['bbox'] = bbox
+
+    if perimeter:
+        stats['n_boundary'], stats['perimeter'] = slice_perimeter(img, inverse.reshape(img.shape), n)
+    return stats
+
+
+def slice_perimeter(img, compact, n):
+    '''
+    Perimeter of every label of a 2d label image, equal to skimage.measure.perimeter on the
+    mask of each label. A pixel is a boundary pixel if one of its 4 neighbours belongs to another
+    label. Each boundary pixel is weighted by the configuration of its 8 neighbouring boundary
+    pixels of the same label.
+    :param img: (np.array) 2d label image.
+    :param compact: (np.array) labels of img mapped to 0..n-1, background -1.
+    :param n: (int) number of labels.
+    :returns n_boundary, perimeter: (np.array)s with one value per label.
+    '''
+    pad = np.pad(compact, 1, mode='constant', constant_values=-1)
+    h, w = img.shape
+    center = pad[1:h + 1, 1:w + 1]
+    shifted = lambda dr, dc: pad[1 + dr:h + 1 + dr, 1 + dc:w + 1 + dc]
+
+    inner = center >= 0
+    for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        inner &= shifted(dr, dc) == center
+    boundary = (center >= 0) & ~inner
+
+    bpad = np.pad(boundary, 1, mode='constant', constant_values=False)
+    code = boundary.astype(np.uint8)
+    for dr in [-1, 0, 1]:
+        for dc in [-1, 0, 1]:
+            if dr == 0 and dc == 0:
+                continue
+            weight = 2 if dr == 0 or dc == 0 else 10
+            code += weight * (bpad[1 + dr:h + 1 + dr, 1 + dc:w + 1 + dc] & (shifted(dr, dc) == center)).astype(np.uint8)
+
+    pos = center[boundary]
+    n_boundary = np.bincount(pos, minlength=n)
+    perimeter = np.bincount(pos, weights=PERIMETER_WEIGHTS[code[boundary]], minlength=n)
+    return n_boundary, perimeter
+
+
+def cc(area, perimeter):
+    '''
+    The circularity of a circle is 1, and much less than one for a starfish footprint.
+    '''
+    if math.isnan(perimeter) or (perimeter == 0):
+        circ = np.float64(0.0)
+    else:
+        circ = (4 * np.pi * area) / (perimeter ** 2)
+    return (circ)
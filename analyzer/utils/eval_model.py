@@ -12,7 +12,6 @@ import imageio
 from sklearn.metrics import normalized_mutual_info_score, pair_confusion_matrix
 from tqdm import tqdm
 
-from analyzer.model.utils.extracting import calc_props
 
 class Evaluationmodel():
     '''
@@ -27,6 +26,9 @@ class Evaluationmodel():
     def __init__(self, cfg, dl):
         self.cfg = cfg
         self.dl = dl
+        # imported here, analyzer.data imports this module.
+        from analyzer.data.feature_store import FeatureStore
+        self.store = FeatureStore(self.cfg.DATASET.ROOTF, dtype=None)
 
     def eval(self, rsl_vector):
         '''
@@ -45,28 +47,45 @@ class Evaluationmodel():
 
         return gt_values, gt_counts
 
-    def get_gt_vector(self, fn='gt_vector.json', fast=True):
+    def get_gt_vector(self, fn='gt_vector.json', fast=True, labels=None):
+        '''
+        Ground truth class of every object in ascending id order.
+        :param labels: (np.array) object ids. If set, the vector holds the classes of these objects in their
+                       order (-1 for unknown ids). It is kept with its ids as feature 'gtf' in the feature store.
+        '''
+        if labels is not None:
+            fns = 'binary_gtf' if fn.startswith('binary') else 'gtf'
+            if fns not in self.store:
+                gt_vector = self.get_gt_vector(fn=fn, fast=fast)
+                index = self.dl.get_region_index()
+                ids = index.ids[~index.border] if self.cfg.DATASET.EXCLUDE_BORDER_OBJECTS else index.ids
+                if ids.shape[0] != gt_vector.shape[0]:
+                    raise ValueError('The gt vector holds {} objects, the region index {}.'.format(gt_vector.shape[0], ids.shape[0]))
+                self.store.write(fns, np.asarray(ids), gt_vector)
+            return self.store.read(fns, ids=labels, fill=-1)
+
         if fast:
             return self.fast_create_gt_vector(fn)
         return self.create_gt_vector()
 
-    def eval_volume(self, rsl_vector, gt_values, gt_counts):
+    def eval_volume(self, rsl_vector, gt_values, gt_counts, scan=None):
         '''
         Compute accuracy by comparing each segment from the result to the ground truth.
+        :param scan: (ScanResult) precomputed scan of the label stack, reused if the region index has to be built.
         '''
-        if os.path.exists(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json')) \
-                and os.stat(
-            os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json')).st_size != 0:
-            with open(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json'), 'r') as f:
-                data_info = json.loads(f.read())
-        else:
-            print('data info not found. Will be computed. This takes a while. Be prepared.')
-            data_info = self.prep_data_info(save=True)
+        index = self.dl.get_region_index(scan=scan)
 
         print('\nStarting to compute the accuracy of the clustering process.')
         # Preparation section.
         gt_fns = sorted(glob.glob(self.dl.gtpath + '*.' + self.cfg.DATASET.FILE_FORMAT))
-        rsl_fns = sorted(glob.glob(self.cfg.CLUSTER.OUTPUTPATH + 'masks/*.' + self.cfg.DATASET.FILE_FORMAT))
+        if self.cfg.CLUSTER.MASK_OUTPUT == 'store':
+            from analyzer.data.volume_store import VolumeStore
+            masks = VolumeStore(os.path.join(self.cfg.CLUSTER.OUTPUTPATH, 'masks', 'masks.h5'))
+            rsl_fns = list(range(masks.shape('cluster')[0]))
+            # the masks are read in chunk aligned slabs, see VolumeStore.iter_slices.
+            rsl_slices = masks.iter_slices('cluster')
+        else:
+            rsl_fns = sorted(glob.glob(self.cfg.CLUSTER.OUTPUTPATH + 'masks/*.' + self.cfg.DATASET.FILE_FORMAT))
         if not rsl_fns or not gt_fns:
             raise ValueError('Please make sure that ground truth and result images are there and the path is correct.')
 
@@ -81,45 +100,40 @@ class Evaluationmodel():
 
         for idx in range(len(gt_fns)):
             gt = imageio.imread(gt_fns[idx])
-            rsl = imageio.imread(rsl_fns[idx])
-
-            for key, value in data_info.items():
-                slices = value[0]
-                randompts = value[2]
+            rsl = next(rsl_slices) if self.cfg.CLUSTER.MASK_OUTPUT == 'store' else imageio.imread(rsl_fns[idx])
 
-                if slices[0] == idx:
-                    if self.cfg.CLUSTER.BINARY:
-                        if gt[randompts[0][0], randompts[0][1]] == self.cfg.CLUSTER.TRUE_LABEL:
-                            gt_label_index = np.where(s_gt == gt[randompts[0][0], randompts[0][1]])[0].item()
-                        else:
-                            gt_label_index = np.where(s_gt == -1)[0].item()
-                    else:
+            for key in index.starting_in(idx):
+                randompts = index.records(key)['sample']
+                if self.cfg.CLUSTER.BINARY:
+                    if gt[randompts[0][0], randompts[0][1]] == self.cfg.CLUSTER.TRUE_LABEL:
                         gt_label_index = np.where(s_gt == gt[randompts[0][0], randompts[0][1]])[0].item()
-                    rsl_label_index = -1
-                    for k, coords in enumerate(randompts):
-                        if np.where(s_rsl == rsl[randompts[k][0], randompts[k][1]])[0].size == 0:
-                            continue
+                    else:
+                        gt_label_index = np.where(s_gt == -1)[0].item()
+                else:
+                    gt_label_index = np.where(s_gt == gt[randompts[0][0], randompts[0][1]])[0].item()
+                rsl_label_index = -1
+                for k, coords in enumerate(randompts):
+                    if np.where(s_rsl == rsl[randompts[k][0], randompts[k][1]])[0].size == 0:
+                        continue
+                    else:
+                        rsl_label_index = np.where(s_rsl == rsl[randompts[k][0], randompts[k][1]])[0].item()
+                        break
+                if gt_label_index == rsl_label_index:
+                    correct = correct + 1
+
+                gt_key = s_gt[gt_label_index]
+                rsl_key = s_gt[rsl_label_index]
+                for key, value in condition_dict.items():
+                    if gt_key == key:
+                        if gt_label_index == rsl_label_index:
+                            value[0] += 1
                         else:
-                            rsl_label_index = np.where(s_rsl == rsl[randompts[k][0], randompts[k][1]])[0].item()
-                            break
-                    if gt_label_index == rsl_label_index:
-                        correct = correct + 1
-
-                    gt_key = s_gt[gt_label_index]
-                    rsl_key = s_gt[rsl_label_index]
-                    for key, value in condition_dict.items():
-                        if gt_key == key:
-                            if gt_label_index == rsl_label_index:
-                                value[0] += 1
-                            else:
-                                value[3] += 1
+                            value[3] += 1
+                    else:
+                        if rsl_key == key:
+                            value[1] += 1
                         else:
-                            if rsl_key == key:
-                                value[1] += 1
-                            else:
-                                value[2] += 1
-                else:
-                    continue
+                            value[2] += 1
             if idx % 50 == 0:
                 print('iteration through [{}/{}] done.'.format(idx, len(gt_fns)))
 
@@ -138,36 +152,27 @@ class Evaluationmodel():
                 gt_vector = json.loads(f.read())
         else:
             print('gt vector not found. Will be computed.')
-            if os.path.exists(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json')) \
-                    and os.stat(
-                os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json')).st_size != 0:
-                with open(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json'),
-                          'r') as f:
-                    data_info = json.loads(f.read())
-            else:
-                print('data info not found. Will be computed.')
-                data_info = self.prep_data_info(save=True)
+            index = self.dl.get_region_index()
 
             fns = sorted(glob.glob(self.dl.gtpath + '*.' + self.cfg.DATASET.FILE_FORMAT))
-            gt_ids = list(map(int, data_info.keys()))
-            gt_vector = np.zeros(len(gt_ids), dtype=np.uint16)
-            for key, value in data_info.items():
-                slices = value[0]
-                centerpoints = value[1]
-                randompts = value[2]
-                for i, s in enumerate(slices):
+            gt_vector = np.zeros(len(index), dtype=np.uint16)
+            for r, key in enumerate(index.ids):
+                records = index.records(key)
+                for i, s in enumerate(records['z']):
                     gt = imageio.imread(fns[s])
-                    if gt[centerpoints[i][0], centerpoints[i][1]] == 0 and gt[randompts[i][0], randompts[i][1]] == 0:
+                    cpt = records['centroid'][i].astype(int)
+                    rpt = records['sample'][i]
+                    if gt[cpt[0], cpt[1]] == 0 and gt[rpt[0], rpt[1]] == 0:
                         continue
                     else:
-                        if gt[centerpoints[i][0], centerpoints[i][1]] != 0:
-                            gt_vector[gt_ids.index(int(key))] = gt[centerpoints[i][0], centerpoints[i][1]]
+                        if gt[cpt[0], cpt[1]] != 0:
+                            gt_vector[r] = gt[cpt[0], cpt[1]]
                         else:
-                            gt_vector[gt_ids.index(int(key))] = gt[randompts[i][0], randompts[i][1]]
+                            gt_vector[r] = gt[rpt[0], rpt[1]]
                         break
 
-                if gt_ids.index(int(key)) % 1000 == 0:
-                    print('altered [{}/{}] labels for ground truth vector.'.format(gt_ids.index(int(key)), len(gt_ids)))
+                if r % 1000 == 0:
+                    print('altered [{}/{}] labels for ground truth vector.'.format(r, len(index)))
             if save:
                 with open(os.path.join(self.cfg.DATASET.ROOTF, 'gt_vector.json'), 'w') as f:
                     json.dump(gt_vector, f, cls=NumpyEncoder)
@@ -181,35 +186,6 @@ class Evaluationmodel():
 
         return gt_vector
 
-    def prep_data_info(self, save=False):
-        '''
-        Extracting the label and its centerpoints.
-        '''
-        fns = sorted(glob.glob(self.dl.labelpath + '*.' + self.cfg.DATASET.FILE_FORMAT))
-
-        with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-            tmp = pool.starmap(functools.partial(calc_props, prop_list=['slices', 'centroid', 'random_pt']),
-                               enumerate(fns))
-
-        result_dict = {}
-        for dicts in tmp:
-            for key, value in dicts.items():
-                if key in result_dict:
-                    result_dict[key][0].append(value[0])
-                    result_dict[key][1].append(value[1])
-                    result_dict[key][2].append(value[2])
-                else:
-                    result_dict.setdefault(key, [])
-                    result_dict[key].append([value[0]])
-                    result_dict[key].append([value[1]])
-                    result_dict[key].append([value[2]])
-
-        if save:
-            with open(os.path.join(self.cfg.SYSTEM.ROOT_DIR, self.cfg.DATASET.ROOTF, 'eval_data_info.json'), 'w') as f:
-                json.dump(result_dict, f, cls=NumpyEncoder)
-                f.close()
-        return result_dict
-
     def fast_create_gt_vector(self, fn='gt_vector.json', save=True):
         if os.path.exists(os.path.join(self.cfg.DATASET.ROOTF, fn)) \
                 and os.stat(os.path.join(self.cfg.DATASET.ROOTF, fn)).st_size != 0 and save:
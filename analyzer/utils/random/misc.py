@@ -5,7 +5,7 @@ import multiprocessing
 import functools
 import numpy as np
 from numpyencoder import NumpyEncoder
-from analyzer.model.utils.extracting import calc_props
+from analyzer.data.region_index import RegionIndex, build_region_index, region_index_exists
 
 ### --- running example ---
 # import glob
@@ -27,13 +27,7 @@ def find_cluster_center(eval_model, cfg, unique_fns, gt_fns, save=False):
 	:param unique_fns: sorted (list) that contains filenames of all the uniquely labeled segments.
 	:param gt_fns: sorted (list) that contains filenames of all the gt and clustered segments.
 	'''
-	if os.path.exists(os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.ROOTF, 'mito_centroids.json')) \
-			and os.stat(os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.ROOTF, 'mito_centroids.json')).st_size != 0:
-		with open(os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.ROOTF, 'mito_centroids.json'), 'r') as f:
-			centroids = json.loads(f.read())
-	else:
-		print('centroids not found. Will be computed. This takes a while. Be prepared.')
-		centroids = compute_centerpoints(cfg, gt_fns, save=True)
+	centroids = compute_centerpoints(cfg, gt_fns, save=True)
 
 	gt_labels = [x['id'] for x in centroids]
 	gt_cpts = [x['c'] for x in centroids]
@@ -66,47 +60,22 @@ def find_cluster_center(eval_model, cfg, unique_fns, gt_fns, save=False):
 	return result_dict
 
 def compute_centerpoints(cfg, fns, save=True):
-	'''Compute centroids of every segment.'''
-	result_dict = {}
-	with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-		tmp = pool.starmap(functools.partial(calc_props, prop_list=['size', 'slices', 'centroid']), enumerate(fns))
-
-	for dicts in tmp:
-		for key, value in dicts.items():
-			if key in result_dict:
-				result_dict[key][0].append(value[0])
-				result_dict[key][1].append(value[1])
-				result_dict[key][2].append(value[2])
-			else:
-				result_dict.setdefault(key, [])
-				result_dict[key].append([value[0]])
-				result_dict[key].append([value[1]])
-				result_dict[key].append([value[2]])
-
-	labels = list(result_dict.keys())
-	centerpts = list()
-	for key, value in result_dict.items():
-		pt = list(map(int, [sum(x) / len(x) for x in zip(*value[2])]))
-		tmp_z = 0.0
-		for i in range(len(value[0])):
-			tmp_z += (value[0][i] / sum(value[0])) * value[1][i]
-		pt.append(int(tmp_z))
-		centerpts.append(pt)
-
-	centerpts = np.array(centerpts, dtype=np.int16)
-	for idx in range(len(labels)):
-		result_dict[labels[idx]].append([centerpts[idx]])
+	'''
+	Compute the area weighted centroids of every segment. The per slice information is taken from the region index
+	of the stack fns, that is stored in ROOTF/mito_centroids/ if save is set and reused afterwards.
+	'''
+	path = os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.ROOTF, 'mito_centroids')
+	if save and region_index_exists(path):
+		index = RegionIndex(path)
+	else:
+		index = build_region_index(fns, path=path if save else None, cpus=cfg.SYSTEM.NUM_CPUS)
 
 	result_array = []
-	for result in result_dict.keys():
+	for key, pt in zip(index.ids.tolist(), index.centroids().astype(np.int16)):
 		result_array.append({
-			'id': result,
-			'c': result_dict[result][3],
+			'id': int(key),
+			'c': [pt],
 		})
-	if save:
-		with open(os.path.join(cfg.SYSTEM.ROOT_DIR, cfg.DATASET.ROOTF, 'mito_centroids.json'), 'w') as f:
-			json.dump(result_array, f, cls=NumpyEncoder)
-			f.close()
 
 	print('centerpoints computation finished. {} extracted.'.format(len(result_array)))
 	return (result_array)
@@ -4,7 +4,7 @@ import numpy as np
 import multiprocessing
 import functools
 import imageio
-from scipy import signal
+from scipy import signal, ndimage
 from skimage import measure
 from skimage.measure import label, regionprops
 import matplotlib.pyplot as plt
@@ -13,96 +13,142 @@ from sklearn.preprocessing import normalize
 from tqdm import tqdm
 
 from analyzer.data.ptc_dataset import normalize_ptc
+from analyzer.data.ptc_store import PtcWriter
 
 def point_cloud(cfg, dl, save=True):
 	'''
 	Calculating a point cloud representation for every segment in the Dataset.
+	The slices are processed in parallel and their contours are handed in slice order to a PtcAssembler,
+	which writes every object as soon as its last slice (zmax of the region index) is done.
 	:param fns: (list) of images within the dataset.
 	:param save: (Bool) Save it or not.
-	:returns result_array: An (np.array) full of (dict)s that contain id and pts.
 	'''
 	_, fns, _ = dl.get_fns()
 	print('Starting to compute the point representation extracted from {} images.'.format(len(fns)))
-	result_dict = {}
+	index = dl.get_region_index()
+	ends = {}
+	for label, zmax in zip(index.ids.tolist(), index.zmax.tolist()):
+		ends.setdefault(zmax, []).append(label)
 
+	assembler = PtcAssembler(cfg.PTC.INPUT_DATA if save else None, fmt=cfg.PTC.STORE_FORMAT,
+							 chunks=cfg.PTC.STORE_CHUNKS, codec=cfg.PTC.STORE_CODEC)
 	with multiprocessing.Pool(processes=cfg.SYSTEM.NUM_CPUS) as pool:
-		tmp = list(tqdm(pool.imap(calc_point_repr, enumerate(fns)), total=len(fns)))
-
-	for dicts in tmp:
-		for key, value in dicts.items():
-			if key in result_dict:
-				result_dict[key][0] = np.vstack((result_dict[key][0], value[0]))
-			else:
-				result_dict.setdefault(key, [])
-				result_dict[key].append(value[0])
+		for idx, result in enumerate(tqdm(pool.imap(calc_point_repr, enumerate(fns)), total=len(fns))):
+			assembler.add(result)
+			assembler.finish(ends.get(idx, []))
+	assembler.close()
 
 	if save:
-		with h5py.File(cfg.PTC.INPUT_DATA, 'w') as h5f:
-			h5f.create_dataset('labels', data=list(result_dict.keys()))
-			grp = h5f.create_group('ptcs')
-			for result in result_dict.keys():
-				std_rs = normalize_ptc(result_dict[result][0])
-				grp.create_dataset(str(result), data=std_rs)
-			h5f.close()
 		print('saved point representations to {}.'.format(cfg.PTC.INPUT_DATA))
 	print('point cloud generation finished.')
 
+class PtcAssembler():
+	'''
+	Assembles the point clouds from per slice contour chunks in linear time. The chunks of an object are
+	collected in a list and concatenated once when the object is finished; it is then normalized, written
+	and dropped, so only the objects that cross the current slice are held in memory.
+	:param path: (string) h5 file the clouds are written to. None only assembles them.
+	:param fmt: (string) 'ragged': one ragged point cloud store (see PtcWriter).
+						 'groups': one dataset ptcs/<id> per object.
+	:param chunks: (int) points per chunk of the ragged store.
+	:param codec: (string) compression of the ragged store.
+	'''
+	def __init__(self, path=None, fmt='ragged', chunks=16384, codec='lz4'):
+		if fmt not in ['ragged', 'groups']:
+			raise ValueError('No point cloud format {}. Choose \'ragged\' or \'groups\'.'.format(fmt))
+		self.chunks = {}
+		self.labels = []
+		self.h5f, self.grp, self.writer = None, None, None
+		if path is not None and fmt == 'ragged':
+			self.writer = PtcWriter(path, chunks=chunks, codec=codec)
+		elif path is not None:
+			self.h5f = h5py.File(path, 'w')
+			self.grp = self.h5f.create_group('ptcs')
+
+	def add(self, result):
+		'''adds the contours of one slice: (dict) label -> (list) of (N x 3) arrays.'''
+		for label, chunks in result.items():
+			self.chunks.setdefault(label, []).extend(chunks)
+
+	def finish(self, labels):
+		'''concatenates and writes the objects labels, their last slice has been added.'''
+		for label in labels:
+			chunks = self.chunks.pop(label, None)
+			if chunks is None:
+				continue
+			if self.writer is not None:
+				self.writer.append(label, normalize_ptc(np.concatenate(chunks, axis=0)))
+			elif self.grp is not None:
+				self.grp.create_dataset(str(label), data=normalize_ptc(np.concatenate(chunks, axis=0)))
+			self.labels.append(label)
+
+	def close(self):
+		'''writes the remaining objects and the list of labels.'''
+		self.finish(list(self.chunks.keys()))
+		if self.writer is not None:
+			self.writer.close()
+		if self.h5f is not None:
+			self.h5f.create_dataset('labels', data=sorted(self.labels))
+			self.h5f.close()
+
 def calc_point_repr(fns):
 	'''
 	Helper for calculating the point representation.
+	The contour of every region is traced on the bounding box crop of the region, grown by one pixel
+	where the slice allows it, instead of on a full size copy of the slice. The contours are the same.
 	:param idx: This indicates the index of the image --> iterates therefor over the whole dataset.
 	:param fns: This is a concrete filename.
 	'''
 	idx, fns = fns
 	result = {}
-	# if idx >= 2:
-	# 	return result
 	if os.path.exists(fns):
 		tmp = imageio.imread(fns)
-		regions = regionprops(tmp, cache=False)
-
-		labels = list()
-		cont_list = list()
-		for props in regions:
-			labels.append(props.label)
-			#print('label of ptc: ', props.label)
-			seg = tmp.copy().astype(int)
-			seg[tmp != props.label] = 0
-
-			cs = measure.find_contours(seg, 0.8)
-			cs3d = np.hstack((cs[0], np.full((cs[0].shape[0], 1), idx, dtype=cs[0].dtype)))
-			cont_list.append(cs3d)
-
-		for l in range(len(labels)):
-			if labels[l] == 0:
-				continue
-			result.setdefault(labels[l], [])
-			result[labels[l]].append(cont_list[l])
+		for label, points in slice_contours(tmp, idx):
+			result.setdefault(label, [])
+			result[label].append(points)
 
 	return result
 
+def slice_contours(img, z):
+	'''
+	Outer contour of every region of a label slice.
+	:param img: (np.array) 2d label slice.
+	:param z: (int) slice index that is added as third coordinate.
+	:returns: (list) of (label, (N x 3) np.array) tuples in ascending label order.
+	'''
+	contours = []
+	for l, bbox in enumerate(ndimage.find_objects(img)):
+		if bbox is None:
+			continue
+		label = l + 1
+		# one pixel of context on every side that is not the border of the slice.
+		r0, c0 = max(bbox[0].start - 1, 0), max(bbox[1].start - 1, 0)
+		crop = img[r0:bbox[0].stop + 1, c0:bbox[1].stop + 1]
+		seg = np.where(crop == label, label, 0)
+
+		cs = measure.find_contours(seg, 0.8)
+		cs2d = cs[0] + np.array([r0, c0], dtype=cs[0].dtype)
+		contours.append((label, np.hstack((cs2d, np.full((cs2d.shape[0], 1), z, dtype=cs2d.dtype)))))
+	return contours
+
 
 # Additional stuff here.
 def get_surface_voxel(seg):
+	'''
+	Marks the surface voxels of a segmentation volume: voxels that have at least one of their
+	6 neighbours outside of their own label.
+	:param seg: (np.array) 3d label volume.
+	:returns surface: (np.array) of the same shape. 1 for surface voxels, 0 otherwise.
+	'''
 	assert seg.ndim == 3
-	kernel = np.array([-1, 1])
-	k_size = [1,1,1]
-	seg = seg.copy().astype(int)
-	surface = np.zeros_like(seg)
-	indices, counts = np.unique(seg, return_counts = True)
-	if indices[0] == 0:
-		indices, counts = indices[1:], counts[1:]
-	for i in range(3):
-		temp_k_size = k_size.copy()
-		temp_k_size[i] = 2
-		temp_kernel = kernel.reshape(tuple(temp_k_size))
-		temp = seg.copy()
-		edge = convolve(temp, temp_kernel, mode='constant')
-		surface += (edge!=0).astype(int)
-	seg = seg[::-1, ::-1, ::-1]
-	surface[seg == 0] = 0
-	surface = (surface!=0).astype(int)
-	return surface
+	pad = np.pad(seg, 1, mode='constant', constant_values=0)
+	surface = np.zeros(seg.shape, dtype=bool)
+	for axis in range(3):
+		for shift in [-1, 1]:
+			neighbour = np.roll(pad, shift, axis=axis)[1:-1, 1:-1, 1:-1]
+			surface |= neighbour != seg
+	surface[seg == 0] = False
+	return surface.astype(int)
 
 '''
 def generate_volume_ptc(cfg, dl):
@@ -10,6 +10,9 @@ from pytorch_lightning import loggers as pl_loggers
 from analyzer.cl.trainer import CLTrainer
 from analyzer.config import get_cfg_defaults
 from analyzer.data import Dataloader, PtcDataset
+from analyzer.data.cc_label import label_volume_store
+from analyzer.data.ptc_sampler import sample_point_clouds
+from analyzer.data.volume_store import build_volume_store
 from analyzer.model.build_model import Clustermodel
 from analyzer.vae import train
 from analyzer.vae.model.random_ptc_ae import RandomPtcAe, RandomPtcDataModule
@@ -51,10 +54,16 @@ def main():
         print("Configuration details:")
         print(cfg, '\n')
 
-    if cfg.MODE.PROCESS == "preprocessing":
+    if cfg.MODE.PROCESS == "ingest":
+        print('--- Converting the image stacks into the chunked volume store. --- \n')
+        build_volume_store(cfg)
+        return
+    elif cfg.MODE.PROCESS == "cclabel":
+        print('--- Labeling the connected components of the volume store block by block. --- \n')
+        label_volume_store(cfg)
+        return
+    elif cfg.MODE.PROCESS == "preprocessing":
         dl = Dataloader(cfg)
-        print(dl.prep_data_info())
-        exit()
         dl.extract_scale_mitos_samples()
         return
     elif cfg.MODE.PROCESS == "train":
@@ -118,6 +127,9 @@ def main():
         dl = Dataloader(cfg)
         point_cloud(cfg, dl)
         return
+    elif cfg.MODE.PROCESS == "ptcsample":
+        sample_point_clouds(cfg)
+        return
     elif cfg.MODE.PROCESS == "ptctrain":
         print('--- Starting the training process for the vae based on point clouds. --- \n')
         ptcdl = PtcDataset(cfg)
@@ -143,6 +155,16 @@ def main():
         print('--- Extracting the features using the Contrastive Learning model. --- \n')
         trainer = CLTrainer(cfg)
         trainer.infer_feat_vector()
+    elif cfg.MODE.PROCESS == "clcompare":
+        print('--- Comparing the clustering algorithms on the same features. --- \n')
+        dl = Dataloader(cfg)
+        model = Clustermodel(cfg, dl=dl)
+        model.compare()
+    elif cfg.MODE.PROCESS == "clsweep":
+        print('--- Sweeping the feature weights and numbers of clusters. --- \n')
+        dl = Dataloader(cfg)
+        model = Clustermodel(cfg, dl=dl)
+        model.sweep()
     else:
         dl = Dataloader(cfg)
         model = Clustermodel(cfg, dl=dl)
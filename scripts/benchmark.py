@@ -0,0 +1,268 @@
+import argparse
+import sys, os
+import glob
+import time
+import resource
+import tracemalloc
+import multiprocessing
+
+import imageio
+import numpy as np
+from scipy.spatial import cKDTree, distance
+from sklearn.cluster import DBSCAN, SpectralClustering
+from skimage import measure
+from skimage.measure import regionprops
+
+# adding the right path.
+parent = os.path.abspath(os.getcwd())
+sys.path.append(parent)
+
+from analyzer.model.utils.scanner import slice_stats, cc
+from analyzer.model.utils.dist_engine import SingleLinkage, knn_graph, knn_affinity
+from analyzer.vae.model.utils.pt import slice_contours
+from analyzer.data.ptc_sampler import farthest_point_sample
+
+# RUN THE SCRIPT LIKE: $ python scripts/benchmark.py --bench slice_stats
+
+def create_arg_parser():
+    '''Get arguments from command lines.'''
+    parser = argparse.ArgumentParser(description="Benchmarks of the processing kernels.")
+    parser.add_argument('--bench', type=str, default='slice_stats', help='benchmark that is run: slice_stats || knn || contours || bluenoise')
+    parser.add_argument('--fns', type=str, default=None, help='glob of label images. Synthetic slices are used if not set.')
+    parser.add_argument('--size', type=int, default=2048, help='height and width of the synthetic slices')
+    parser.add_argument('--labels', type=int, default=4000, help='number of labels per synthetic slice')
+    parser.add_argument('--slices', type=int, default=3, help='number of slices that are timed')
+    parser.add_argument('--objects', type=str, default='10000,50000,100000', help='comma separated numbers of objects (knn)')
+    parser.add_argument('--dims', type=int, default=16, help='dimension of the synthetic feature matrix (knn)')
+    parser.add_argument('--alg', type=str, default='aggloCl', help='clustering that consumes the graph: aggloCl || specCl || dbscan (knn)')
+    parser.add_argument('--k', type=int, default=30, help='neighbours per object (knn)')
+    parser.add_argument('--dense_max', type=int, default=20000, help='largest number of objects the dense path is run for (knn)')
+    parser.add_argument('--points', type=str, default='5000,20000,100000', help='comma separated numbers of points per cloud (bluenoise)')
+    parser.add_argument('--samples', type=int, default=4096, help='points sampled per cloud (bluenoise)')
+    parser.add_argument('--candidates', type=int, default=10, help='random candidates per blue noise step (bluenoise)')
+    parser.add_argument('--pairwise_max', type=int, default=20000, help='largest cloud the pairwise sampler is run for (bluenoise)')
+
+    return parser
+
+def synthetic_slice(size, n_labels, seed=0):
+    '''Dense label slice: voronoi cells of n_labels random seeds, about 10% of them background.'''
+    rng = np.random.default_rng(seed)
+    seeds = rng.integers(0, size, (n_labels, 2))
+    grid = np.stack(np.meshgrid(np.arange(size), np.arange(size), indexing='ij'), axis=-1).reshape(-1, 2)
+    _, nearest = cKDTree(seeds).query(grid)
+    ids = rng.permutation(np.arange(1, n_labels + 1))
+    ids[rng.random(n_labels) < 0.1] = 0
+    return ids[nearest].reshape(size, size).astype(np.uint16)
+
+def regionprops_stats(img):
+    '''The per region loop that calc_props used before the vectorised kernel.'''
+    result = {}
+    for props in regionprops(img, cache=False):
+        minr, minc, maxr, maxc = props.bbox
+        result[props.label] = [props.area, tuple(map(int, props.centroid)), cc(props.area, props.perimeter),
+                               props.perimeter, tuple(np.argwhere(img == props.label)[0]), props.bbox]
+    return result
+
+def bincount_stats(img):
+    stats = slice_stats(img)
+    result = {}
+    for l, label in enumerate(stats['labels'].tolist()):
+        result[label] = [int(stats['area'][l]), tuple(map(int, stats['centroid'][l])),
+                         cc(stats['area'][l], stats['perimeter'][l]), stats['perimeter'][l],
+                         tuple(stats['first'][l]), tuple(stats['bbox'][l])]
+    return result
+
+def bench_slice_stats(args):
+    if args.fns is not None:
+        slices = [imageio.imread(fn) for fn in sorted(glob.glob(args.fns))[:args.slices]]
+    else:
+        slices = [synthetic_slice(args.size, args.labels, seed=i) for i in range(args.slices)]
+
+    timings = {'regionprops': [], 'bincount': []}
+    for img in slices:
+        t = time.perf_counter()
+        reference = regionprops_stats(img)
+        timings['regionprops'].append(time.perf_counter() - t)
+
+        t = time.perf_counter()
+        result = bincount_stats(img)
+        timings['bincount'].append(time.perf_counter() - t)
+
+        if reference.keys() != result.keys():
+            raise ValueError('label sets differ.')
+        for key in reference.keys():
+            ref, res = reference[key], result[key]
+            if ref[0] != res[0] or ref[1] != res[1] or ref[4] != res[4] or tuple(ref[5]) != res[5] \
+                    or not np.isclose(ref[3], res[3]) or not np.isclose(ref[2], res[2]):
+                raise ValueError('statistics of label {} differ: {} vs. {}'.format(key, ref, res))
+
+    print('{} slices of shape {} with {} labels on average.'.format(
+        len(slices), slices[0].shape, int(np.mean([len(np.unique(img)) - 1 for img in slices]))))
+    for name, t in timings.items():
+        print('{:>12}: {:.3f} s per slice'.format(name, np.mean(t)))
+    print('     speedup: {:.1f}x (results identical)'.format(np.mean(timings['regionprops']) / np.mean(timings['bincount'])))
+
+def synthetic_features(n, dims, n_clusters=5, seed=0):
+    '''Feature matrix of n objects in n_clusters gaussian blobs, scaled to [0, 1] like prep_feature_matrix.'''
+    rng = np.random.default_rng(seed)
+    centers = rng.random((n_clusters, dims))
+    X = centers[rng.integers(0, n_clusters, n)] + 0.05 * rng.standard_normal((n, dims))
+    X = (X - X.min(axis=0)) / (X.max(axis=0) - X.min(axis=0))
+    return X.astype(np.float32)
+
+def cluster_input(X, path, alg, k):
+    '''builds the input of alg: the dense (N x N) matrix or the sparse kNN graph.'''
+    if path == 'dense':
+        dist = distance.cdist(X, X, 'euclidean').astype(np.float32)
+        if alg == 'specCl':
+            return np.exp(-dist ** 2 / (2 * dist.mean() ** 2))
+        return dist
+    graph = knn_graph(X, k, mode=path)
+    return knn_affinity(graph) if alg == 'specCl' else graph
+
+def run_knn_case(n, dims, path, alg, k, queue):
+    '''Runs one case in a fresh process, so that ru_maxrss is the peak of this case only.'''
+    X = synthetic_features(n, dims)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.perf_counter()
+    clst_m = cluster_input(X, path, alg, k)
+    t_input = time.perf_counter() - t
+
+    if alg == 'aggloCl':
+        model = SingleLinkage(n_clusters=5)
+    elif alg == 'specCl':
+        model = SpectralClustering(n_clusters=5, affinity='precomputed', random_state=0)
+    elif alg == 'dbscan':
+        model = DBSCAN(eps=0.05, metric='precomputed')
+    else:
+        raise ValueError('No clustering {} in the knn benchmark.'.format(alg))
+    t = time.perf_counter()
+    model.fit_predict(clst_m)
+    t_fit = time.perf_counter() - t
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((t_input, t_fit, (peak - base) / 1024, peak / 1024))
+
+def bench_knn(args):
+    ctx = multiprocessing.get_context('spawn')
+    print('{:>8} {:>7} {:>10} {:>10} {:>10} {:>14} {:>14}'.format(
+        'objects', 'path', 'input [s]', 'fit [s]', 'total [s]', 'peak +RSS [MB]', 'peak RSS [MB]'))
+    for n in [int(n) for n in args.objects.split(',')]:
+        for path in ['dense', 'exact', 'approx']:
+            if path == 'dense' and n > args.dense_max:
+                print('{:>8} {:>7} skipped, the dense matrix needs {:.1f} GB.'.format(n, path, 4 * n ** 2 / 1024 ** 3))
+                continue
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_knn_case, args=(n, args.dims, path, args.alg, args.k, queue))
+            proc.start()
+            t_input, t_fit, rss, peak = queue.get()
+            proc.join()
+            print('{:>8} {:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>14.0f} {:>14.0f}'.format(
+                n, path, t_input, t_fit, t_input + t_fit, rss, peak))
+
+def full_slice_contours(img, z):
+    '''The per region loop of calc_point_repr before the bbox crop: one full size copy of the slice per region.'''
+    contours = []
+    for props in regionprops(img, cache=False):
+        seg = img.copy().astype(int)
+        seg[img != props.label] = 0
+        cs = measure.find_contours(seg, 0.8)
+        contours.append((props.label, np.hstack((cs[0], np.full((cs[0].shape[0], 1), z, dtype=cs[0].dtype)))))
+    return contours
+
+def run_contour_case(name, slices, queue):
+    '''Runs one contour function in a fresh process, so that ru_maxrss is the peak of this function only.'''
+    func = full_slice_contours if name == 'full slice' else slice_contours
+    t = time.perf_counter()
+    result = [func(img, z) for z, img in enumerate(slices)]
+    elapsed = time.perf_counter() - t
+    # the imports dominate ru_maxrss, so the peak of the arrays allocated while tracing is measured as well.
+    tracemalloc.start()
+    for z, img in enumerate(slices):
+        func(img, z)
+    peak_alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    queue.put((elapsed, peak_alloc / 1024 ** 2, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, result))
+
+def bench_contours(args):
+    if args.fns is not None:
+        slices = [imageio.imread(fn) for fn in sorted(glob.glob(args.fns))[:args.slices]]
+    else:
+        slices = [synthetic_slice(args.size, args.labels, seed=i) for i in range(args.slices)]
+    print('{} slices of shape {} with {} labels on average.'.format(
+        len(slices), slices[0].shape, int(np.mean([len(np.unique(img)) - 1 for img in slices]))))
+
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    print('{:>12} {:>10} {:>10} {:>16} {:>14}'.format('contours', 'time [s]', 'slices/s', 'peak alloc [MB]', 'peak RSS [MB]'))
+    for name in ['full slice', 'bbox crop']:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_contour_case, args=(name, slices, queue))
+        proc.start()
+        elapsed, alloc, rss, results[name] = queue.get()
+        proc.join()
+        print('{:>12} {:>10.2f} {:>10.2f} {:>16.1f} {:>14.0f}'.format(name, elapsed, len(slices) / elapsed, alloc, rss))
+
+    for ref, res in zip(results['full slice'], results['bbox crop']):
+        if [l for l, _ in ref] != [l for l, _ in res] or not all(np.allclose(a, b) for (_, a), (_, b) in zip(ref, res)):
+            raise ValueError('contours differ.')
+    print('contours identical.')
+
+def pairwise_blue_noise(cloud, n, candidates, seed=0):
+    '''PtcDataset.calculate_blue_noise_samples before the sampler: full pairwise matrix and summed distances.'''
+    rng = np.random.default_rng(seed)
+    dists = distance.cdist(cloud, cloud)
+    idxs = [int(rng.integers(0, len(cloud)))]
+    for i in range(1, n):
+        cand = rng.integers(0, len(cloud), candidates)
+        idxs.append(cand[np.argmax(np.sum(dists[cand, :][:, idxs], axis=1))])
+    return np.array(idxs)
+
+def run_blue_noise_case(name, cloud, n, candidates, queue):
+    '''Runs one sampler in a fresh process and reports time and peak RSS.'''
+    t = time.perf_counter()
+    if name == 'pairwise':
+        idxs = pairwise_blue_noise(cloud, n, candidates)
+    else:
+        idxs = farthest_point_sample([cloud], n, candidates=candidates)[0]
+    elapsed = time.perf_counter() - t
+    # spacing of the samples: mean distance to the nearest other sample.
+    nn = cKDTree(cloud[idxs]).query(cloud[idxs], k=2)[0][:, 1]
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, float(np.mean(nn))))
+
+def bench_blue_noise(args):
+    ctx = multiprocessing.get_context('spawn')
+    rng = np.random.default_rng(0)
+    print('{:>10} {:>10} {:>10} {:>14} {:>12}'.format('points', 'sampler', 'time [s]', 'peak RSS [MB]', 'nn spacing'))
+    for n_points in [int(n) for n in args.points.split(',')]:
+        # points on the surface of an ellipsoid, like the contour clouds of a mitochondrion.
+        cloud = rng.normal(size=(n_points, 3))
+        cloud = cloud / np.linalg.norm(cloud, axis=1, keepdims=True) * np.array([1.0, 0.4, 0.3])
+        for name in ['pairwise', 'min-dist']:
+            if name == 'pairwise' and n_points > args.pairwise_max:
+                print('{:>10} {:>10} {:>10}'.format(n_points, name, 'skipped'))
+                continue
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_blue_noise_case, args=(name, cloud, args.samples, args.candidates, queue))
+            proc.start()
+            elapsed, rss, spacing = queue.get()
+            proc.join()
+            print('{:>10} {:>10} {:>10.2f} {:>14.0f} {:>12.4f}'.format(n_points, name, elapsed, rss, spacing))
+
+def main():
+    '''benchmark function.'''
+    arg_parser = create_arg_parser()
+    args = arg_parser.parse_args(sys.argv[1:])
+
+    if args.bench == 'slice_stats':
+        bench_slice_stats(args)
+    elif args.bench == 'knn':
+        bench_knn(args)
+    elif args.bench == 'contours':
+        bench_contours(args)
+    elif args.bench == 'bluenoise':
+        bench_blue_noise(args)
+    else:
+        raise ValueError('No benchmark {} found.'.format(args.bench))
+
+if __name__ == "__main__":
+    main()